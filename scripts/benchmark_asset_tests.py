@@ -0,0 +1,493 @@
+# python scripts/benchmark_asset_tests.py --benchmark ingestion --size-mb 2048
+# python scripts/benchmark_asset_tests.py --benchmark normalize --rows 1000000
+# python scripts/benchmark_asset_tests.py --benchmark records --size-mb 64
+# python scripts/benchmark_asset_tests.py --benchmark render --tickers 5000
+# python scripts/benchmark_asset_tests.py --benchmark stages --sizes 10000,100000,1000000,10000000 --output stages.json
+# python scripts/benchmark_asset_tests.py --benchmark formats --sizes 100000,1000000 --output formats.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import generate_asset_tests as gat
+import synthetic_b3_exports
+
+# --- Configuration ---
+DEFAULT_SIZE_MB = 2048 # Size of the synthetic export used by the memory benchmark
+DEFAULT_ROWS = 1_000_000 # Rows of the synthetic column used by the normalization benchmark
+DEFAULT_TICKERS = 5000 # Synthetic tickers rendered by the template benchmark
+DEFAULT_STAGE_SIZES = '10000,100000,1000000,10000000' # Negociação rows of each stages benchmark run
+DEFAULT_STAGE_TICKERS = 200 # Distinct tickers of the synthetic exports used by the stages benchmark
+DISTINCT_PRODUCTS = 400 # Distinct 'Produto'/'Código de Negociação' strings in that column
+SYNTHETIC_TICKERS = ['EXMP3', 'EXMP4', 'FIIX11', 'BANC4', 'ENRG3', 'SNEM3', 'ATIV3', 'HOLD11']
+SYNTHETIC_BROKERS = ['CORRETORA EXEMPLO S/A', 'OUTRA CORRETORA EXEMPLO']
+
+# Reads every history file of one format the way the generated tests do: JSON files through
+# readFileSync + JSON.parse (what Jest's JSON module import does), NDJSON and columnar files
+# as carregarHistorico in the calculation helper does. Prints {"files", "records", "seconds"}.
+NODE_HISTORY_IMPORT_SCRIPT = r"""
+const fs = require('fs');
+const path = require('path');
+const [dir, extension] = process.argv.slice(-2); // node -e puts the arguments right after argv[0]
+
+function expand(h) {
+    const layouts = h.layouts.map(fields => fields.map(i => [h.fields[i], h.columns[h.fields[i]], h.dictionaries[h.fields[i]]]));
+    const records = new Array(h.length);
+    for (let r = 0; r < h.length; r++) {
+        const record = {};
+        for (const [name, values, dictionary] of layouts[h.layout ? h.layout[r] : 0]) {
+            record[name] = dictionary ? dictionary[values[r]] : values[r];
+        }
+        records[r] = record;
+    }
+    return records;
+}
+
+const files = fs.readdirSync(dir).filter(name => name.endsWith(extension) && (extension !== '.json' || !name.endsWith('.columns.json')));
+let records = 0;
+const start = process.hrtime.bigint();
+for (const name of files) {
+    const content = fs.readFileSync(path.join(dir, name), 'utf-8');
+    let data;
+    if (extension === '.ndjson') {
+        data = content.split('\n').filter(line => line !== '').map(line => JSON.parse(line));
+    } else {
+        data = JSON.parse(content);
+        if (!Array.isArray(data)) data = expand(data);
+    }
+    records += data.length;
+}
+const seconds = Number(process.hrtime.bigint() - start) / 1e9;
+process.stdout.write(JSON.stringify({ files: files.length, records: records, seconds: seconds }));
+"""
+
+# --- Helper Functions ---
+
+def write_synthetic_negociacao(file_path: str, size_mb: int, seed: int = 42) -> int:
+    """Writes a negociação export of roughly size_mb megabytes, returning the record count."""
+    rng = random.Random(seed)
+    target_bytes = size_mb * 1024 * 1024
+    written = 0
+    count = 0
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        while written < target_bytes:
+            quantity = rng.randint(1, 500)
+            price = rng.randint(100, 20000) / 100
+            record = {
+                gat.FIELD_NEG_DATE: f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2015, 2025)}",
+                gat.FIELD_NEG_TYPE: rng.choice(['Compra', gat.NEG_TYPE_SELL]),
+                gat.FIELD_NEG_MARKET_TYPE: 'Mercado à Vista',
+                'Prazo/Vencimento': '-',
+                gat.FIELD_NEG_BROKER_NAME: rng.choice(SYNTHETIC_BROKERS),
+                gat.FIELD_NEG_TICKER: rng.choice(SYNTHETIC_TICKERS),
+                gat.FIELD_NEG_QUANTITY: str(quantity),
+                gat.FIELD_NEG_UNIT_PRICE: f"{price:.2f}",
+                gat.FIELD_NEG_TOTAL_COST: f"{quantity * price:.2f}",
+            }
+            text = ('' if count == 0 else ',\n') + json.dumps(record, indent=4, ensure_ascii=False)
+            f.write(text)
+            written += len(text.encode('utf-8'))
+            count += 1
+        f.write('\n]\n')
+
+    return count
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return round(peak_rss / (1024 * 1024), 1)
+
+def current_rss_mb() -> float:
+    """Resident memory right now (Linux only, None elsewhere)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        return None
+
+def measure_ingestion(file_path: str, mode: str) -> dict:
+    """
+    Runs the ingestion pipeline on the file in the given mode: load_json_data, fragment_data
+    and then every ticker's records read back record by record, as the history files are
+    written. Reports time and peak RSS.
+    """
+    start = time.perf_counter()
+    fragmented = gat.fragment_data(gat.load_json_data(file_path, stream=(mode == 'stream')), [])
+    count = 0
+    for ticker in fragmented:
+        for _ in fragmented.iter_records(ticker, "transactions"):
+            count += 1
+    elapsed = time.perf_counter() - start
+
+    return {"mode": mode, "records": count, "seconds": round(elapsed, 3), "peak_rss_mb": peak_rss_mb()}
+
+def run_isolated(file_path: str, mode: str) -> dict:
+    """Runs measure_ingestion in a fresh interpreter so peak RSS is not shared between modes."""
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", mode, "--input", file_path],
+        check=True, capture_output=True, text=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def benchmark_ingestion(size_mb: int, input_path: str = None) -> list:
+    """Compares peak RSS of the ingestion pipeline after a full json.load vs streaming ingestion."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not input_path:
+            input_path = os.path.join(tmp_dir, 'negociacao-sintetica.json')
+            print(f"Writing synthetic export of ~{size_mb} MB to {input_path}...")
+            records = write_synthetic_negociacao(input_path, size_mb)
+            print(f"Wrote {records} records ({Path(input_path).stat().st_size / (1024 * 1024):.1f} MB).")
+
+        return [run_isolated(input_path, mode) for mode in ("stream", "load")]
+
+def synthetic_ticker_column(rows: int, seed: int = 42) -> list:
+    """A column mixing negociação codes ('ABCD3', 'ABCD3F') and movimentação products ('ABCD3 - NAME')."""
+    rng = random.Random(seed)
+    distinct = []
+    for i in range(DISTINCT_PRODUCTS):
+        base = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+        code = f"{base}{rng.choice([3, 4, 5, 6, 11])}"
+        distinct.append([code, f"{code}F", f"{code} - EMPRESA {base} S/A"][i % 3])
+    return [rng.choice(distinct) for _ in range(rows)]
+
+def normalize_ticker_uncached(ticker_raw: str) -> str:
+    """The previous per-record implementation, kept as the benchmark baseline."""
+    ticker_part = ticker_raw.split(' - ')[0]
+    match = re.match(r"([A-Z]+)", ticker_part.upper())
+    return match.group(1) if match else ticker_part.upper()
+
+def benchmark_normalize(rows: int) -> list:
+    """Times uncached, memoized per-record and batch ticker normalization over the same column."""
+    column = synthetic_ticker_column(rows)
+    gat._normalize_ticker_cached.cache_clear()
+
+    variants = [
+        ("uncached", lambda: [normalize_ticker_uncached(value) for value in column]),
+        ("memoized", lambda: [gat.normalize_ticker(value) for value in column]),
+        ("batch", lambda: gat.normalize_ticker_column(column)),
+    ]
+
+    results = []
+    baseline = None
+    expected = None
+    for name, run in variants:
+        start = time.perf_counter()
+        normalized = run()
+        elapsed = time.perf_counter() - start
+
+        if expected is None:
+            expected, baseline = normalized, elapsed
+        elif normalized != expected:
+            raise AssertionError(f"{name} normalization differs from the uncached baseline")
+
+        results.append({"variant": name, "rows": rows, "seconds": round(elapsed, 3), "speedup": round(baseline / elapsed, 2)})
+    return results
+
+def measure_records(file_path: str, representation: str) -> dict:
+    """Memory retained by the loaded rows of the export, as dicts or as compact records."""
+    tracemalloc.start()
+    rows = gat.load_json_data(file_path, compact=(representation == "compact"))
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "representation": representation,
+        "records": len(rows),
+        "retained_mb": round(retained / (1024 * 1024), 1),
+        "peak_mb": round(peak / (1024 * 1024), 1),
+        "bytes_per_record": round(retained / max(len(rows), 1)),
+    }
+
+def benchmark_records(size_mb: int, input_path: str = None) -> list:
+    """Compares memory per record of the dict rows vs NegotiationRecord (__slots__) rows."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not input_path:
+            input_path = os.path.join(tmp_dir, 'negociacao-sintetica.json')
+            write_synthetic_negociacao(input_path, size_mb)
+
+        results = [measure_records(input_path, representation) for representation in ("dict", "compact")]
+
+    baseline = results[0]["bytes_per_record"]
+    for result in results:
+        result["ratio"] = round(result["bytes_per_record"] / baseline, 2)
+    return results
+
+def legacy_jest_renderer():
+    """The previous per-call f-string evaluation of the Jest template, kept as the benchmark baseline."""
+    source = (
+        "def render(ticker, history_dir_relative_posix, declaration_year):\n"
+        f"    return f\"\"\"{gat.JEST_TEST_TEMPLATE}\"\"\"\n"
+    )
+    namespace = dict(vars(gat))
+    exec(source, namespace)
+    return namespace["render"]
+
+def legacy_generate_jest_test_file(render, ticker: str, test_dir: str, history_dir_relative: str, declaration_year: int):
+    """The previous generate_jest_test_file body around the given renderer."""
+    template = render(ticker, history_dir_relative.replace('\\', '/'), declaration_year)
+    Path(test_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(test_dir) / f"{ticker}.test.ts", 'w', encoding='utf-8') as f:
+        f.write(template)
+
+def benchmark_render(tickers: int) -> list:
+    """Per-ticker cost of rendering (and writing) the Jest test file: f-string per call vs compiled template."""
+    names = [f"T{i:05d}" for i in range(tickers)]
+    history = "history"
+    legacy = legacy_jest_renderer()
+
+    for ticker in names[:50]:
+        expected = legacy(ticker, history, gat.DECLARATION_YEAR)
+        rendered = gat.JEST_TEST_COMPILED.render({"ticker": ticker, "history_dir_relative_posix": history, "declaration_year": gat.DECLARATION_YEAR})
+        if rendered != expected:
+            raise AssertionError(f"Compiled template differs from the f-string for {ticker}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_root:
+        # Each variant writes into a fresh directory, so none of them only overwrites files
+        fresh_dir = lambda name: os.path.join(tmp_root, name)
+        variants = [
+            ("render_fstring", lambda ticker: legacy(ticker, history, gat.DECLARATION_YEAR)),
+            ("render_compiled", lambda ticker: gat.JEST_TEST_COMPILED.render(
+                {"ticker": ticker, "history_dir_relative_posix": history, "declaration_year": gat.DECLARATION_YEAR})),
+            ("write_fstring", lambda ticker: legacy_generate_jest_test_file(legacy, ticker, fresh_dir("fstring"), history, gat.DECLARATION_YEAR)),
+            ("write_compiled", lambda ticker: gat.generate_jest_test_file(ticker, fresh_dir("compiled"), history, (gat.DECLARATION_YEAR,))),
+        ]
+        for name, run in variants:
+            start = time.perf_counter()
+            for ticker in names:
+                run(ticker)
+            elapsed = time.perf_counter() - start
+            results.append({"variant": name, "tickers": tickers, "seconds": round(elapsed, 3), "us_per_ticker": round(elapsed / tickers * 1e6, 1)})
+    return results
+
+def measure_stages(negociacao_path: str, movimentacao_path: str, output_dir: str, stream: bool = False, compact: bool = False) -> list:
+    """
+    Runs the script's stages one after the other on the given exports, reporting for each
+    its wall and CPU time, records handled, resident memory after it and peak RSS so far.
+    """
+    stages = []
+
+    def run(name: str, stage, records=None):
+        # records: count handled by the stage, or a function of its result
+        start, cpu_start = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()): # The stages print progress lines
+            result = stage()
+        elapsed = time.perf_counter() - start
+        if callable(records):
+            records = records(result)
+        stages.append({
+            "stage": name,
+            "seconds": round(elapsed, 3),
+            "cpu_seconds": round(time.process_time() - cpu_start, 3),
+            "records": records,
+            "records_per_second": round(records / elapsed) if records and elapsed > 0 else None,
+            "rss_mb": current_rss_mb(),
+            "peak_rss_mb": peak_rss_mb(),
+        })
+        return result
+
+    load = lambda path: list(gat.load_json_data(path, stream=stream, compact=compact))
+    negociacao, movimentacao = run(
+        "load_json_data", lambda: (load(negociacao_path), load(movimentacao_path)), lambda loaded: len(loaded[0]) + len(loaded[1])
+    )
+    records = len(negociacao) + len(movimentacao)
+
+    column = [r.get(gat.FIELD_NEG_TICKER) for r in negociacao] + [r.get(gat.FIELD_MOV_TICKER) for r in movimentacao]
+    gat._normalize_ticker_cached.cache_clear()
+    run("normalize_ticker", lambda: [gat.normalize_ticker(value) for value in column], len(column))
+    del column
+
+    gat._normalize_ticker_cached.cache_clear()
+    fragmented = run("fragment_data", lambda: gat.fragment_data(negociacao, movimentacao), records)
+
+    history_dir = Path(output_dir) / 'history'
+    test_dir = Path(output_dir) / 'tests'
+    run("save_fragmented_files", lambda: gat.save_fragmented_files(fragmented, history_dir), records)
+    run("generate_calculation_helper_file", lambda: gat.generate_calculation_helper_file(test_dir), 1)
+    relative = os.path.relpath(history_dir, test_dir)
+    run("generate_jest_test_file", lambda: [gat.generate_jest_test_file(ticker, test_dir, relative) for ticker in fragmented], len(fragmented))
+    return stages
+
+def benchmark_stages(sizes: list, tickers: int, stream: bool = False, compact: bool = False) -> list:
+    """
+    Writes seeded synthetic exports of each size and measures every stage on them in a fresh
+    interpreter, so peak RSS is not shared between sizes.
+    """
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            negociacao_path = os.path.join(tmp_dir, 'negociacao-sintetica.json')
+            movimentacao_path = os.path.join(tmp_dir, 'movimentacao-sintetica.json')
+            start = time.perf_counter()
+            counts = synthetic_b3_exports.write_synthetic_exports(negociacao_path, movimentacao_path, rows=rows, tickers=tickers)
+            generation_seconds = time.perf_counter() - start
+            print(f"Measuring {counts['negociacao']} negociação + {counts['movimentacao']} movimentação rows...", file=sys.stderr)
+
+            command = [sys.executable, __file__, "--measure-stages", "--input", negociacao_path, "--movimentacao", movimentacao_path,
+                       "--stage-dir", os.path.join(tmp_dir, 'out')]
+            command += ["--stream"] if stream else []
+            command += ["--compact"] if compact else []
+            measured = subprocess.run(command, check=True, capture_output=True, text=True)
+
+            results.append({
+                "rows": rows,
+                "negociacao_records": counts["negociacao"],
+                "movimentacao_records": counts["movimentacao"],
+                "tickers": counts["tickers"],
+                "negociacao_mb": round(Path(negociacao_path).stat().st_size / (1024 * 1024), 1),
+                "generation_seconds": round(generation_seconds, 3),
+                "stages": json.loads(measured.stdout.strip().splitlines()[-1]),
+            })
+    return results
+
+def benchmark_formats(sizes: list, tickers: int) -> list:
+    """
+    Bytes on disk, Python write time and node read+parse time (the cost of the generated
+    tests importing their history) of every --history-format, on seeded synthetic exports.
+    The node column is None when node is not installed.
+    """
+    node = shutil.which('node')
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            negociacao_path = os.path.join(tmp_dir, 'negociacao-sintetica.json')
+            movimentacao_path = os.path.join(tmp_dir, 'movimentacao-sintetica.json')
+            synthetic_b3_exports.write_synthetic_exports(negociacao_path, movimentacao_path, rows=rows, tickers=tickers)
+            fragmented = gat.fragment_data(gat.load_json_data(negociacao_path), gat.load_json_data(movimentacao_path))
+            print(f"Measuring history formats of {rows} negociação rows ({len(fragmented)} tickers)...", file=sys.stderr)
+
+            for history_format in gat.HISTORY_FORMATS:
+                history_dir = Path(tmp_dir) / history_format
+                start = time.perf_counter()
+                gat.save_fragmented_files(fragmented, history_dir, history_format=history_format)
+                write_seconds = time.perf_counter() - start
+
+                result = {
+                    "rows": rows,
+                    "format": history_format,
+                    "bytes": sum(path.stat().st_size for path in history_dir.iterdir()),
+                    "write_seconds": round(write_seconds, 3),
+                    "node_import_seconds": None,
+                }
+                if node:
+                    measured = subprocess.run(
+                        [node, "-e", NODE_HISTORY_IMPORT_SCRIPT, str(history_dir), gat.HISTORY_FILE_EXTENSIONS[history_format]],
+                        check=True, capture_output=True, text=True
+                    )
+                    result["node_import_seconds"] = round(json.loads(measured.stdout)["seconds"], 3)
+                results.append(result)
+                shutil.rmtree(history_dir)
+    return results
+
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark stages of scripts/generate_asset_tests.py.")
+    parser.add_argument(
+        "--benchmark",
+        choices=["ingestion", "normalize", "records", "render", "stages", "formats"],
+        default="ingestion",
+        help="ingestion: peak memory of full vs streaming JSON loading; normalize: ticker normalization speed; "
+             "records: memory per record of dict vs compact rows; render: per-ticker Jest template cost; "
+             "stages: time and memory of every stage on synthetic exports of each --sizes; "
+             "formats: bytes and write/import time of each history file format (default: ingestion)"
+    )
+    parser.add_argument(
+        "--size-mb",
+        type=int,
+        default=DEFAULT_SIZE_MB,
+        help=f"Size of the synthetic negociação export in MB (default: {DEFAULT_SIZE_MB})"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=DEFAULT_ROWS,
+        help=f"Rows of the synthetic ticker column for the normalize benchmark (default: {DEFAULT_ROWS})"
+    )
+    parser.add_argument(
+        "--tickers",
+        type=int,
+        default=DEFAULT_TICKERS,
+        help=f"Synthetic tickers for the render benchmark (default: {DEFAULT_TICKERS})"
+    )
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_STAGE_SIZES,
+        help=f"Comma-separated negociação row counts for the stages and formats benchmarks (default: {DEFAULT_STAGE_SIZES})"
+    )
+    parser.add_argument(
+        "--stage-tickers",
+        type=int,
+        default=DEFAULT_STAGE_TICKERS,
+        help=f"Distinct tickers of the synthetic exports for the stages and formats benchmarks (default: {DEFAULT_STAGE_TICKERS})"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stages benchmark: load the exports with the incremental parser"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Stages benchmark: load the rows as compact records"
+    )
+    parser.add_argument(
+        "--output",
+        help="Also write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--input",
+        help="Use an existing export instead of generating a synthetic one"
+    )
+    parser.add_argument(
+        "--measure",
+        choices=["load", "stream"],
+        help=argparse.SUPPRESS # Internal: measure a single mode in this process
+    )
+    parser.add_argument("--measure-stages", action="store_true", help=argparse.SUPPRESS) # Internal: stages of one size
+    parser.add_argument("--movimentacao", help=argparse.SUPPRESS)
+    parser.add_argument("--stage-dir", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_ingestion(args.input, args.measure)))
+        sys.exit(0)
+
+    if args.measure_stages:
+        print(json.dumps(measure_stages(args.input, args.movimentacao, args.stage_dir, args.stream, args.compact)))
+        sys.exit(0)
+
+    if args.benchmark == "normalize":
+        results = benchmark_normalize(args.rows)
+    elif args.benchmark == "stages":
+        results = benchmark_stages([int(size) for size in args.sizes.split(',')], args.stage_tickers, args.stream, args.compact)
+    elif args.benchmark == "formats":
+        results = benchmark_formats([int(size) for size in args.sizes.split(',')], args.stage_tickers)
+    elif args.benchmark == "render":
+        results = benchmark_render(args.tickers)
+    elif args.benchmark == "records":
+        results = benchmark_records(args.size_mb, args.input)
+    else:
+        results = benchmark_ingestion(args.size_mb, args.input)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
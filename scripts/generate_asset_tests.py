@@ -1,12 +1,56 @@
 # python scripts/generate_asset_tests.py --year 2024
 
+import cProfile
+import glob
+import hashlib
+import heapq
 import json
 import os
+import pstats
 import re
+import shutil
+import string
+import textwrap
+import sys
+import tempfile
+import time
+import unicodedata
+import weakref
 import argparse
-from collections import defaultdict
+from array import array
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, timedelta
+from fractions import Fraction
+from functools import lru_cache
+from itertools import chain, count, repeat
+from math import gcd
 from pathlib import Path
 
+try:
+    import resource # Unix only, used for CPU time of worker processes and peak RSS
+except ImportError:
+    resource = None
+
+try:
+    import numpy as np
+except ImportError: # Optional: only needed by the vectorized engine and the export cache
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Optional: the export cache falls back to NumPy .npz
+    pa = pq = None
+
+try:
+    import openpyxl
+except ImportError: # Optional: only needed to read the B3 Portal .xlsx exports directly
+    openpyxl = None
+
 # --- Configuration ---
 DEFAULT_NEGOCIACAO_PATH = '../documentation/arquivos-b3/negociacao-exemplo.json'
 DEFAULT_MOVIMENTACAO_PATH = '../documentation/arquivos-b3/movimentacao-exemplo.json'
@@ -15,6 +59,8 @@ DECLARATION_YEAR = 2024 # Default year, can be overridden
 
 OUTPUT_HISTORY_DIR = '../src/infrastructure/adapters/__tests__/calculation/history'
 OUTPUT_TEST_DIR = '../src/infrastructure/adapters/__tests__/calculation'
+JEST_ROOT_DIR = '..' # Directory of package.json, the shard manifest's suite paths are relative to it
+JEST_TEST_COMMAND = 'npx react-scripts test --watchAll=false' # react-scripts 5 runs Jest 27, which has no --shard
 
 # --- Configurable JSON Field Names ---
 FIELD_INDEX = '_original_index'
@@ -35,6 +81,7 @@ FIELD_MOV_DATE = 'Data'
 FIELD_MOV_TYPE = 'Movimentação'
 FIELD_MOV_STATUS = 'Status' # Optional field to indicate 'CREDITADO_NAO_PAGO'
 FIELD_MOV_DIRECTION = 'Entrada/Saída'
+FIELD_MOV_QUANTITY = 'Quantidade'
 FIELD_MOV_UNIT_PRICE = 'Preço unitário'
 FIELD_MOV_TOTAL_COST = 'Valor da Operação'
 
@@ -44,11 +91,177 @@ MOV_TYPE_JCP = 'Juros sobre Capital Próprio'
 MOV_TYPE_FII_INCOME = 'Rendimento' # Assuming this is the type for FII income
 STATUS_NOT_PAID = 'CREDITADO_NAO_PAGO' # Status indicating item goes to Bens e Direitos 99
 NEG_TYPE_SELL = 'Venda' # Or 'V' depending on your data
+CALCULATION_EPSILON = 0.0001 # Same tolerance as the generated calculation helper
+
+# --- Constants for the Python Reference Engine (mirror calculation_helper.ts) ---
+EVENT_FRACTION = 'Fração em Ativos'
+EVENT_REVERSE_SPLIT = 'Grupamento'
+BONUS_EVENT_TYPES = ('Bonificação em Ativos', 'Bonificação em ações')
+SPLIT_EVENT_TYPES = ('Desdobramento', 'Desdobro')
+AVERAGE_PRICE_EVENT_TYPES = (
+    'Atualização',
+    'Direito de Subscrição',
+    'Direito de Subscrição - Exercido',
+    'Direitos de Subscrição - Exercido',
+    'Cessão de Direitos - Solicitada',
+)
+IRRELEVANT_MOVEMENT_TYPES = frozenset([
+    'Dividendo', 'Juros sobre Capital Próprio', 'Rendimento',
+    'Cessão de Direitos - Não Exercido', 'Cessão de Direitos',
+    'Direito de Subscrição', 'Direito de Subscrição - Não Exercido',
+    'Direitos de Subscrição', 'Direitos de Subscrição - Não Exercido',
+    'Direito de Subscrição - Exercido', 'Direitos de Subscrição - Exercido', 'Cessão de Direitos - Solicitada',
+    'Leilão de Fração', 'Leilão', 'Empréstimo',
+])
+QUANTITY_COST_EVENT_TYPES = frozenset([
+    *BONUS_EVENT_TYPES, *SPLIT_EVENT_TYPES, EVENT_REVERSE_SPLIT, 'Atualização',
+    'Direito de Subscrição - Exercido', 'Direitos de Subscrição - Exercido', 'Cessão de Direitos - Solicitada',
+    EVENT_FRACTION,
+])
+SAME_DAY_EVENT_PRIORITY = {
+    'Venda': 1,
+    'Fração em Ativos': 2,
+    'Cessão de Direitos - Solicitada': 2,
+    'Direito de Subscrição - Exercido': 2,
+    'Direitos de Subscrição - Exercido': 2,
+    'Compra': 3,
+    'Bonificação em Ativos': 4,
+    'Bonificação em ações': 4,
+    'Atualização': 4,
+    'Desdobramento': 5,
+    'Desdobro': 5,
+    'Grupamento': 5,
+}
+# The template's duplicateCheckEventTypes also lists the subscription-right types, but those are
+# dropped as irrelevantMovements before the check, so only Atualização ever reaches it
+DUPLICATE_CHECK_EVENT_TYPES = frozenset([
+    'Atualização',
+])
+DUPLICATE_TIME_WINDOW_DAYS = 20
+STATIC_EVENT_WINDOW_DAYS = 20 # Same window as searchWithinDateWindow in StaticEventInfoAdapter.ts
+
+# Mirror of AssetCategory (src/core/domain/Transaction.ts) and of the rates of AssetProcessor.calculateMonthlyResults
+ASSET_CATEGORY_STOCK = 'STOCK'
+ASSET_CATEGORY_ETF = 'ETF'
+ASSET_CATEGORY_FII = 'FII'
+ASSET_CATEGORY_BDR = 'BDR'
+ASSET_CATEGORY_OPTION = 'OPTION'
+ASSET_CATEGORY_DEBENTURE = 'DEBENTURE'
+ASSET_CATEGORY_OTHER = 'OTHER'
+STOCK_SALES_EXEMPTION_LIMIT = 20000 # Monthly stock sales up to R$ 20.000,00 have exempt gains
+CAPITAL_GAINS_TAX_RATES = {ASSET_CATEGORY_FII: 0.20}
+DEFAULT_CAPITAL_GAINS_TAX_RATE = 0.15
+LOSS_CARRYING_CATEGORIES = (ASSET_CATEGORY_STOCK, ASSET_CATEGORY_FII) # Only these carry a loss forward to later months and years
+
+# Mirror of src/infrastructure/data/staticFactorEventInfoData.ts (dates already shifted by normalizeDateDay)
+STATIC_EVENT_FACTORS = [
+    ('WEGE3', 'Desdobro', date(2021, 4, 29), 2),
+    ('VINO11', 'Desdobro', date(2023, 8, 8), 5),
+    ('GGRC11', 'Desdobro', date(2024, 3, 7), 10),
+    ('BCFF11', 'Desdobro', date(2023, 11, 30), 8),
+    ('BBAS3', 'Desdobro', date(2024, 4, 17), 2),
+]
+
+# Mirror of src/infrastructure/data/staticAveragePriceEventInfoData.ts
+STATIC_EVENT_AVERAGE_PRICES = [
+    ('BTHF11', 'Atualização', date(2024, 12, 13), 10.75165746),
+    ('BCFF11', 'Atualização', date(2024, 12, 13), 0),
+    ('ISAE4', 'Atualização', date(2024, 11, 19), 0),
+    ('TRBL11', 'Atualização', date(2023, 7, 5), 0),
+    ('ITSA2', 'Direito de Subscrição', date(2023, 8, 21), 6.70),
+    ('ITSA2', 'Direito de Subscrição', date(2025, 2, 19), 6.70),
+    ('HFOF12', 'Cessão de Direitos - Solicitada', date(2025, 1, 21), 70.13),
+    ('GGRC12', 'Cessão de Direitos - Solicitada', date(2024, 10, 3), 11.31),
+    ('MXRF12', 'Cessão de Direitos - Solicitada', date(2024, 6, 27), 10.07),
+    ('HSML12', 'Cessão de Direitos - Solicitada', date(2024, 6, 4), 97.76),
+    ('GGRC12', 'Cessão de Direitos - Solicitada', date(2024, 4, 25), 11.25),
+    ('HSML12', 'Cessão de Direitos - Solicitada', date(2024, 1, 18), 94.34),
+    ('MXRF12', 'Cessão de Direitos - Solicitada', date(2023, 12, 12), 10.29),
+    ('VISC12', 'Cessão de Direitos - Solicitada', date(2023, 11, 29), 117.47),
+    ('TRBL12', 'Cessão de Direitos - Solicitada', date(2023, 11, 24), 97.84),
+    ('GGRC12', 'Cessão de Direitos - Solicitada', date(2023, 9, 1), 115.50),
+    ('HFOF12', 'Cessão de Direitos - Solicitada', date(2023, 8, 31), 83.91),
+    ('MXRF12', 'Cessão de Direitos - Solicitada', date(2023, 7, 11), 10.36),
+    ('HFOF12', 'Cessão de Direitos - Solicitada', date(2023, 5, 8), 75.33),
+    ('GGRC12', 'Cessão de Direitos - Solicitada', date(2022, 12, 1), 114.50),
+    ('HFOF12', 'Cessão de Direitos - Solicitada', date(2022, 11, 1), 86.97),
+    ('VISC12', 'Cessão de Direitos - Solicitada', date(2022, 10, 19), 115.76),
+    ('VINO12', 'Cessão de Direitos - Solicitada', date(2022, 1, 14), 55.14),
+    ('GGRC12', 'Cessão de Direitos - Solicitada', date(2021, 10, 28), 110.00),
+    ('BCFF12', 'Cessão de Direitos - Solicitada', date(2021, 3, 31), 84.39),
+]
+
+# Patterns reproducing JavaScript's parseInt/parseFloat prefix parsing and getAssetCode
+JS_INT_PATTERN = re.compile(r"\s*[+-]?\d+")
+JS_FLOAT_PATTERN = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+ASSET_CODE_PATTERN = re.compile(r"[A-Z]{4}\d+")
+
+
+# --- Constants for Ticker Normalization ---
+TICKER_BASE_PATTERN = re.compile(r"[A-Z]+")
+NORMALIZE_TICKER_CACHE_SIZE = 4096 # Distinct raw tickers kept in the LRU cache
+
+
+# --- Constants for Streaming Ingestion ---
+STREAM_READ_CHUNK_SIZE = 1 << 16 # Characters read per chunk by iter_json_records
+XLSX_SUFFIX = '.xlsx' # B3 Portal exports, read row by row by iter_xlsx_records
+XLSX_DATE_FORMAT = '%d/%m/%Y' # Date cells are written back as the B3 text dates (DD/MM/YYYY)
+EXPORT_DATE_ORDER = -1 # Merge order of exports with a single date: newest first, like the B3 Portal
+SPILL_BUFFER_RECORDS = 1 << 14 # Streamed records buffered by fragment_data before they are appended to the ticker spill files
+SPILL_DIR_PREFIX = 'asset-fragments-'
+
+
+# --- Constants for Compact Records ---
+# Fields whose texts are nearly all distinct, so compact records do not try to share them
+COMPACT_DISTINCT_FIELDS = frozenset((
+    FIELD_NEG_QUANTITY, FIELD_NEG_UNIT_PRICE, FIELD_NEG_TOTAL_COST, FIELD_MOV_QUANTITY, FIELD_MOV_UNIT_PRICE, FIELD_MOV_TOTAL_COST
+))
+
+
+# --- Constants for the Export Cache ---
+EXPORT_CACHE_SCHEMA_VERSION = 1 # Bump whenever build_export_table's layout changes
+EXPORT_CACHE_NUMERIC_COLUMNS = ('date_ordinal', 'quantity', 'unit_price', 'value')
 
 
 # --- Constants for Template ---
 TEMPLATE_NEW_LINE = '\\n'
 
+# --- Constants for the Consolidated Test Layout ---
+TEST_LAYOUTS = ('per-ticker', 'consolidated') # One .test.ts per ticker, or a few describe.each suites
+ASSET_MANIFEST_FILE = 'asset_manifest.json' # Written in the test dir: ticker -> history files and record counts
+ASSET_SUITE_FILE_GLOB = 'asset_suite_*.test.ts'
+ASSET_SHARDS_FILE = 'asset_shards.json' # Per suite file: its path, the command that runs it alone, weight and tickers
+DEFAULT_SUITES = 4
+SUITE_TICKER_BASE_WEIGHT = 1 # Fixed setup cost of a ticker, in records, when balancing the suites
+
+# --- Constants for the History File Formats ---
+HISTORY_FORMATS = ('pretty', 'compact', 'ndjson', 'columnar')
+DEFAULT_HISTORY_FORMAT = 'pretty' # Indented JSON arrays, as written by json.dump(..., indent=2)
+HISTORY_FILE_EXTENSIONS = {'pretty': '.json', 'compact': '.json', 'ndjson': '.ndjson', 'columnar': '.columns.json'}
+HISTORY_FILE_KINDS = ('transactions', 'movements', 'timeline') # timeline is only written with --timeline
+COLUMNAR_FORMAT_VERSION = 1
+COLUMNAR_DICTIONARY_FIELDS = frozenset(( # Low-cardinality string fields stored once per file in the columnar format
+    FIELD_NEG_TICKER, FIELD_NEG_TYPE, FIELD_NEG_MARKET_TYPE, FIELD_NEG_BROKER_NAME,
+    FIELD_MOV_TICKER, FIELD_MOV_TYPE, FIELD_MOV_DIRECTION, FIELD_MOV_STATUS,
+    "source", "type", "direction", # Timeline rows
+))
+
+# --- Constants for Expected-Result Snapshots ---
+SNAPSHOT_FILE_SUFFIX = '_expected.json' # {TICKER}_expected.json, written in the history dir with --snapshots
+SNAPSHOT_VERSION = 5 # 2: per-year sales and income under "anos", for --years; 3: FIFO sale results; 4: FIFO run per year; 5: monthly results
+
+# --- Constants for Incremental Generation ---
+MANIFEST_SUFFIX = '.manifest.json' # Written next to the history dir, e.g. history.manifest.json
+MANIFEST_VERSION = 1
+
+# --- Constants for Parallel Generation ---
+JOBS_IN_FLIGHT_PER_WORKER = 2 # Tickers submitted ahead per --jobs worker, so a worker never waits for its next ticker
+
+# --- Constants for Pipeline Metrics ---
+METRICS_VERSION = 1
+TICKER_STAT_FIELDS = ('history_seconds', 'history_bytes', 'test_seconds', 'test_bytes')
+PROFILE_TOP_FUNCTIONS = 25 # Entries printed from the --profile stats, by cumulative time
+
 # --- Helper Functions ---
 
 def normalize_ticker(ticker_raw: str) -> str:
@@ -56,28 +269,83 @@ def normalize_ticker(ticker_raw: str) -> str:
     Normalizes a raw ticker string to its base alphabetic part.
     Examples: 'ITSA4' -> 'ITSA', 'PETR4F' -> 'PETR', 'BBDC3' -> 'BBDC'
     Handles cases like 'XYZW11 - FII XPTO' by taking the part before ' - '.
+    Results are memoized, since the same few hundred strings repeat across every record.
     """
     if not isinstance(ticker_raw, str):
         print(f"Warning: Invalid ticker input type: {type(ticker_raw)}, value: {ticker_raw}. Returning 'UNKNOWN'.")
         return 'UNKNOWN'
-    
+
+    return _normalize_ticker_cached(ticker_raw)
+
+@lru_cache(maxsize=NORMALIZE_TICKER_CACHE_SIZE)
+def _normalize_ticker_cached(ticker_raw: str) -> str:
     # Take the part before ' - ' if it exists
-    ticker_part = ticker_raw.split(' - ')[0]
+    ticker_part = ticker_raw.split(' - ', 1)[0].upper()
     
     # Remove trailing 'F' and any digits
-    match = re.match(r"([A-Z]+)", ticker_part.upper())
+    match = TICKER_BASE_PATTERN.match(ticker_part)
     if match:
-        return match.group(1)
+        return match.group(0)
     else:
         print(f"Warning: Could not normalize ticker: {ticker_raw}. Returning as is (uppercase).")
-        return ticker_part.upper() # Fallback
+        return ticker_part # Fallback
+
+def normalize_ticker_column(values) -> list:
+    """
+    Normalizes a whole column of raw tickers (e.g. every 'Produto' of an export) at once.
+    Each distinct value is normalized a single time and then looked up.
+    """
+    lookup = {}
+    normalized = []
+    append = normalized.append
+    for value in values:
+        try:
+            append(lookup[value])
+        except KeyError:
+            lookup[value] = normalize_ticker(value)
+            append(lookup[value])
+        except TypeError:
+            append(normalize_ticker(value)) # Unhashable (invalid) input
+    return normalized
+
+def load_json_data(file_path: str, stream: bool = False, cache_dir: str = None, compact: bool = False):
+    """
+    Loads data from a JSON file, or from the first sheet of a B3 Portal .xlsx export (see iter_xlsx_records).
+    With stream=True, returns a generator yielding the records of the top-level
+    array one at a time (see iter_json_records) instead of a fully loaded list.
+    With cache_dir, records are rebuilt from the parsed columnar cache of the file
+    (see load_cached_export_table) instead of decoding the JSON again, as compact
+    NegotiationRecord/MovementRecord rows whose parsed slots come from the cache's typed
+    columns, so fragmentation and the calculations never parse B3's strings again.
+    With compact=True, each record is converted to a NegotiationRecord/MovementRecord
+    as it is read, so the dicts are never all held at once.
+    """
+    if compact and (not cache_dir or np is None):
+        records = compact_records(load_json_data(file_path, stream=True, cache_dir=cache_dir))
+        return records if stream else list(records)
 
-def load_json_data(file_path: str) -> list:
-    """Loads data from a JSON file."""
     # Ensure the file path exists before opening
     if not Path(file_path).is_file():
         print(f"Error: Input file not found at {file_path}")
         exit(1)
+
+    if is_xlsx_export(file_path):
+        if openpyxl is None:
+            print(f"Error: Reading {file_path} requires openpyxl (pip install openpyxl), or convert it to JSON first.")
+            exit(1)
+        if not cache_dir or np is None:
+            records = iter_xlsx_records(file_path)
+            return records if stream else list(records)
+
+    if cache_dir:
+        if np is None:
+            print("Warning: NumPy is not installed, ignoring the export cache.")
+        else:
+            records = iter_table_records(load_cached_export_table(file_path, cache_dir, stream), compact=True)
+            return records if stream else list(records)
+
+    if stream:
+        return iter_json_records(file_path)
         
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -99,61 +367,908 @@ def load_json_data(file_path: str) -> list:
         print(f"Error loading {file_path}: {e}")
         exit(1)
 
-def fragment_data(negociacao_data: list, movimentacao_data: list) -> dict:
-    """Fragments data by normalized ticker."""
-    fragmented = defaultdict(lambda: {"transactions": [], "movements": []})
-
-    # Process Negociação
-    for i, record in enumerate(negociacao_data):
-        raw_ticker = record.get(FIELD_NEG_TICKER)
-        if raw_ticker:
-            normalized = normalize_ticker(raw_ticker)
-            if normalized != 'UNKNOWN':
-                 # Add original index for potential debugging
-                 record[FIELD_INDEX] = i
-                 fragmented[normalized]["transactions"].append(record)
-        else:
-            print(f"Warning: Negotiation record at index {i} missing '{FIELD_NEG_TICKER}': {record}")
+def iter_json_records(file_path: str, chunk_size: int = STREAM_READ_CHUNK_SIZE):
+    """
+    Incrementally parses a JSON file whose top-level value is an array, yielding
+    one record at a time. Only the current read chunk and the record being
+    decoded are held in memory, so peak usage does not grow with the file size.
+    """
+    decoder = json.JSONDecoder()
 
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            buffer = ''
+            pos = 0
+            eof = False
+
+            def fill() -> bool:
+                # Drop what was already consumed and append the next chunk
+                nonlocal buffer, pos, eof
+                if eof:
+                    return False
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    eof = True
+                    return False
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                return True
+
+            def next_token() -> str:
+                # Skip whitespace, refilling as needed; '' means end of file
+                nonlocal pos
+                while True:
+                    while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                        pos += 1
+                    if pos < len(buffer):
+                        return buffer[pos]
+                    if not fill():
+                        return ''
+
+            first = next_token()
+            if first != '[':
+                # Not an array: decode whatever is there to reproduce load_json_data's checks
+                while fill():
+                    pass
+                data = json.loads(buffer[pos:]) if buffer[pos:].strip() else None
+                if data is None or data == '':
+                    print(f"Warning: File {file_path} is empty or contains non-list data. Treating as empty list.")
+                    return
+                raise ValueError("JSON content must be a list of records.")
+            pos += 1
+
+            if next_token() == ']':
+                return
+
+            while True:
+                if next_token() == '':
+                    raise json.JSONDecodeError("Unterminated array", buffer, pos)
+
+                # Decode one element, reading more input until it is complete.
+                # A value ending exactly at the buffer end may be truncated (e.g. a number).
+                while True:
+                    try:
+                        record, end = decoder.raw_decode(buffer, pos)
+                        if end < len(buffer) or eof:
+                            break
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                    if not fill():
+                        record, end = decoder.raw_decode(buffer, pos)
+                        break
+                pos = end
+                yield record
+
+                separator = next_token()
+                if separator == ',':
+                    pos += 1
+                elif separator == ']':
+                    return
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode JSON from {file_path}")
+        exit(1)
+    except ValueError as e:
+        print(f"Error loading {file_path}: {e}")
+        exit(1)
+
+def is_xlsx_export(file_path: str) -> bool:
+    return Path(file_path).suffix.lower() == XLSX_SUFFIX
 
-    # Process Movimentação
-    for i, record in enumerate(movimentacao_data):
-        raw_ticker = record.get(FIELD_MOV_TICKER)
-        if raw_ticker:
-            normalized = normalize_ticker(raw_ticker)
-            if normalized != 'UNKNOWN':
-                 record[FIELD_INDEX] = i
-                 fragmented[normalized]["movements"].append(record)
+def iter_xlsx_records(file_path: str):
+    """
+    Yields the rows of the first sheet of an .xlsx export as records, like SheetJS'
+    sheet_to_json in B3FileParser: the first row holds the field names, empty cells are
+    left out and empty rows skipped. The workbook is opened read-only, so rows are parsed
+    as they are consumed instead of loading the whole sheet. Cell values are converted to
+    the text the JSON exports carry (see xlsx_cell_text), so both inputs fragment alike.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        keys = [xlsx_cell_text(value) if value is not None else None for value in header]
+
+        for row in rows:
+            record = {
+                key: xlsx_cell_text(value)
+                for key, value in zip(keys, row)
+                if key is not None and value is not None and value != ''
+            }
+            if record:
+                yield record
+    finally:
+        workbook.close()
+
+def xlsx_cell_text(value) -> str:
+    """Text of an .xlsx cell as in the JSON exports: '70' for 70.0, '20.5', dates as DD/MM/YYYY."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, date): # Also datetime cells
+        return value.strftime(XLSX_DATE_FORMAT)
+    return str(value)
+
+def parse_declaration_years(text: str) -> tuple:
+    """
+    Parses --years: a year, a range ("2019-2025") or a comma-separated list of both
+    ("2019-2021,2024"). Returns the sorted distinct years.
+    """
+    years = set()
+    for part in str(text).split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            first_year = int(first)
+            last_year = int(last) if last else first_year
+        except ValueError:
+            print(f"Error: Invalid declaration year or range '{part.strip()}' in --years {text}.")
+            exit(1)
+        if last_year < first_year:
+            print(f"Error: Declaration year range '{part.strip()}' ends before it starts.")
+            exit(1)
+        years.update(range(first_year, last_year + 1))
+    return tuple(sorted(years))
+
+def resolve_input_paths(patterns, base_dir: Path) -> list:
+    """
+    Expands the --negociacao/--movimentacao arguments (paths or glob patterns, relative to
+    base_dir) into a sorted list of distinct files, so the merge order does not depend on
+    the order they were given in.
+    """
+    paths = set()
+    for pattern in patterns:
+        full_pattern = str(base_dir / pattern)
+        if glob.has_magic(full_pattern):
+            matches = glob.glob(full_pattern)
+            if not matches:
+                print(f"Error: No input file matches {full_pattern}")
+                exit(1)
+            paths.update(Path(match) for match in matches)
         else:
-             print(f"Warning: Movement record at index {i} missing '{FIELD_MOV_TICKER}': {record}")
+            paths.add(Path(full_pattern))
+    return sorted(paths)
+
+def load_export_files(file_paths: list, date_field: str, stream: bool = False, cache_dir: str = None,
+                      compact: bool = False, merge_stats: dict = None):
+    """
+    load_json_data for one export, or for several overlapping ones: their records are
+    k-way merged by date and the duplicates removed (see merge_export_records).
+    """
+    if len(file_paths) == 1:
+        return load_json_data(file_paths[0], stream=stream, cache_dir=cache_dir, compact=compact)
+
+    sources = {path: load_json_data(path, stream=True, cache_dir=cache_dir, compact=compact) for path in file_paths}
+    records = merge_export_records(sources, date_field, merge_stats)
+    return records if stream else list(records)
+
+def merge_export_records(sources: dict, date_field: str, stats: dict = None):
+    """
+    Streams the k-way merge by date_field of several exports (path -> iterable of records),
+    each already in date order like the B3 Portal writes them (newest first) or oldest first.
+    A row also found in an earlier export of the merge is dropped: rows are matched by
+    export_row_key, and only for the day being merged, so memory stays bounded. A row
+    repeated within one export (e.g. two identical fills) is kept as many times as the
+    export that has it most often. Same-day rows keep the order of the sorted paths, so the
+    result is the same however the history was split across files.
+    stats, when given, receives the "records" yielded and the "duplicates" dropped.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(records=0, duplicates=0)
+
+    dated_sources, directions = [], set()
+    for source_index, (path, records) in enumerate(sources.items()):
+        direction, dated = _export_date_direction(_dated_export_records(records, date_field))
+        if direction:
+            directions.add(direction)
+        dated_sources.append(_check_export_order(dated, path, source_index))
+    if len(directions) > 1:
+        print(f"Error: Cannot merge exports sorted oldest first with exports sorted newest first: {', '.join(map(str, sources))}")
+        exit(1)
+    direction = directions.pop() if directions else EXPORT_DATE_ORDER
+
+    current_ordinal, emitted, occurrences = None, {}, {}
+    for ordinal, source_index, record in heapq.merge(*dated_sources, key=lambda item: item[0], reverse=direction < 0):
+        if ordinal != current_ordinal:
+            current_ordinal, emitted, occurrences = ordinal, {}, {}
+        key = export_row_key(record)
+        occurrence = occurrences[source_index, key] = occurrences.get((source_index, key), 0) + 1
+        if occurrence <= emitted.get(key, 0):
+            stats["duplicates"] += 1
+            continue
+        emitted[key] = occurrence
+        stats["records"] += 1
+        yield record
+
+def export_row_key(record) -> bytes:
+    """Content hash of a record with sorted keys and trimmed string values, matching the same row in two exports."""
+    normalized = {key: value.strip() if isinstance(value, str) else value for key, value in record.items()}
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).digest()
+
+def _dated_export_records(records, date_field: str):
+    # (date ordinal, record); rows with an invalid date take the date of the row before them
+    # (or after them, at the start of the export) so they stay where the export put them
+    previous, pending = None, []
+    for record in records:
+        event_date = parse_br_date(record.get(date_field))
+        if event_date is None and previous is None:
+            pending.append(record)
+            continue
+        if event_date is not None:
+            previous = event_date.toordinal()
+        for pending_record in pending:
+            yield previous, pending_record
+        pending = []
+        yield previous, record
+    for pending_record in pending:
+        yield 0, pending_record
+
+def _export_date_direction(dated) -> tuple:
+    # Reads an export up to its second distinct date: 1 when oldest first, -1 when newest first, 0 when unknown
+    head, direction = [], 0
+    for item in dated:
+        head.append(item)
+        if item[0] != head[0][0]:
+            direction = 1 if item[0] > head[0][0] else -1
+            break
+    return direction, chain(head, dated)
+
+def _check_export_order(dated, path: Path, source_index: int):
+    direction, previous = 0, None
+    for row, (ordinal, record) in enumerate(dated):
+        if previous is not None and ordinal != previous:
+            step = 1 if ordinal > previous else -1
+            if direction and step != direction:
+                print(f"Error: {path} is not sorted by date (row {row}); only exports in date order can be merged.")
+                exit(1)
+            direction = step
+        previous = ordinal
+        yield ordinal, source_index, record
+
+# Stands in a compact row's values for a text its parsed slot rebuilds exactly (see CompactRecord)
+PARSED_TEXT = object()
+
+def format_cents(cents: int) -> str:
+    """The B3 export text of an amount of centavos (140007 -> '1400.07')."""
+    sign = '-' if cents < 0 else ''
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def format_quantity(quantity: float) -> str:
+    """The B3 export text of a movimentação quantity (100.0 -> '100', 0.5 -> '0.5')."""
+    return str(int(quantity)) if float(quantity).is_integer() else repr(quantity)
+
+class CompactRecord(Mapping):
+    """
+    Read-only export row holding its raw values in a tuple, with the key -> position
+    dict shared by every row of the same columns. Reads like the source dict
+    (get, [], keys, {**record}), so the history files are written unchanged.
+    A text of PARSED_FIELDS that its parsed slot formats back exactly (e.g. '1400.00'
+    from 140000 centavos) is not kept in the tuple but rebuilt when read.
+    """
+    __slots__ = ('_positions', '_values')
+    PARSED_FIELDS = {} # Field -> (slot, formatter)
+
+    def __getitem__(self, key):
+        value = self._values[self._positions[key]]
+        return self._parsed_text(key) if value is PARSED_TEXT else value
+
+    def get(self, key, default=None):
+        position = self._positions.get(key)
+        if position is None:
+            return default
+        value = self._values[position]
+        return self._parsed_text(key) if value is PARSED_TEXT else value
+
+    def _parsed_text(self, key) -> str:
+        slot, formatter = self.PARSED_FIELDS[key]
+        return formatter(getattr(self, slot))
+
+    def is_exact(self, key) -> bool:
+        """Whether key's parsed slot holds its text's exact value (the text was rebuilt from it)."""
+        position = self._positions.get(key)
+        return position is not None and self._values[position] is PARSED_TEXT
+
+    def keys(self):
+        return self._positions.keys()
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+class NegotiationRecord(CompactRecord):
+    """A negociação row, parsed once: date ordinal (0 if invalid), integer quantity and prices in centavos."""
+    __slots__ = ('date_ordinal', 'quantity', 'unit_price_cents', 'value_cents')
+    PARSED_FIELDS = {
+        FIELD_NEG_QUANTITY: ('quantity', str),
+        FIELD_NEG_UNIT_PRICE: ('unit_price_cents', format_cents),
+        FIELD_NEG_TOTAL_COST: ('value_cents', format_cents),
+    }
+
+class MovementRecord(CompactRecord):
+    """
+    A movimentação row, parsed once like NegotiationRecord. The quantity stays a float,
+    since fractions of shares (e.g. 'Fração em Ativos') are moved too.
+    """
+    __slots__ = ('date_ordinal', 'quantity', 'unit_price_cents', 'value_cents')
+    PARSED_FIELDS = {
+        FIELD_MOV_QUANTITY: ('quantity', format_quantity),
+        FIELD_MOV_UNIT_PRICE: ('unit_price_cents', format_cents),
+        FIELD_MOV_TOTAL_COST: ('value_cents', format_cents),
+    }
+
+def compact_record(record: dict, shared_values: dict = None) -> CompactRecord:
+    """
+    Converts one export record into a NegotiationRecord or MovementRecord.
+    Repeating texts are replaced by their first occurrence in shared_values, and the
+    texts the parsed slots rebuild exactly are left out (see CompactRecord).
+    """
+    if shared_values is None:
+        shared_values = {}
+    positions, shared = _record_layout(tuple(record))
+    if FIELD_NEG_TICKER in positions:
+        row = NegotiationRecord()
+        row.quantity = parse_int_safe(record.get(FIELD_NEG_QUANTITY))
+        row.unit_price_cents = parse_cents(record.get(FIELD_NEG_UNIT_PRICE))
+        row.value_cents = parse_cents(record.get(FIELD_NEG_TOTAL_COST))
+        date_value = record.get(FIELD_NEG_DATE)
+    else:
+        row = MovementRecord()
+        row.quantity = parse_float_safe(record.get(FIELD_MOV_QUANTITY))
+        row.unit_price_cents = parse_cents(record.get(FIELD_MOV_UNIT_PRICE))
+        row.value_cents = parse_cents(record.get(FIELD_MOV_TOTAL_COST))
+        date_value = record.get(FIELD_MOV_DATE)
+
+    row._positions = positions
+    row._values = tuple(_compact_values(row, record, shared, shared_values))
+    row.date_ordinal = _date_ordinal_cached(date_value) if isinstance(date_value, str) else 0
+    return row
+
+def _compact_values(row: CompactRecord, record: dict, shared: tuple, shared_values: dict):
+    parsed_fields = row.PARSED_FIELDS
+    for (key, value), share in zip(record.items(), shared):
+        if isinstance(value, str):
+            if share:
+                value = shared_values.setdefault(value, value)
+            elif key in parsed_fields:
+                slot, formatter = parsed_fields[key]
+                if formatter(getattr(row, slot)) == value:
+                    value = PARSED_TEXT
+        yield value
+
+def compact_records(records):
+    """Converts an iterable of export records into compact rows, one at a time."""
+    shared_values = {}
+    for record in records:
+        yield compact_record(record, shared_values)
+
+@lru_cache(maxsize=None)
+def _record_layout(keys: tuple) -> tuple:
+    # One shared key -> position dict per distinct column layout, plus which positions hold
+    # repeating texts (dates, types, brokers, tickers...) that every row can reference
+    positions = {key: position for position, key in enumerate(keys)}
+    shared = tuple(key not in COMPACT_DISTINCT_FIELDS for key in keys)
+    return positions, shared
+
+@lru_cache(maxsize=None)
+def _date_ordinal_cached(date_string: str) -> int:
+    # A few thousand distinct dates repeat across all rows
+    date_object = parse_br_date(date_string)
+    return date_object.toordinal() if date_object else 0
+
+@lru_cache(maxsize=None)
+def date_from_ordinal(ordinal: int) -> date:
+    """Inverse of NegotiationRecord.date_ordinal (0 -> None)."""
+    return date.fromordinal(ordinal) if ordinal > 0 else None
+
+def parse_cents(value) -> int:
+    """parse_float_safe as a fixed-point integer amount of centavos."""
+    return round(parse_float_safe(value) * 100)
+
+class RecordSpill:
+    """
+    The records of one streamed export, written by fragment_data to one NDJSON file per
+    ticker ([export index, record] lines) in a temporary directory, so the export is never
+    held in memory. Records are buffered up to SPILL_BUFFER_RECORDS before being appended.
+    The directory is removed once the last FragmentedData using it is gone.
+    """
 
-    return fragmented
+    def __init__(self, parent_dir: str = None):
+        self.path = Path(tempfile.mkdtemp(prefix=SPILL_DIR_PREFIX, dir=parent_dir))
+        self.compact = False # Whether compact rows were spilled, so they are read back as compact rows
+        self._buffers = {}
+        self._buffered = 0
+        weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def append(self, ticker: str, index: int, record):
+        if isinstance(record, CompactRecord):
+            self.compact = True
+            record = dict(record)
+        self._buffers.setdefault(ticker, []).append(json.dumps([index, record], ensure_ascii=False))
+        self._buffered += 1
+        if self._buffered >= SPILL_BUFFER_RECORDS:
+            self.flush()
+
+    def flush(self):
+        for ticker, lines in self._buffers.items():
+            with open(self.path / f"{ticker}.ndjson", 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        self._buffers.clear()
+        self._buffered = 0
+
+    def read(self, ticker: str, indexes):
+        """Yields the (export index, record) pairs of one ticker whose index is in indexes (a subsequence of its file)."""
+        wanted = iter(indexes)
+        next_index = next(wanted, None)
+        if next_index is None:
+            return
+        shared_values = {}
+        with open(self.path / f"{ticker}.ndjson", 'r', encoding='utf-8') as f:
+            for line in f:
+                i, record = json.loads(line)
+                if i == next_index:
+                    yield i, compact_record(record, shared_values) if self.compact else record
+                    next_index = next(wanted, None)
+                    if next_index is None:
+                        return
+
+class FragmentedData(Mapping):
+    """
+    Result of fragment_data: a read-only mapping of normalized ticker ->
+    {"transactions": [...], "movements": [...]}.
+    Only compact array('I') offsets into the source records are kept per ticker; the
+    source is the caller's list, or a RecordSpill for streamed inputs. Each ticker's
+    records are copied (with FIELD_INDEX added) only when it is accessed, so the caller's
+    records are never mutated.
+    """
+
+    def __init__(self, negociacao_records, movimentacao_records, indexes: dict, activity: dict = None):
+        self._sources = {"transactions": negociacao_records, "movements": movimentacao_records}
+        self._indexes = indexes
+        self.activity = activity # ticker -> TickerActivity, with fragment_data(..., activity=True)
+
+    def __getitem__(self, ticker: str) -> dict:
+        return {kind: list(self.iter_records(ticker, kind)) for kind in self._sources}
+
+    def _indexed_records(self, ticker: str, kind: str):
+        records = self._sources[kind]
+        offsets = self._indexes[ticker][kind]
+        if isinstance(records, RecordSpill):
+            return records.read(ticker, offsets)
+        return ((i, records[i]) for i in offsets)
+
+    def iter_records(self, ticker: str, kind: str):
+        """Yields copies of one ticker's "transactions" or "movements" records, one at a time."""
+        for i, record in self._indexed_records(ticker, kind):
+            yield {**record, FIELD_INDEX: i}
+
+    def source_records(self, ticker: str, kind: str) -> list:
+        """One ticker's source records themselves (no copies, no FIELD_INDEX), for read-only calculations."""
+        return [record for _, record in self._indexed_records(ticker, kind)]
+
+    def record_indexes(self, ticker: str, kind: str) -> array:
+        """Positions in the whole export of one ticker's records, in the order they are yielded."""
+        return self._indexes[ticker][kind]
+
+    def __iter__(self):
+        return iter(self._indexes)
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def without_records(self, kind: str, skipped) -> 'FragmentedData':
+        """The same data without the "transactions" or "movements" at the given export indexes."""
+        skipped = frozenset(skipped)
+        indexes = {
+            ticker: {**offsets, kind: array('I', (i for i in offsets[kind] if i not in skipped))}
+            if skipped.intersection(offsets[kind]) else offsets
+            for ticker, offsets in self._indexes.items()
+        }
+        return FragmentedData(self._sources["transactions"], self._sources["movements"], indexes, self.activity)
+
+    def restricted_to(self, tickers) -> 'FragmentedData':
+        """The same data limited to the given tickers, sharing the source records and offsets."""
+        indexes = {ticker: self._indexes[ticker] for ticker in tickers}
+        activity = {ticker: self.activity[ticker] for ticker in tickers if ticker in self.activity} if self.activity is not None else None
+        return FragmentedData(self._sources["transactions"], self._sources["movements"], indexes, activity)
+
+    def record_counts(self, ticker: str = None) -> tuple:
+        """(transactions, movements) of one ticker, or of all tickers, without copying any record."""
+        offsets = [self._indexes[ticker]] if ticker is not None else self._indexes.values()
+        return (
+            sum(len(o["transactions"]) for o in offsets),
+            sum(len(o["movements"]) for o in offsets),
+        )
+
+def ticker_records(fragmented_data: dict, ticker: str, kind: str) -> list:
+    """One ticker's "transactions" or "movements", as the source records when fragment_data produced them."""
+    if isinstance(fragmented_data, FragmentedData):
+        return fragmented_data.source_records(ticker, kind)
+    return fragmented_data[ticker][kind]
+
+def find_duplicate_events(movements, indexes=None) -> list:
+    """
+    Finds the movimentação events the calculation helper skips as duplicates: an event of
+    DUPLICATE_CHECK_EVENT_TYPES with the same asset code, type and quantity as one up to
+    DUPLICATE_TIME_WINDOW_DAYS days before it (the window slides from every occurrence,
+    skipped ones included, as in calcularResumoAnualComEventos).
+    Events are grouped by that key in one pass and only each group's dates are sorted.
+    indexes, when given, are the movements' positions in the whole export (by default
+    their positions in movements). Returns one report entry per duplicate, ordered by index.
+    """
+    events_by_key = {}
+    for i, movement in zip(indexes if indexes is not None else count(), movements):
+        event_type = movement.get(FIELD_MOV_TYPE)
+        if event_type not in DUPLICATE_CHECK_EVENT_TYPES:
+            continue
+
+        asset_code = get_asset_code(movement.get(FIELD_MOV_TICKER))
+        event_date, quantity = movement_fields(movement)
+        if not asset_code or not event_date or quantity <= 0:
+            continue
+        events_by_key.setdefault((asset_code, event_type, quantity), []).append((event_date, i))
+
+    duplicates = []
+    for (asset_code, event_type, quantity), events in events_by_key.items():
+        # Same-day events keep their export order, like the stable sort of the template
+        events.sort()
+        for (last_date, last_index), (event_date, i) in zip(events, events[1:]):
+            if (event_date - last_date).days <= DUPLICATE_TIME_WINDOW_DAYS:
+                duplicates.append({
+                    "index": i,
+                    "assetCode": asset_code,
+                    "eventType": event_type,
+                    "date": event_date.isoformat(),
+                    "quantity": quantity,
+                    "duplicateOf": {"index": last_index, "date": last_date.isoformat()},
+                })
+
+    duplicates.sort(key=lambda duplicate: duplicate["index"])
+    return duplicates
+
+def find_fragmented_duplicate_events(fragmented_data: 'FragmentedData') -> list:
+    """
+    find_duplicate_events over each ticker's movements, with their export indexes. An asset
+    code always normalizes to a single ticker, so no duplicate group spans two tickers and
+    the export never has to be held in a list (e.g. with --stream).
+    """
+    duplicates = []
+    for ticker in fragmented_data:
+        duplicates.extend(find_duplicate_events(
+            fragmented_data.source_records(ticker, "movements"), fragmented_data.record_indexes(ticker, "movements")
+        ))
+    duplicates.sort(key=lambda duplicate: duplicate["index"])
+    return duplicates
+
+class TickerActivity:
+    """
+    Activity index entry of a ticker, filled by fragment_data(..., activity=True) in its
+    single pass: the years of its trades, of any of its dated records and of its income.
+    """
+    __slots__ = ('trade_years', 'record_years', 'income_years')
+
+    def __init__(self):
+        self.trade_years = set()
+        self.record_years = set() # Trades and every movement (events, income, transfers...)
+        self.income_years = set() # Dividendo, Juros sobre Capital Próprio and Rendimento movements
+
+    @property
+    def first_trade_year(self) -> int:
+        return min(self.trade_years, default=None)
+
+    @property
+    def last_trade_year(self) -> int:
+        return max(self.trade_years, default=None)
+
+def record_year(record, date_field: str) -> int:
+    """Year of an export record's date (0 if invalid), taken from the parsed ordinal of compact records."""
+    ordinal = getattr(record, 'date_ordinal', None)
+    if ordinal is None:
+        value = record.get(date_field)
+        ordinal = _date_ordinal_cached(value) if isinstance(value, str) else 0
+    return date_from_ordinal(ordinal).year if ordinal else 0
+
+def is_income_movement(movement_type) -> bool:
+    """Whether a movimentação type is one of the incomes the generated tests total (dividends, JCP, FII income)."""
+    return isinstance(movement_type, str) and (
+        movement_type.startswith(MOV_TYPE_DIVIDEND) or movement_type == MOV_TYPE_JCP or movement_type.startswith(MOV_TYPE_FII_INCOME)
+    )
 
-def save_fragmented_files(fragmented_data: dict, output_dir: str):
-    """Saves fragmented data into separate JSON files."""
+def fragment_data(negociacao_data, movimentacao_data, activity: bool = False, spill_dir: str = None) -> FragmentedData:
+    """
+    Fragments data by normalized ticker in a single pass over each input.
+    Accepts lists or any iterable of records (e.g. the generators returned by
+    load_json_data(..., stream=True)). The records of an iterable are spilled to per-ticker
+    files (see RecordSpill, created in spill_dir or the system temporary directory), so
+    memory does not grow with the export, beyond 4 bytes of offset per record.
+    The input records are not modified, so it is safe to call repeatedly on the same data.
+    With activity=True the same pass also builds each ticker's TickerActivity.
+    """
+    indexes = {}
+    sources = []
+    activities = {} if activity else None
+
+    for kind, records, ticker_field, date_field, label in (
+        ("transactions", negociacao_data, FIELD_NEG_TICKER, FIELD_NEG_DATE, "Negotiation"),
+        ("movements", movimentacao_data, FIELD_MOV_TICKER, FIELD_MOV_DATE, "Movement"),
+    ):
+        spill = None if isinstance(records, list) else RecordSpill(spill_dir)
+
+        for i, record in enumerate(records):
+            raw_ticker = record.get(ticker_field)
+            if raw_ticker:
+                normalized = normalize_ticker(raw_ticker)
+                if normalized != 'UNKNOWN':
+                    if normalized not in indexes:
+                        indexes[normalized] = {"transactions": array('I'), "movements": array('I')}
+                    # Original index is added to the copies for potential debugging
+                    indexes[normalized][kind].append(i)
+                    if spill is not None:
+                        spill.append(normalized, i, record)
+
+                    year = record_year(record, date_field) if activities is not None else 0
+                    if year:
+                        ticker_activity = activities.get(normalized) or activities.setdefault(normalized, TickerActivity())
+                        ticker_activity.record_years.add(year)
+                        if kind == "transactions":
+                            ticker_activity.trade_years.add(year)
+                        elif is_income_movement(record.get(FIELD_MOV_TYPE)):
+                            ticker_activity.income_years.add(year)
+            else:
+                print(f"Warning: {label} record at index {i} missing '{ticker_field}': {record}")
+
+        if spill is not None:
+            spill.flush()
+        sources.append(records if spill is None else spill)
+
+    return FragmentedData(sources[0], sources[1], indexes, activities)
+
+def save_fragmented_files(fragmented_data: dict, output_dir: str, timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT):
+    """Saves fragmented data into separate JSON files (plus each ticker's merged timeline when requested)."""
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    for ticker, data in fragmented_data.items():
-        transactions_path = output_path / f"{ticker}_transactions.json"
-        movements_path = output_path / f"{ticker}_movements.json"
+    for ticker in fragmented_data:
+        if timeline:
+            data = {kind: ticker_records(fragmented_data, ticker, kind) for kind in ("transactions", "movements")}
+        elif isinstance(fragmented_data, FragmentedData):
+            # Serialize record by record instead of copying the whole ticker first
+            data = {kind: fragmented_data.iter_records(ticker, kind) for kind in ("transactions", "movements")}
+        else:
+            data = fragmented_data[ticker]
+        save_ticker_history_files(ticker, data, output_path, timeline, history_format)
 
-        with open(transactions_path, 'w', encoding='utf-8') as f:
-            json.dump(data["transactions"], f, indent=2, ensure_ascii=False)
-        #print(f"Saved: {transactions_path}")
+def history_file_name(ticker: str, kind: str, history_format: str = DEFAULT_HISTORY_FORMAT) -> str:
+    """File name of a ticker's "transactions", "movements" or "timeline" history in the given format."""
+    return f"{ticker}_{kind}{HISTORY_FILE_EXTENSIONS[history_format]}"
 
-        with open(movements_path, 'w', encoding='utf-8') as f:
-            json.dump(data["movements"], f, indent=2, ensure_ascii=False)
-        #print(f"Saved: {movements_path}")
+def save_ticker_history_files(ticker: str, data: dict, output_path: Path, timeline: bool = False,
+                              history_format: str = DEFAULT_HISTORY_FORMAT):
+    """
+    Saves one ticker's transactions and movements files (lists or iterables of records) in
+    the given history format, and with timeline=True also its timeline (see build_ticker_timeline).
+    """
+    if timeline:
+        data = {kind: list(data[kind]) for kind in ("transactions", "movements")}
+    transactions_path = output_path / history_file_name(ticker, "transactions", history_format)
+    movements_path = output_path / history_file_name(ticker, "movements", history_format)
 
+    with open(transactions_path, 'w', encoding='utf-8') as f:
+        write_history_records(data["transactions"], f, history_format)
+    #print(f"Saved: {transactions_path}")
 
-def generate_calculation_helper_file(test_dir: str):
-    """Generates a Calculation Helper test file"""
+    with open(movements_path, 'w', encoding='utf-8') as f:
+        write_history_records(data["movements"], f, history_format)
+    #print(f"Saved: {movements_path}")
 
-    test_calculation_helper_file_path = Path(test_dir) / f"calculation_helper.ts" # Use .ts extension
+    if timeline:
+        with open(output_path / history_file_name(ticker, "timeline", history_format), 'w', encoding='utf-8') as f:
+            write_history_records(build_ticker_timeline(data["transactions"], data["movements"]), f, history_format)
 
-    # --- Calculation Helper Test File Template ---
-    template = f"""// Generated by scripts/generate_asset_tests.py
+def write_history_records(records, f, history_format: str = DEFAULT_HISTORY_FORMAT):
+    """
+    Writes records in one of the HISTORY_FORMATS: pretty (indented JSON array), compact
+    (JSON array without whitespace), ndjson (one record per line) or columnar (see build_columnar_history).
+    """
+    if history_format == 'pretty':
+        write_json_array(records, f)
+    elif history_format == 'compact':
+        first = True
+        for record in records:
+            f.write('[' if first else ',')
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            first = False
+        f.write('[]' if first else ']')
+    elif history_format == 'ndjson':
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+    elif history_format == 'columnar':
+        json.dump(build_columnar_history(records), f, ensure_ascii=False, separators=(',', ':'))
+    else:
+        raise ValueError(f"Unknown history format: {history_format}")
+
+def build_columnar_history(records) -> dict:
+    """
+    Column-oriented form of a list of records: one array of values per field, with the
+    COLUMNAR_DICTIONARY_FIELDS stored as indexes into a per-file dictionary of distinct values.
+    Each distinct key order is a "layout" (indexes into "fields"), so expandirHistoricoColunar
+    rebuilds every record with exactly its original keys, in order; "layout" is omitted when
+    all records share one.
+    """
+    records = list(records)
+    fields, field_indexes = [], {}
+    layouts, layout_indexes, record_layouts = [], {}, []
+    for record in records:
+        keys = tuple(record.keys())
+        layout = layout_indexes.get(keys)
+        if layout is None:
+            for key in keys:
+                if key not in field_indexes:
+                    field_indexes[key] = len(fields)
+                    fields.append(key)
+            layout = layout_indexes[keys] = len(layouts)
+            layouts.append([field_indexes[key] for key in keys])
+        record_layouts.append(layout)
+
+    columns, dictionaries = {}, {}
+    for field in fields:
+        column = [record[field] if field in record else None for record in records]
+        if field in COLUMNAR_DICTIONARY_FIELDS and all(isinstance(value, str) or value is None for value in column):
+            codes = {}
+            column = [codes.setdefault(value, len(codes)) for value in column]
+            dictionaries[field] = list(codes)
+        columns[field] = column
+
+    history = {
+        "format": 'columnar',
+        "version": COLUMNAR_FORMAT_VERSION,
+        "length": len(records),
+        "fields": fields,
+        "layouts": layouts,
+    }
+    if len(layouts) > 1:
+        history["layout"] = record_layouts
+    history["dictionaries"] = dictionaries
+    history["columns"] = columns
+    return history
+
+def write_json_array(records, f):
+    """
+    Writes records as a JSON array one element at a time, producing the same bytes as
+    json.dump(list(records), f, indent=2, ensure_ascii=False).
+    """
+    first = True
+    for record in records:
+        f.write('[\n  ' if first else ',\n  ')
+        # Newlines inside JSON strings are escaped, so every raw newline is indentation
+        f.write(json.dumps(record, indent=2, ensure_ascii=False).replace('\n', '\n  '))
+        first = False
+    f.write('[]' if first else '\n]')
+
+def build_ticker_timeline(transactions: list, movements: list) -> list:
+    """
+    Merges one ticker's transactions and movements into a single chronological timeline,
+    parsed once here so the generated tests neither re-parse dates nor sort:
+    ISO dates, numeric quantity/unitPrice/value and the "index" of each row in its source file.
+    Rows follow calcularResumoAnualComEventos' order (date, same-day priority, transactions
+    before movements, file position), invalid dates last; "seq" is that position and
+    "tradeSeq" the position of a transaction in calcularResumoAnual's (date, file position) order.
+    """
+    rows = []
+    for index, t in enumerate(transactions):
+        event_date, quantity, value = negotiation_fields(t)
+        rows.append((event_date, {
+            "source": 'transaction', "index": index, "type": t.get(FIELD_NEG_TYPE), "direction": None,
+            "quantity": quantity, "unitPrice": parse_float_safe(t.get(FIELD_NEG_UNIT_PRICE)), "value": value,
+        }))
+    for index, m in enumerate(movements):
+        event_date, quantity = movement_fields(m)
+        rows.append((event_date, {
+            "source": 'movement', "index": index, "type": m.get(FIELD_MOV_TYPE), "direction": m.get(FIELD_MOV_DIRECTION),
+            "quantity": quantity, "unitPrice": parse_float_safe(m.get(FIELD_MOV_UNIT_PRICE)),
+            "value": parse_float_safe(m.get(FIELD_MOV_TOTAL_COST)),
+        }))
+
+    # Both sorts are stable, so rows of the same key keep transactions first, then file order
+    trade_order = sorted(
+        (row for row in rows if row[1]["source"] == 'transaction'),
+        key=lambda row: (row[0] is None, row[0] or date.min)
+    )
+    trade_seq = {row[1]["index"]: position for position, row in enumerate(trade_order)}
+    rows.sort(key=lambda row: (row[0] is None, row[0] or date.min, SAME_DAY_EVENT_PRIORITY.get(row[1]["type"]) or 99))
+
+    timeline = []
+    for seq, (event_date, row) in enumerate(rows):
+        timeline.append({
+            "seq": seq,
+            "tradeSeq": trade_seq[row["index"]] if row["source"] == 'transaction' else None,
+            "source": row["source"],
+            "index": row["index"],
+            "date": event_date.isoformat() if event_date else None,
+            "year": event_date.year if event_date else None,
+            "type": row["type"],
+            "direction": row["direction"],
+            "quantity": row["quantity"],
+            "unitPrice": row["unitPrice"],
+            "value": row["value"],
+        })
+    return timeline
+
+
+class CompiledTemplate:
+    """
+    A str.format-style template split once into static chunks and named slots,
+    so rendering a file is a single join instead of re-evaluating the whole text.
+    """
+    __slots__ = ('parts', 'slots')
+
+    def __init__(self, parts: list, slots: list):
+        self.parts = parts # Static chunks, with None where a slot goes
+        self.slots = slots # (position in parts, slot name)
+
+    def render(self, values: dict = None) -> str:
+        parts = self.parts.copy()
+        for position, name in self.slots:
+            parts[position] = str(values[name])
+        return ''.join(parts)
+
+def compile_template(text: str, constants: dict) -> CompiledTemplate:
+    """
+    Parses a str.format-style template once. Upper-case fields found in constants (e.g. the
+    module's FIELD_* names) are folded into the static chunks; the others become slots
+    filled by CompiledTemplate.render.
+    """
+    parts, slots = [], []
+    static = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(text):
+        static.append(literal)
+        if field is None:
+            continue
+        if format_spec or conversion:
+            raise ValueError(f"Unsupported template field: {{{field}!{conversion}:{format_spec}}}")
+        if field.isupper() and field in constants:
+            static.append(str(constants[field]))
+        else:
+            parts.append(''.join(static))
+            static = []
+            slots.append((len(parts), field))
+            parts.append(None)
+    parts.append(''.join(static))
+    return CompiledTemplate(parts, slots)
+
+def fill_template_blocks(text: str, blocks: dict) -> str:
+    """
+    Fills the fields of a str.format-style template named in blocks with their template text
+    (which may hold block fields too), keeping every other field and escaped brace for
+    compile_template.
+    """
+    filled = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(text):
+        filled.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if format_spec or conversion:
+            raise ValueError(f"Unsupported template field: {{{field}!{conversion}:{format_spec}}}")
+        filled.append(fill_template_blocks(blocks[field], blocks) if field in blocks else f"{{{field}}}")
+    return ''.join(filled)
+
+# --- Calculation Helper Test File Template ---
+# str.format syntax: every field is a module constant, filled in once by compile_template
+CALCULATION_HELPER_TEMPLATE = """// Generated by scripts/generate_asset_tests.py
+
+import * as fs from 'fs';
+import * as path from 'path';
 
 import {{ ExternalEventInfoProviderPort }} from '../../../../core/interfaces/ExternalEventInfoProviderPort';
 import {{ StaticEventInfoAdapter }} from '../../../adapters/StaticEventInfoAdapter';
@@ -248,7 +1363,7 @@ interface Movement {{
   '{FIELD_MOV_DATE}': string;
   '{FIELD_MOV_TYPE}': string; // Ex: "Bonificação em Ativos", "Fração em Ativos"
   '{FIELD_MOV_DIRECTION}': 'Credito' | 'Debito' | string; // Tipagem mais específica
-  '{FIELD_NEG_QUANTITY}': string; // Vem como string do input
+  '{FIELD_MOV_QUANTITY}': string; // Vem como string do input
   // Permite outras propriedades
   [key: string]: any;
 }}
@@ -584,7 +1699,7 @@ export async function calcularResumoAnualComEventos(
         // Garantir que direction seja um dos tipos esperados ou tratar como string genérica
         const direction: 'Credito' | 'Debito' | string = m['{FIELD_MOV_DIRECTION}'];
         // Quantidade em movimentos PODE ser float (ex: bonificação)
-        const quantity = parseFloatSafe(m['{FIELD_NEG_QUANTITY}']); // Pode ser fracionado
+        const quantity = parseFloatSafe(m['{FIELD_MOV_QUANTITY}']); // Pode ser fracionado
 
          // Quantidade deve ser positiva
          if (quantity <= 0) {{
@@ -1043,6 +2158,226 @@ export function calcularVendasDoAno(transactions: TransacaoBase[], selectedYear:
 
 
 
+/**
+ * Linha de {{ticker}}_timeline.json (gerado com --timeline): transações e movimentos de um ativo
+ * já intercalados em ordem cronológica, com datas ISO e valores numéricos convertidos uma única vez.
+ */
+export interface LinhaDoTempo {{
+    seq: number; // Posição na ordem de calcularResumoAnualComEventos (data, prioridade no dia, transações antes de movimentos)
+    tradeSeq: number | null; // Posição da transação na ordem de calcularResumoAnual (null em movimentos)
+    source: string; // 'transaction' | 'movement'
+    index: number; // Posição do registro no arquivo _transactions.json ou _movements.json
+    date: string | null; // YYYY-MM-DD, null se a data original for inválida
+    year: number | null;
+    type: string | null;
+    direction: string | null;
+    quantity: number;
+    unitPrice: number;
+    value: number;
+}}
+
+/**
+ * Transações da linha do tempo na ordem usada por calcularResumoAnual, sem ordenar nem converter datas.
+ */
+export function transacoesDaLinhaDoTempo(linhaDoTempo: LinhaDoTempo[]): LinhaDoTempo[] {{
+    const transacoes: LinhaDoTempo[] = new Array(linhaDoTempo.filter(linha => linha.tradeSeq !== null).length);
+    for (const linha of linhaDoTempo) {{
+        if (linha.tradeSeq !== null) {{
+            transacoes[linha.tradeSeq] = linha;
+        }}
+    }}
+    return transacoes;
+}}
+
+/**
+ * Mesmo resultado de calcularResumoAnual, lendo a linha do tempo pré-ordenada e pré-convertida.
+ */
+export function calcularResumoAnualDaLinhaDoTempo(linhaDoTempo: LinhaDoTempo[]): ResumoAnual[] {{
+  let totalQuantidade: number = 0;
+  let valorTotalInvestido: number = 0.0;
+  const resumoAnual: Record<number, ResumoAnual> = {{}};
+  const epsilon = 0.0001; // Tolerância para comparação de ponto flutuante
+
+  for (const transacao of transacoesDaLinhaDoTempo(linhaDoTempo)) {{
+      const quantidade = transacao.quantity;
+      const valor = transacao.value;
+
+      if (transacao.year === null || quantidade <= 0 || valor < 0) {{
+          console.warn(`Transação (linha do tempo) ignorada por dados inválidos: ${{JSON.stringify(transacao)}}`);
+          continue;
+      }}
+
+      if (transacao.type === 'Compra') {{
+          totalQuantidade += quantidade;
+          valorTotalInvestido += valor;
+      }} else if (transacao.type === '{NEG_TYPE_SELL}') {{
+          if (totalQuantidade > 0) {{
+              const custoMedioAntesVenda = valorTotalInvestido / totalQuantidade;
+              const quantidadeRealVendida = Math.min(quantidade, totalQuantidade);
+
+              if (quantidade > totalQuantidade) {{
+                  console.warn(`Venda simples: Tentativa de venda de ${{quantidade}} quando havia ${{totalQuantidade}} em ${{transacao.date}}. Vendendo ${{totalQuantidade}}.`);
+              }}
+
+              valorTotalInvestido -= quantidadeRealVendida * custoMedioAntesVenda;
+              totalQuantidade -= quantidadeRealVendida;
+
+              if (totalQuantidade < epsilon) {{
+                  totalQuantidade = 0;
+                  valorTotalInvestido = 0; // Se zerou a quantidade, zera o custo
+              }}
+          }} else {{
+              console.warn(`Venda simples ignorada pois não havia quantidade: ${{JSON.stringify(transacao)}}`);
+          }}
+      }}
+
+      resumoAnual[transacao.year] = {{
+          ano: transacao.year,
+          quantidadeFinal: totalQuantidade,
+          precoMedio: totalQuantidade > epsilon ? valorTotalInvestido / totalQuantidade : 0,
+          totalInvestido: valorTotalInvestido
+      }};
+  }}
+
+  // Replicar a posição para anos futuros sem movimentação (mesma regra de calcularResumoAnual)
+  const anosProcessados = Object.keys(resumoAnual).map(Number).sort((a, b) => a - b);
+  if (anosProcessados.length > 0) {{
+      const anoFinalParaLoop = Math.max(anosProcessados[anosProcessados.length - 1], new Date().getFullYear());
+      let ultimoResumoValido: ResumoAnual | null = null;
+
+      for (let ano = anosProcessados[0]; ano <= anoFinalParaLoop; ano++) {{
+          if (resumoAnual[ano]) {{
+              ultimoResumoValido = resumoAnual[ano];
+          }} else if (ultimoResumoValido && ultimoResumoValido.quantidadeFinal > epsilon) {{
+              resumoAnual[ano] = {{ ...ultimoResumoValido, ano: ano }};
+          }} else {{
+              ultimoResumoValido = null; // Reset chain
+          }}
+      }}
+  }}
+
+  return Object.values(resumoAnual).sort((a, b) => a.ano - b.ano);
+}}
+
+/**
+ * Soma o valor dos movimentos de um ano cujo tipo satisfaz o filtro (ex: dividendos), sem converter datas nem valores.
+ */
+export function somarMovimentosDoAno(linhaDoTempo: LinhaDoTempo[], ano: number, filtroTipo: (tipo: string) => boolean): number {{
+    return linhaDoTempo
+        .filter(linha => linha.source === 'movement' && linha.year === ano && linha.type !== null && filtroTipo(linha.type))
+        .reduce((sum, linha) => sum + linha.value, 0);
+}}
+
+/**
+ * Arquivo de histórico no formato colunar (--history-format columnar): uma lista de valores por campo,
+ * com os campos repetitivos (ticker, tipo de evento...) trocados por índices de um dicionário.
+ */
+export interface HistoricoColunar {{
+    length: number;
+    fields: string[];
+    layouts: number[][]; // Campos de cada formato de registro, na ordem original das chaves
+    layout?: number[]; // Formato de cada registro (ausente quando todos usam layouts[0])
+    dictionaries: Record<string, unknown[]>;
+    columns: Record<string, unknown[]>;
+}}
+
+/**
+ * Reconstrói os registros originais (mesmas chaves, na mesma ordem) de um histórico colunar.
+ */
+export function expandirHistoricoColunar(historico: HistoricoColunar): any[] {{
+    const layouts = historico.layouts.map(campos => campos.map(campo => {{
+        const nome = historico.fields[campo];
+        return {{ nome: nome, valores: historico.columns[nome], dicionario: historico.dictionaries[nome] }};
+    }}));
+
+    const registros: any[] = new Array(historico.length);
+    for (let i = 0; i < historico.length; i++) {{
+        const registro: Record<string, unknown> = {{}};
+        for (const {{ nome, valores, dicionario }} of layouts[historico.layout ? historico.layout[i] : 0]) {{
+            registro[nome] = dicionario ? dicionario[valores[i] as number] : valores[i];
+        }}
+        registros[i] = registro;
+    }}
+    return registros;
+}}
+
+/**
+ * Lê um arquivo de histórico em qualquer formato de --history-format (JSON indentado ou compacto, NDJSON ou colunar).
+ */
+export function carregarHistorico(diretorio: string, caminhoRelativo: string): any[] {{
+    const conteudo = fs.readFileSync(path.join(diretorio, caminhoRelativo), 'utf-8');
+    if (caminhoRelativo.endsWith('.ndjson')) {{
+        return conteudo.split('\\n').filter(linha => linha !== '').map(linha => JSON.parse(linha));
+    }}
+    const historico = JSON.parse(conteudo);
+    return Array.isArray(historico) ? historico : expandirHistoricoColunar(historico);
+}}
+
+/**
+ * Resultado FIFO esperado de uma venda (custo pelos lotes de compra mais antigos primeiro).
+ */
+export interface ResultadoFifo {{
+    date: string; // AAAA-MM-DD
+    month: number;
+    quantity: number;
+    purchasePrice: number; // Custo FIFO por unidade vendida
+    purchaseCost: number;
+    salePrice: number;
+    saleValue: number;
+    profitOrLoss: number;
+    unmatchedQuantity: number; // Vendida sem lote de compra, custeada pelo preço médio do fim do ano
+}}
+
+/**
+ * Resultado mensal esperado de uma categoria de ativo (ganho de capital, isenção e compensação de prejuízo).
+ */
+export interface ResultadoMensal {{
+    month: number;
+    assetCategory: string;
+    trades: number;
+    totalSalesValue: number;
+    totalProfit: number;
+    totalLoss: number;
+    netResult: number;
+    isExempt: boolean; // Vendas de ações do mês até R$ {STOCK_SALES_EXEMPTION_LIMIT}
+    compensatedLoss: number;
+    taxableProfit: number;
+    taxRate: number;
+    taxDue: number;
+    taxWithheld: number;
+    taxToPay: number;
+    remainingLoss: number; // Prejuízo a compensar nos meses seguintes do ano (só ações e FIIs)
+}}
+
+/**
+ * Vendas e rendimentos esperados de um ativo em um ano de declaração.
+ */
+export interface ResultadoDoAno {{
+    vendasDoAno: ResumoVendasAnual[];
+    resultadosFifo: ResultadoFifo[]; // Resultado de cada venda do ano, como AssetProcessor.calculateTradeResults
+    resultadosMensais: ResultadoMensal[]; // Como AssetProcessor.calculateMonthlyResults
+    dividendos: number;
+    jcp: number;
+    rendimentos: number;
+}}
+
+/**
+ * Resultados esperados de um ativo ({{ticker}}_expected.json, gerado com --snapshots), calculados uma única vez
+ * pelo gerador com as mesmas regras de calcularResumoAnual, calcularResumoAnualComEventos e calcularVendasDoAno.
+ */
+export interface ResultadoEsperado {{
+    version: number;
+    anosDeclaracao: number[];
+    anoAtual: number; // Ano em que o arquivo foi gerado (último ano dos resumos)
+    resumoAnual: ResumoAnual[];
+    resumoAnualComEventos: ResumoAnual[];
+    anos: Record<number, ResultadoDoAno>; // Um item por ano de anosDeclaracao
+}}
+
+export function carregarResultadoEsperado(diretorio: string, caminhoRelativo: string): ResultadoEsperado {{
+    return JSON.parse(fs.readFileSync(path.join(diretorio, caminhoRelativo), 'utf-8'));
+}}
+
 export function printSummaryPosition(resumo: ResumoAnual[], title: string): void {{
     let resumoAnualOutputText = `${{title}}{TEMPLATE_NEW_LINE}`;
     resumoAnualOutputText += "==================================={TEMPLATE_NEW_LINE}{TEMPLATE_NEW_LINE}";
@@ -1057,40 +2392,50 @@ export function printSummaryPosition(resumo: ResumoAnual[], title: string): void
     console.log(resumoAnualOutputText);
 }}
 """
-    # --- End Template ---
+# --- End Template ---
+CALCULATION_HELPER_COMPILED = compile_template(CALCULATION_HELPER_TEMPLATE, globals())
+
+def generate_calculation_helper_file(test_dir: str):
+    """Generates a Calculation Helper test file. Returns its path, or None when it was already up to date."""
+
+    test_calculation_helper_file_path = Path(test_dir) / f"calculation_helper.ts" # Use .ts extension
+    template = CALCULATION_HELPER_COMPILED.render()
 
     output_calculation_helper_test_path = Path(test_dir)
     output_calculation_helper_test_path.mkdir(parents=True, exist_ok=True)
 
+    # Leave the file untouched when nothing changed so Jest's cache stays valid
+    if test_calculation_helper_file_path.is_file():
+        with open(test_calculation_helper_file_path, 'r', encoding='utf-8') as f:
+            if f.read() == template:
+                print(f"Calculation helper test file unchanged: {test_calculation_helper_file_path}")
+                return None
+
     with open(test_calculation_helper_file_path, 'w', encoding='utf-8') as f:
         f.write(template)
 
     print(f"Generated calculation helper test file: {test_calculation_helper_file_path}")
+    return test_calculation_helper_file_path
 
 
 
-def generate_jest_test_file(ticker: str, test_dir: str, history_dir_relative: str):
-    """Generates a Jest test file for a given ticker, including expected counts."""
-
-    test_file_path = Path(test_dir) / f"{ticker}.test.ts" # Use .ts extension
-
-    history_dir_relative_posix = history_dir_relative.replace('\\', '/') # Ensure posix paths for imports
+# --- Jest Test File Templates ---
+# str.format syntax, shared by the per-ticker test files and the consolidated suites: the
+# lower-case fields named in jest_test_template's blocks are filled with template text when a
+# layout is compiled; ticker, history_dir_relative_posix, declaration_year (declaration_years
+# with several years), suite_index and manifest_file are filled per file; every other field is
+# a module constant filled in once by compile_template
+JEST_TEST_IMPORTS_TEMPLATE = """// Generated by scripts/generate_asset_tests.py
 
-    # --- Jest Test File Template ---
-    template = f"""// Generated by scripts/generate_asset_tests.py
-
-import {{ 
+{file_system_imports}import {{ 
     mockExternalTickerInfoProvider,
     mockStaticEventInfoProvider,
     mockB3FileParser,
     mockTaxPayerInfo,
 
-    calcularResumoAnual,
-    calcularResumoAnualComEventos,
-    calcularVendasDoAno,
-    ResumoAnual,
+{expectation_helpers}    ResumoAnual,
 
-    printSummaryPosition,
+{history_helpers}    printSummaryPosition,
     
     parseFloatSafe,
     parseDate
@@ -1101,21 +2446,14 @@ import {{ DBKFileGenerator }} from '../../DBKFileGenerator';
 import {{ IRPFDeclaration }} from '../../../../core/domain/IRPFDeclaration';
 
 
-import transactionsData from './{history_dir_relative_posix}/{ticker}_transactions.json';
-import movementsData from './{history_dir_relative_posix}/{ticker}_movements.json';
-
-const DECLARATION_YEAR = {DECLARATION_YEAR};
-const includeInitialPosition = true;
+"""
 
-const defaultResumoComEventos: ResumoAnual = {{
-    ano: 0,
-    quantidadeFinal: 0,
-    precoMedio: 0,
-    totalInvestido: 0
-}};
+# The year-end summaries of an asset, computed once per file (once per asset in a suite)
+JEST_TEST_SUMMARIES_TEMPLATE = """{expected_result}const resumo: ResumoAnual[] = {annual_summaries};
+"""
 
-const resumo: ResumoAnual[] = calcularResumoAnual(transactionsData);
-const resumoDoAnoEsperado: ResumoAnual = resumo.find(dado => dado.ano == DECLARATION_YEAR) ?? defaultResumoComEventos;
+# The expected values of a declaration year
+JEST_TEST_EXPECTATIONS_TEMPLATE = """const resumoDoAnoEsperado: ResumoAnual = resumo.find(dado => dado.ano == DECLARATION_YEAR) ?? defaultResumoComEventos;
 
 // It will be loaded in Async method
 let expectedResumoComEventos: ResumoAnual[] = [];
@@ -1123,23 +2461,98 @@ let expectedResumoComEventosDoAnoEsperado: ResumoAnual;
 let expectedResumoComEventosDoAnoAnteriorEsperado: ResumoAnual;
 
 
-const expectedSoldMonthlyResults = calcularVendasDoAno(transactionsData, DECLARATION_YEAR);
+const expectedSoldMonthlyResults = {expected_sales};
 
-const expectedDividends = movementsData
-    .filter(m => m['{FIELD_MOV_TYPE}'].startsWith('{MOV_TYPE_DIVIDEND}') && parseDate(m['{FIELD_MOV_DATE}'])?.getFullYear() === DECLARATION_YEAR)
-    .reduce((sum, m) => sum + parseFloatSafe(m['{FIELD_MOV_TOTAL_COST}']), 0);
+const expectedDividends = {expected_dividends};
 
-const expectedJCP = movementsData
-    .filter(m => m['{FIELD_MOV_TYPE}'] === '{MOV_TYPE_JCP}' && parseDate(m['{FIELD_MOV_DATE}'])?.getFullYear() === DECLARATION_YEAR)
-    .reduce((sum, m) => sum + parseFloatSafe(m['{FIELD_MOV_TOTAL_COST}']), 0);
+const expectedJCP = {expected_jcp};
 
-const expectedTotalDividends = movementsData
+const expectedTotalDividends = {expected_income};"""
+
+# Blocks of the expected values computed by the calculation helpers from the raw B3 records
+JEST_TEST_COMPUTED_EXPECTATIONS = {
+    "expectation_helpers": "    calcularResumoAnual,\n    calcularResumoAnualComEventos,\n    calcularVendasDoAno,\n",
+    "expected_result": "",
+    "annual_summaries": "calcularResumoAnual(transactionsData)",
+    "expected_summaries_with_events": "await calcularResumoAnualComEventos(transactionsData, movementsData, {ticker_expression})",
+    "expected_sales": "calcularVendasDoAno(transactionsData, DECLARATION_YEAR)",
+    "current_year": "new Date().getFullYear()",
+    "snapshot_tests": "",
+    "expected_dividends": """movementsData
+    .filter(m => m['{FIELD_MOV_TYPE}'].startsWith('{MOV_TYPE_DIVIDEND}') && parseDate(m['{FIELD_MOV_DATE}'])?.getFullYear() === DECLARATION_YEAR)
+    .reduce((sum, m) => sum + parseFloatSafe(m['{FIELD_MOV_TOTAL_COST}']), 0)""",
+    "expected_jcp": """movementsData
+    .filter(m => m['{FIELD_MOV_TYPE}'] === '{MOV_TYPE_JCP}' && parseDate(m['{FIELD_MOV_DATE}'])?.getFullYear() === DECLARATION_YEAR)
+    .reduce((sum, m) => sum + parseFloatSafe(m['{FIELD_MOV_TOTAL_COST}']), 0)""",
+    "expected_income": """movementsData
     .filter(r => r['{FIELD_MOV_TYPE}'].startsWith('{MOV_TYPE_FII_INCOME}') && parseDate(r['{FIELD_MOV_DATE}'])?.getFullYear() === DECLARATION_YEAR)
-    .reduce((sum, r) => sum + parseFloatSafe(r['{FIELD_MOV_TOTAL_COST}']), 0);
+    .reduce((sum, r) => sum + parseFloatSafe(r['{FIELD_MOV_TOTAL_COST}']), 0)""",
+}
+
+# The simple position and the dividend/JCP/income totals read from the ticker's pre-sorted,
+# pre-parsed timeline (--timeline); AssetProcessor and calcularResumoAnualComEventos still
+# get the raw B3 records
+JEST_TEST_TIMELINE_EXPECTATIONS = {
+    **JEST_TEST_COMPUTED_EXPECTATIONS,
+    "expectation_helpers": (
+        "    calcularResumoAnualDaLinhaDoTempo,\n    somarMovimentosDoAno,\n"
+        "    calcularResumoAnualComEventos,\n    calcularVendasDoAno,\n"
+    ),
+    "annual_summaries": "calcularResumoAnualDaLinhaDoTempo(timelineData)",
+    "expected_dividends": "somarMovimentosDoAno(timelineData, DECLARATION_YEAR, tipo => tipo.startsWith('{MOV_TYPE_DIVIDEND}'))",
+    "expected_jcp": "somarMovimentosDoAno(timelineData, DECLARATION_YEAR, tipo => tipo === '{MOV_TYPE_JCP}')",
+    "expected_income": "somarMovimentosDoAno(timelineData, DECLARATION_YEAR, tipo => tipo.startsWith('{MOV_TYPE_FII_INCOME}'))",
+}
+
+# Every expected value read from the ticker's snapshot file (--snapshots, see build_expected_snapshot)
+# instead of running the calculation helpers, so the tests only compare AssetProcessor's output;
+# snapshot_path is the TS expression of the snapshot's path
+JEST_TEST_SNAPSHOT_EXPECTATIONS = {
+    "expectation_helpers": "    carregarResultadoEsperado,\n    ResultadoEsperado,\n",
+    "expected_result": "const resultadoEsperado: ResultadoEsperado = carregarResultadoEsperado(__dirname, {snapshot_path});\n",
+    "annual_summaries": "resultadoEsperado.resumoAnual",
+    "expected_summaries_with_events": "resultadoEsperado.resumoAnualComEventos",
+    "expected_sales": "resultadoEsperado.anos[DECLARATION_YEAR].vendasDoAno",
+    "current_year": "resultadoEsperado.anoAtual", # Last year of the snapshot's summaries
+    "expected_dividends": "resultadoEsperado.anos[DECLARATION_YEAR].dividendos",
+    "expected_jcp": "resultadoEsperado.anos[DECLARATION_YEAR].jcp",
+    "expected_income": "resultadoEsperado.anos[DECLARATION_YEAR].rendimentos",
+    "snapshot_tests": """
+  test('AssetProcessor: should calculate FIFO Trade Results correctly', async () => {{
+    const expectedTradeResults = resultadoEsperado.anos[DECLARATION_YEAR].resultadosFifo;
+    const tradeResults = (await assetProcessor.calculateTradeResults(declaration.assetPositions, DECLARATION_YEAR))
+        .filter(result => result.assetCode?.startsWith({ticker_expression}));
+
+    expect(tradeResults.length).toBe(expectedTradeResults.length);
+    tradeResults.forEach((result, index) => {{
+        expect(result.quantity).toBeCloseTo(expectedTradeResults[index].quantity, 4);
+        expect(result.purchaseCost).toBeCloseTo(expectedTradeResults[index].purchaseCost, 2);
+        expect(result.profitOrLoss).toBeCloseTo(expectedTradeResults[index].profitOrLoss, 2);
+    }});
+  }});
 
+  test('AssetProcessor: should calculate the Monthly Results ledger correctly', () => {{
+    const expectedMonthlyResults = resultadoEsperado.anos[DECLARATION_YEAR].resultadosMensais;
+
+    expect(declaration.monthlyResults.length).toBe(expectedMonthlyResults.length);
+    declaration.monthlyResults.forEach((result, index) => {{
+        const expected = expectedMonthlyResults[index];
+        expect(result.month).toBe(expected.month);
+        expect(result.assetCategory).toBe(expected.assetCategory);
+        expect(result.totalSalesValue).toBeCloseTo(expected.totalSalesValue, 2);
+        expect(result.netResult).toBeCloseTo(expected.netResult, 2);
+        expect(result.compensatedLoss).toBeCloseTo(expected.compensatedLoss, 2);
+        expect(result.taxableProfit).toBeCloseTo(expected.taxableProfit, 2);
+        expect(result.taxDue).toBeCloseTo(expected.taxDue, 2);
+        expect(result.taxToPay).toBeCloseTo(expected.taxToPay, 2);
+        expect(result.remainingLoss).toBeCloseTo(expected.remainingLoss, 2);
+    }});
+  }});
+""",
+}
 
-describe('{ticker} Asset Calculation and DBK Generation', () => {{
-  let assetProcessor: AssetProcessor;
+# The beforeAll and tests of one asset, inside its describe block
+JEST_TEST_BODY_TEMPLATE = """  let assetProcessor: AssetProcessor;
   let dbkGenerator: DBKFileGenerator;
   let declaration: IRPFDeclaration; // To store result from DBKFileGenerator
 
@@ -1152,10 +2565,10 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     const parsedTransactions = mockB3FileParser.parseNegotiationData(transactionsData);
     const parsedMovementsData = mockB3FileParser.parseMovementData(movementsData);
 
-    console.log(`Processing {ticker} with ${{transactionsData.length}} raw transactions and ${{movementsData.length}} raw movements...`);
+    console.log(`Processing {ticker_label} with ${{transactionsData.length}} raw transactions and ${{movementsData.length}} raw movements...`);
 
     try {{
-        expectedResumoComEventos = await calcularResumoAnualComEventos(transactionsData, movementsData, '{ticker}');
+        expectedResumoComEventos = {expected_summaries_with_events};
         expectedResumoComEventosDoAnoEsperado = expectedResumoComEventos.find(dado => dado.ano == DECLARATION_YEAR) ?? defaultResumoComEventos;
         expectedResumoComEventosDoAnoAnteriorEsperado = expectedResumoComEventos.find(dado => dado.ano == DECLARATION_YEAR - 1) ?? defaultResumoComEventos;
 
@@ -1172,7 +2585,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
         throw error;
     }}
 
-    console.log(`{ticker} processing and declaration generation complete.`);
+    console.log(`{ticker_label} processing and declaration generation complete.`);
 
     printSummaryPosition(resumo, "Resumo Anual da Posição");
     printSummaryPosition(expectedResumoComEventos, "Resumo Anual da Posição (incluindo eventos)");
@@ -1180,7 +2593,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
 
   
    test('calculation_helper: just checking last/recently calculated final Asset Position', () => {{
-    const currentYear = new Date().getFullYear();
+    const currentYear = {current_year};
 
     const resumoDoUltimoAnoEsperado = resumo.find(dado => dado.ano == currentYear) ?? defaultResumoComEventos;
     const expectedResumoComEventosDoUltimoAnoEsperado = expectedResumoComEventos.find(dado => dado.ano == currentYear) ?? defaultResumoComEventos; 
@@ -1198,7 +2611,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     expect(declaration?.assetPositions).toBeDefined();
 
     // Use optional chaining and provide a default value for find
-    const finalPosition = declaration.assetPositions?.find(p => p.assetCode?.startsWith('{ticker}'));
+    const finalPosition = declaration.assetPositions?.find(p => p.assetCode?.startsWith({ticker_expression}));
 
     if (finalPosition) {{
         expect(finalPosition?.quantity).toBeCloseTo(expectedResumoComEventosDoAnoEsperado.quantidadeFinal, 4);
@@ -1237,7 +2650,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     //const unpaidJCP = declaration.incomeRecords
     //    .filter(r => r.incomeType === '{MOV_TYPE_JCP}' && r.date.getFullYear() === DECLARATION_YEAR /*&& r.status === '{STATUS_NOT_PAID}'*/); // Using the status enum from AssetPosition.ts
 
-     // TODO: Verify how 'paid' status is determined in AssetProcessor based on '{ticker}' field ('Creditado', 'Provisionado', etc.)
+     // TODO: Verify how 'paid' status is determined in AssetProcessor based on the ticker field ('Creditado', 'Provisionado', etc.)
      // For now, let's assume 'Creditado' means paid.
      // We determine unpaid count based on the processed incomeRecords' status,
      // as the raw data lacks a reliable status field.
@@ -1255,7 +2668,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
         expect(result.year).toBe(DECLARATION_YEAR);
     }});
   }});
-
+{snapshot_tests}
 
   // --- DBKFileGenerator Tests ---
   test('DBKFileGenerator: should generate Bens e Direitos section correctly (Asset Position)', () => {{
@@ -1263,7 +2676,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     const bensSection = declaration.sections.find(s => s.code === 'BENS');
     expect(bensSection).toBeDefined();
 
-    const assetItem = bensSection?.items.find(item => /*item.code === '31' &&*/ item.ticker?.startsWith('{ticker}'));
+    const assetItem = bensSection?.items.find(item => /*item.code === '31' &&*/ item.ticker?.startsWith({ticker_expression}));
 
     if (expectedResumoComEventosDoAnoEsperado.quantidadeFinal > 0) {{
         expect(assetItem).toBeDefined();
@@ -1276,14 +2689,14 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
       
         expect(assetItem?.cnpj).toBeDefined(); // Check if CNPJ was fetched/provided
      
-        expect(assetItem?.description).toContain('{ticker}');
+        expect(assetItem?.description).toContain({ticker_expression});
     }} else {{
         // If no position at year end, no item should be generated for this asset code (31)
         expect(assetItem).toBeUndefined();
     }}
 
     // Check for unpaid JCP (Code 59)
-    const unpaidJCPItems = bensSection?.items.filter(item => item.code === '59' && item.description?.includes('JCP') && item.description?.includes('{ticker}'));
+    const unpaidJCPItems = bensSection?.items.filter(item => item.code === '59' && item.description?.includes('JCP') && item.description?.includes({ticker_expression}));
     const expectedUnpaidJCPValue = declaration.incomeRecords
         .filter(r => r.incomeType === '{MOV_TYPE_JCP}' && r.date.getFullYear() === DECLARATION_YEAR /*&& r.status === '{STATUS_NOT_PAID}'*/)
         .reduce((sum, r) => sum + (r.netValue || r.grossValue || 0), 0);
@@ -1302,7 +2715,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     const rendIsentosSection = declaration.sections.find(s => s.code === 'REND_ISENTOS');
     expect(rendIsentosSection).toBeDefined();
 
-    const assetItem = rendIsentosSection?.items.find(item => item.sourceName?.includes('{ticker}'));
+    const assetItem = rendIsentosSection?.items.find(item => item.sourceName?.includes({ticker_expression}));
 
     const totalDividends = declaration.incomeRecords
         .filter(r => (r.incomeType.startsWith('{MOV_TYPE_DIVIDEND}')) && r.year === DECLARATION_YEAR /*&& r.status === 'PAGO'*/) // Only PAID income
@@ -1345,7 +2758,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
         .filter(r => r.incomeType === '{MOV_TYPE_JCP}' && r.date.getFullYear() === DECLARATION_YEAR /*&& r.status === 'PAGO'*/) // Only paid JCP
         .reduce((sum, r) => sum + (r.netValue || r.grossValue || 0), 0);
 
-       const assetItemList = rendExclusivaSection?.items.filter(item => item.ticker?.startsWith('{ticker}')) ?? [];
+       const assetItemList = rendExclusivaSection?.items.filter(item => item.ticker?.startsWith({ticker_expression})) ?? [];
 
         const jcpItems = assetItemList.filter(item => item.code === '10'); // Code 10 for JCP
 
@@ -1365,7 +2778,7 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     const opRendaVariavelSection = declaration.sections.find(s => s.code === 'OP_RENDA_VARIAVEL');
     expect(opRendaVariavelSection).toBeDefined();
 
-    const assetItemList = opRendaVariavelSection?.items.filter(item => item.ticker?.startsWith('{ticker}'));
+    const assetItemList = opRendaVariavelSection?.items.filter(item => item.ticker?.startsWith({ticker_expression}));
 
     const resultsForYear = declaration.monthlyResults.filter(r => r.year === DECLARATION_YEAR);
 
@@ -1403,34 +2816,1891 @@ describe('{ticker} Asset Calculation and DBK Generation', () => {{
     //      expect(opRendaVariavelSection?.items?.length ?? 0).toBe(0);
     // }}
   }});
-
+{extra_tests}
   // Add more specific tests as needed
 
 }});
 """
-    # --- End Template ---
 
-    output_test_path = Path(test_dir)
-    output_test_path.mkdir(parents=True, exist_ok=True)
+JEST_TEST_FILE_TEMPLATE = """{imports}{history_data}
+{declaration_year_constant}
+const includeInitialPosition = true;
 
-    with open(test_file_path, 'w', encoding='utf-8') as f:
-        f.write(template)
+const defaultResumoComEventos: ResumoAnual = {{
+    ano: 0,
+    quantidadeFinal: 0,
+    precoMedio: 0,
+    totalInvestido: 0
+}};
+
+{summaries}{describe}
+{tests}"""
+
+JEST_TEST_DESCRIBE_TEMPLATE = """{expectations}
+
+
+describe('{ticker} Asset Calculation and DBK Generation', () => {{"""
+
+# With several declaration years the year-dependent expectations move into a describe.each over DECLARATION_YEARS
+JEST_TEST_MULTI_YEAR_DESCRIBE_TEMPLATE = """
+describe.each(DECLARATION_YEARS)('{ticker} Asset Calculation and DBK Generation (%i)', (DECLARATION_YEAR: number) => {{
+{expectations}
+"""
+# --- End Template ---
+
+def _jest_history_data(kinds: tuple, history_format: str, consolidated: bool) -> str:
+    """
+    Template text loading the given kinds of history files into transactionsData, movementsData...:
+    JSON arrays (pretty or compact) are static imports (loadJson calls in a suite), NDJSON and
+    columnar files are read through the helper's carregarHistorico.
+    """
+    extension = HISTORY_FILE_EXTENSIONS[history_format]
+    lines = []
+    for kind in kinds:
+        if consolidated:
+            loader = f"loadJson({kind})" if extension == '.json' else f"carregarHistorico(__dirname, {kind})"
+            lines.append(f"  const {kind}Data: any[] = {loader};\n")
+        elif extension == '.json':
+            lines.append(f"import {kind}Data from './{{history_dir_relative_posix}}/{{ticker}}_{kind}.json';\n")
+        else:
+            lines.append(
+                f"const {kind}Data: any[] = carregarHistorico(__dirname, "
+                f"'./{{history_dir_relative_posix}}/{{ticker}}_{kind}{extension}');\n"
+            )
+    return ''.join(lines)
+
+def jest_test_template(consolidated: bool = False, timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT,
+                       snapshots: bool = False, multi_year: bool = False) -> str:
+    """
+    The Jest test template of a layout, assembled from the shared pieces: a per-ticker test file,
+    or with consolidated a suite running the same tests with describe.each over its manifest entries.
+    timeline (per-ticker files only) reads the expected position and totals from the ticker's timeline,
+    snapshots every expected value from the ticker's snapshot file (the timeline is then not read);
+    history_format is the format of the history files the test reads. multi_year runs the tests
+    once per declaration year, while the history files and the year-end summaries are still
+    loaded and computed once per file (once per asset in a suite).
+    """
+    if snapshots:
+        expectations = JEST_TEST_SNAPSHOT_EXPECTATIONS
+    else:
+        expectations = JEST_TEST_TIMELINE_EXPECTATIONS if timeline else JEST_TEST_COMPUTED_EXPECTATIONS
+    kinds = ("transactions", "movements", "timeline") if timeline and not snapshots else ("transactions", "movements")
+    blocks = {
+        **expectations,
+        "snapshot_path": "expected!" if consolidated else f"'./{{history_dir_relative_posix}}/{{ticker}}{SNAPSHOT_FILE_SUFFIX}'",
+        "snapshot_entry": ", expected" if snapshots else "",
+        "history_data": _jest_history_data(kinds, history_format, consolidated),
+        "history_helpers": "" if HISTORY_FILE_EXTENSIONS[history_format] == '.json' else "    carregarHistorico,\n",
+        "file_system_imports": "import * as fs from 'fs';\nimport * as path from 'path';\n\n" if consolidated else "",
+        "ticker_label": "${{ticker}}" if consolidated else "{ticker}", # The ticker inside a TS template literal
+        "ticker_expression": "ticker" if consolidated else "'{ticker}'",
+        "extra_tests": JEST_SUITE_MANIFEST_TEST_TEMPLATE if consolidated else "",
+    }
+    summaries = fill_template_blocks(JEST_TEST_SUMMARIES_TEMPLATE, blocks)
+    expectations = fill_template_blocks(JEST_TEST_EXPECTATIONS_TEMPLATE, blocks)
+    if consolidated:
+        describe = JEST_SUITE_MULTI_YEAR_DESCRIBE_TEMPLATE if multi_year else JEST_SUITE_DESCRIBE_TEMPLATE
+    else:
+        describe = JEST_TEST_MULTI_YEAR_DESCRIBE_TEMPLATE if multi_year else JEST_TEST_DESCRIBE_TEMPLATE
+    blocks.update(
+        imports=JEST_TEST_IMPORTS_TEMPLATE,
+        declaration_year_constant=(
+            "const DECLARATION_YEARS: number[] = [{declaration_years}];" if multi_year
+            else "const DECLARATION_YEAR = {declaration_year};"
+        ),
+        summaries=textwrap.indent(summaries, '  ') if consolidated else summaries,
+        expectations=textwrap.indent(expectations, '  ') if consolidated or multi_year else expectations,
+        describe=describe,
+        tests=JEST_TEST_BODY_TEMPLATE,
+    )
+    return fill_template_blocks(JEST_SUITE_FILE_TEMPLATE if consolidated else JEST_TEST_FILE_TEMPLATE, blocks)
+
+JEST_TEST_TEMPLATE = jest_test_template()
+JEST_TEST_COMPILED = compile_template(JEST_TEST_TEMPLATE, globals())
+
+@lru_cache(maxsize=None)
+def jest_test_compiled(timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False,
+                       multi_year: bool = False) -> CompiledTemplate:
+    """
+    The compiled Jest test template reading the timeline, the expected-result snapshot and/or a
+    non-default history format, run for several declaration years with multi_year.
+    With snapshots the timeline is not read by the test.
+    """
+    if not timeline and not snapshots and not multi_year and HISTORY_FILE_EXTENSIONS[history_format] == '.json':
+        return JEST_TEST_COMPILED
+    return compile_template(jest_test_template(False, timeline, history_format, snapshots, multi_year), globals())
+
+# --- Consolidated Jest Suite Template ---
+# The tests of JEST_TEST_BODY_TEMPLATE run with describe.each over the manifest entries of one
+# suite; suite_index, manifest_file and declaration_year (or declaration_years) are filled per suite file
+JEST_SUITE_FILE_TEMPLATE = """{imports}interface AssetManifestEntry {{
+    ticker: string;
+    suite: number;
+    transactions: string; // History files, relative to this directory
+    movements: string;
+    transactionCount: number;
+    movementCount: number;
+    expected?: string; // Snapshot of the expected results, with --snapshots
+}}
+
+{declaration_year_constant}
+const SUITE = {suite_index};
+const includeInitialPosition = true;
+
+const loadJson = (relativePath: string): any => JSON.parse(fs.readFileSync(path.join(__dirname, relativePath), 'utf-8'));
+
+const assets: AssetManifestEntry[] = loadJson('./{manifest_file}').assets.filter((asset: AssetManifestEntry) => asset.suite === SUITE);
+
+const defaultResumoComEventos: ResumoAnual = {{
+    ano: 0,
+    quantidadeFinal: 0,
+    precoMedio: 0,
+    totalInvestido: 0
+}};
+
+{describe}
+{history_data}
+{summaries}{expectations}
+
+{tests}"""
+
+JEST_SUITE_DESCRIBE_TEMPLATE = """describe.each(assets)('$ticker Asset Calculation and DBK Generation', ({{ ticker, transactions, movements, transactionCount, movementCount{snapshot_entry} }}) => {{"""
+
+# With several declaration years every asset runs once per year of DECLARATION_YEARS
+JEST_SUITE_MULTI_YEAR_DESCRIBE_TEMPLATE = """describe.each(assets.flatMap(asset => DECLARATION_YEARS.map(declarationYear => ({{ ...asset, declarationYear }}))))('$ticker Asset Calculation and DBK Generation ($declarationYear)', ({{ declarationYear: DECLARATION_YEAR, ticker, transactions, movements, transactionCount, movementCount{snapshot_entry} }}) => {{"""
+
+# Extra test of a consolidated suite, checking the history files against the manifest
+JEST_SUITE_MANIFEST_TEST_TEMPLATE = """
+  test('manifest: history files match the expected record counts', () => {{
+    expect(transactionsData.length).toBe(transactionCount);
+    expect(movementsData.length).toBe(movementCount);
+  }});
+"""
+# --- End Template ---
+JEST_SUITE_TEMPLATE = jest_test_template(consolidated=True)
+JEST_SUITE_COMPILED = compile_template(JEST_SUITE_TEMPLATE, globals())
+
+@lru_cache(maxsize=None)
+def jest_suite_compiled(history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False, multi_year: bool = False) -> CompiledTemplate:
+    """
+    The compiled consolidated suite template, reading NDJSON and columnar history files through
+    carregarHistorico, with snapshots the expected results from each asset's snapshot file and,
+    with multi_year, running every asset once per declaration year.
+    """
+    if HISTORY_FILE_EXTENSIONS[history_format] == '.json' and not snapshots and not multi_year:
+        return JEST_SUITE_COMPILED
+    return compile_template(jest_test_template(True, False, history_format, snapshots, multi_year), globals())
+
+def generate_jest_test_file(ticker: str, test_dir: str, history_dir_relative: str, declaration_years: tuple = (DECLARATION_YEAR,),
+                            timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False):
+    """
+    Generates a Jest test file for a given ticker, including expected counts (read from its
+    timeline file when timeline=True, or from its expected-result snapshot when snapshots=True),
+    loading its history files in the given format. With several declaration years the tests
+    run once per year.
+    """
+
+    test_file_path = Path(test_dir) / f"{ticker}.test.ts" # Use .ts extension
+
+    history_dir_relative_posix = history_dir_relative.replace('\\', '/') # Ensure posix paths for imports
+    template = jest_test_compiled(timeline, history_format, snapshots, len(declaration_years) > 1).render({
+        "ticker": ticker,
+        "history_dir_relative_posix": history_dir_relative_posix,
+        **declaration_year_values(declaration_years),
+    })
+
+    write_text_file(test_file_path, template)
 
     #print(f"Generated test file: {test_file_path}")
 
+def declaration_year_values(declaration_years: tuple) -> dict:
+    """Template values of the declaration years: declaration_year (a single year) or declaration_years (several)."""
+    return {"declaration_year": declaration_years[0], "declaration_years": ', '.join(map(str, declaration_years))}
+
+def write_text_file(file_path: Path, content: str):
+    """
+    Writes a fully assembled file in a single write call. The parent directory is only
+    created when opening fails, instead of checking it again for every ticker.
+    """
+    try:
+        f = open(file_path, 'w', encoding='utf-8')
+    except FileNotFoundError:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(file_path, 'w', encoding='utf-8')
+    with f:
+        f.write(content)
+
+def write_text_file_if_changed(file_path: Path, content: str) -> bool:
+    """write_text_file, leaving the file untouched (and Jest's cache valid) when the content is the same."""
+    if file_path.is_file():
+        with open(file_path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    write_text_file(file_path, content)
+    return True
+
+
+# --- Python Reference Engine ---
+# Mirrors the TypeScript helpers of the calculation_helper.ts template, so expected
+# values can be computed in bulk without starting Jest.
+
+def parse_br_date(date_string) -> date:
+    """Python counterpart of the template's parseDate: DD/MM/YYYY -> date, or None if invalid."""
+    if not date_string or not isinstance(date_string, str):
+        return None
+
+    parts = date_string.split('/')
+    if len(parts) != 3:
+        return None
+
+    day, month, year = (_js_parse_int(part) for part in parts)
+    if day is None or month is None or year is None or year < 1000 or year > 3000 or month < 1 or month > 12 or day < 1 or day > 31:
+        return None
+
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None # e.g. 31/02
+
+def parse_float_safe(value) -> float:
+    """Python counterpart of the template's parseFloatSafe (Brazilian decimals, 0 on failure)."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        cleaned_value = value.replace('R$', '', 1).strip()
+        if ',' in cleaned_value:
+            cleaned_value = cleaned_value.replace('.', '').replace(',', '.', 1)
+        match = JS_FLOAT_PATTERN.match(cleaned_value)
+        return float(match.group(0)) if match else 0
+    return 0
+
+def parse_int_safe(value) -> int:
+    """Python counterpart of the template's parseIntSafe (non-strings and '-' are 0)."""
+    if not isinstance(value, str) or value.strip() in ('-', ''):
+        return 0
+    number = _js_parse_int(value)
+    return 0 if number is None else number
+
+def _js_parse_int(text: str):
+    # JavaScript parseInt(text, 10): leading integer prefix, None when there is none (NaN)
+    match = JS_INT_PATTERN.match(text)
+    return int(match.group(0)) if match else None
+
+def get_asset_code(product_or_code):
+    """Python counterpart of the template's getAssetCode ('ITSA4 - ITAUSA S.A.' -> 'ITSA4')."""
+    if not product_or_code or not isinstance(product_or_code, str):
+        return None
+    match = ASSET_CODE_PATTERN.match(product_or_code)
+    return match.group(0) if match else None
+
+def negotiation_fields(transacao) -> tuple:
+    """
+    (date, quantity, value) of a negociação record; read from the parsed slots of a NegotiationRecord.
+    The value keeps the full precision of its text, like the template's parseFloatSafe: the
+    centavos are only used when they are exact (e.g. not for '1400.005').
+    """
+    if type(transacao) is NegotiationRecord:
+        value = (
+            transacao.value_cents / 100 if transacao.is_exact(FIELD_NEG_TOTAL_COST)
+            else parse_float_safe(transacao.get(FIELD_NEG_TOTAL_COST))
+        )
+        return date_from_ordinal(transacao.date_ordinal), transacao.quantity, value
+    return (
+        parse_br_date(transacao.get(FIELD_NEG_DATE)),
+        parse_int_safe(transacao.get(FIELD_NEG_QUANTITY)),
+        parse_float_safe(transacao.get(FIELD_NEG_TOTAL_COST)),
+    )
+
+def movement_fields(movimentacao) -> tuple:
+    """(date, quantity) of a movimentação record; read from the parsed slots of a MovementRecord."""
+    if type(movimentacao) is MovementRecord:
+        return date_from_ordinal(movimentacao.date_ordinal), movimentacao.quantity
+    return parse_br_date(movimentacao.get(FIELD_MOV_DATE)), parse_float_safe(movimentacao.get(FIELD_MOV_QUANTITY))
+
+def static_event_key(ticker: str, event_type: str, event_date: date) -> str:
+    """Python counterpart of normalizeKey in src/infrastructure/data/staticAveragePriceEventInfoData.ts."""
+    normalized_event_type = unicodedata.normalize('NFD', event_type.lower())
+    normalized_event_type = ''.join(c for c in normalized_event_type if not unicodedata.combining(c))
+    normalized_event_type = re.sub(r'\s+', '-', normalized_event_type)
+    normalized_ticker = re.sub(r'[0-9]', '', ticker.strip().upper())
+    return f"{normalized_ticker}-{normalized_event_type}-{event_date.strftime('%Y%m%d')}"
+
+@lru_cache(maxsize=None)
+def _static_event_tables() -> tuple:
+    factors = {static_event_key(ticker, event_type, event_date): factor for ticker, event_type, event_date, factor in STATIC_EVENT_FACTORS}
+    prices = {static_event_key(ticker, event_type, event_date): price for ticker, event_type, event_date, price in STATIC_EVENT_AVERAGE_PRICES}
+    return factors, prices
+
+def _search_static_event(table: dict, ticker: str, event_type: str, event_date: date):
+    # Same lookup order as searchWithinDateWindow in StaticEventInfoAdapter.ts: exact, then +1, -1, +2, -2...
+    value = table.get(static_event_key(ticker, event_type, event_date))
+    if value is not None:
+        return value
+    for day_offset in range(1, STATIC_EVENT_WINDOW_DAYS + 1):
+        for signed_offset in (day_offset, -day_offset):
+            value = table.get(static_event_key(ticker, event_type, event_date + timedelta(days=signed_offset)))
+            if value is not None:
+                return value
+    return None
+
+def get_static_event_factor(ticker: str, event_type: str, event_date: date):
+    """Python counterpart of StaticEventInfoAdapter.getEventFactor (None when unknown)."""
+    return _search_static_event(_static_event_tables()[0], ticker, event_type, event_date)
+
+def get_static_event_average_price(ticker: str, event_type: str, event_date: date):
+    """Python counterpart of StaticEventInfoAdapter.getSpecialEventAveragePrice (None when unknown)."""
+    return _search_static_event(_static_event_tables()[1], ticker, event_type, event_date)
+
+def build_combined_events(transactions: list, movements: list, target_asset_code: str) -> list:
+    """
+    Maps transactions and quantity/cost movements of a ticker into the chronologically
+    sorted event list used by calcularResumoAnualComEventos (step 1 and 2 of the template).
+    """
+    all_events = []
+
+    for t in transactions:
+        event_date, quantity, value = negotiation_fields(t)
+        if not event_date:
+            continue
+
+        if quantity <= 0 or value < 0:
+            continue
+
+        all_events.append({
+            "date": event_date,
+            "eventType": t.get(FIELD_NEG_TYPE),
+            "assetCode": get_asset_code(t.get(FIELD_NEG_TICKER)),
+            "quantity": quantity,
+            "value": value,
+            "factor": None,
+            "source": 'transaction',
+        })
+
+    for m in movements:
+        asset_code = get_asset_code(m.get(FIELD_MOV_TICKER))
+        if not asset_code or not asset_code.startswith(target_asset_code):
+            continue
+
+        event_date, quantity = movement_fields(m)
+        if not event_date:
+            continue
+
+        event_type = m.get(FIELD_MOV_TYPE)
+        if quantity <= 0:
+            continue
+
+        if event_type in IRRELEVANT_MOVEMENT_TYPES or event_type not in QUANTITY_COST_EVENT_TYPES:
+            continue
+
+        factor = 1
+        if event_type in SPLIT_EVENT_TYPES or event_type == EVENT_REVERSE_SPLIT:
+            if m.get(FIELD_NEG_FACTOR):
+                factor = parse_float_safe(m.get(FIELD_NEG_FACTOR))
+                if not factor > 0:
+                    continue
+            else:
+                factor = get_static_event_factor(asset_code, event_type, event_date)
+                if not factor:
+                    continue
+
+        all_events.append({
+            "date": event_date,
+            "eventType": event_type,
+            "assetCode": asset_code,
+            "quantity": quantity,
+            "value": None,
+            "factor": factor,
+            "source": 'movement',
+        })
+
+    # Same-day ordering: Venda/Fração (debits) before Compra/Bonificação (credits), splits last
+    all_events.sort(key=lambda event: (event["date"], SAME_DAY_EVENT_PRIORITY.get(event["eventType"]) or 99))
+    return all_events
+
+def calcular_resumo_anual_com_eventos(transactions: list, movements: list, target_asset_code: str, current_year: int = None) -> list:
+    """
+    Python counterpart of calcularResumoAnualComEventos: replays Compra, Venda, Bonificação,
+    Fração, Desdobramento, Grupamento, Atualização and subscription events (skipping
+    duplicates within DUPLICATE_TIME_WINDOW_DAYS) and returns the year-end ResumoAnual list.
+    """
+    epsilon = CALCULATION_EPSILON
+    total_quantity = 0.0
+    valor_total_investido = 0.0
+    resumo_anual = {}
+    last_seen_event_date = {}
+
+    for event in build_combined_events(transactions, movements, target_asset_code):
+        event_type = event["eventType"]
+        quantity = event["quantity"]
+
+        duplicate_key = None
+        if event_type in DUPLICATE_CHECK_EVENT_TYPES and event["assetCode"]:
+            duplicate_key = (event["assetCode"], event_type, quantity)
+            last_date = last_seen_event_date.get(duplicate_key)
+            if last_date is not None and 0 <= (event["date"] - last_date).days <= DUPLICATE_TIME_WINDOW_DAYS:
+                last_seen_event_date[duplicate_key] = event["date"]
+                continue
+
+        ano = event["date"].year
+        average_price_before_event = valor_total_investido / total_quantity if total_quantity > epsilon else 0
+
+        if event_type == 'Compra':
+            if event["source"] == 'transaction' and quantity > 0 and event["value"] is not None and event["value"] >= 0:
+                total_quantity += quantity
+                valor_total_investido += event["value"]
+
+        elif event_type == NEG_TYPE_SELL or event_type == EVENT_FRACTION:
+            expected_source = 'transaction' if event_type == NEG_TYPE_SELL else 'movement'
+            if event["source"] == expected_source and quantity > 0:
+                if total_quantity >= quantity - epsilon:
+                    valor_total_investido -= quantity * average_price_before_event
+                    total_quantity -= quantity
+                else:
+                    valor_total_investido = 0
+                    total_quantity = 0
+
+                if total_quantity < epsilon:
+                    total_quantity = 0
+                    valor_total_investido = 0
+
+        elif event_type in BONUS_EVENT_TYPES:
+            if event["source"] == 'movement' and quantity > 0:
+                total_quantity += quantity
+
+        elif event_type in SPLIT_EVENT_TYPES:
+            if event["source"] == 'movement' and event["factor"] is not None and event["factor"] > 1:
+                total_quantity *= event["factor"]
+
+        elif event_type == EVENT_REVERSE_SPLIT:
+            if event["source"] == 'movement' and event["factor"] is not None and event["factor"] > 1:
+                total_quantity /= event["factor"]
+
+        elif event_type in AVERAGE_PRICE_EVENT_TYPES:
+            if event["source"] == 'movement' and quantity > 0:
+                average_price = get_static_event_average_price(event["assetCode"], event_type, event["date"]) if event["assetCode"] else None
+                # Without a known price the template only logs the event, the position is unchanged
+                if average_price is not None and average_price > 0:
+                    total_quantity += quantity
+                    valor_total_investido += quantity * average_price
+
+        preco_medio_atual = valor_total_investido / total_quantity if total_quantity > epsilon else 0
+
+        if -epsilon < valor_total_investido < 0:
+            valor_total_investido = 0
+
+        if total_quantity < epsilon:
+            total_quantity = 0
+            valor_total_investido = 0
+
+        resumo_anual[ano] = {
+            "ano": ano,
+            "quantidadeFinal": total_quantity,
+            "precoMedio": preco_medio_atual,
+            "totalInvestido": valor_total_investido,
+        }
+
+        if duplicate_key is not None:
+            last_seen_event_date[duplicate_key] = event["date"]
+
+    return _fill_year_gaps(resumo_anual, current_year)
+
+def _fill_year_gaps(resumo_anual: dict, current_year: int = None) -> list:
+    # Step 4 of the template: replicate the last known year forward up to the current year
+    if not resumo_anual:
+        return []
+
+    final_year = max(max(resumo_anual), current_year or date.today().year)
+    last_summary = None
+    for ano in range(min(resumo_anual), final_year + 1):
+        if ano in resumo_anual:
+            last_summary = resumo_anual[ano]
+        elif last_summary:
+            resumo_anual[ano] = {**last_summary, "ano": ano}
+
+    return [resumo_anual[ano] for ano in sorted(resumo_anual)]
+
+def compute_reference_summaries(fragmented_data: dict, current_year: int = None) -> dict:
+    """Runs the reference engine for every ticker of fragment_data's output in a single pass."""
+    return {
+        ticker: calcular_resumo_anual_com_eventos(
+            ticker_records(fragmented_data, ticker, "transactions"), ticker_records(fragmented_data, ticker, "movements"),
+            ticker, current_year
+        )
+        for ticker in fragmented_data
+    }
+
+def select_active_tickers(fragmented_data: FragmentedData, declaration_years: tuple) -> list:
+    """
+    The tickers whose generated tests check something in one of declaration_years: a record
+    dated in one of them (trades, events or income) or a non-zero closing position at the end
+    of one of them or of the year before (Bens e Direitos reports both). Needs the activity
+    index of fragment_data(..., activity=True). Only tickers without records in those years
+    replay their events through the reference engine, to find their closing positions.
+    """
+    years = set(declaration_years)
+    position_years = years | {year - 1 for year in years}
+    active = []
+    for ticker in fragmented_data:
+        ticker_activity = fragmented_data.activity.get(ticker)
+        if ticker_activity is not None and not years.isdisjoint(ticker_activity.record_years):
+            active.append(ticker)
+            continue
+
+        summaries = calcular_resumo_anual_com_eventos(
+            ticker_records(fragmented_data, ticker, "transactions"), ticker_records(fragmented_data, ticker, "movements"),
+            ticker, max(declaration_years)
+        )
+        if any(summary["ano"] in position_years and summary["quantidadeFinal"] > 0 for summary in summaries):
+            active.append(ticker)
+    return active
+
+def save_reference_summaries(summaries: dict, output_file: str):
+    """Saves the ticker -> ResumoAnual list map produced by compute_reference_summaries (or another JSON report)."""
+    output_path = Path(output_file)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(summaries, f, indent=2, ensure_ascii=False)
+
+
+def calcular_resumo_anual(transacoes: list, current_year: int = None) -> list:
+    """
+    Python counterpart of calcularResumoAnual: the simple Compra/Venda average-cost
+    position per year, without special events.
+    """
+    epsilon = CALCULATION_EPSILON
+    total_quantidade = 0
+    valor_total_investido = 0.0
+    resumo_anual = {}
+
+    # Sort by date, invalid dates last (same comparator as the template)
+    parsed = [(*negotiation_fields(t), t) for t in transacoes]
+    parsed.sort(key=lambda item: (item[0] is None, item[0] or date.min))
+
+    for date_object, quantidade, valor, transacao in parsed:
+        tipo = transacao.get(FIELD_NEG_TYPE)
+
+        if not date_object or quantidade <= 0 or valor < 0:
+            continue
+
+        if tipo == 'Compra':
+            total_quantidade += quantidade
+            valor_total_investido += valor
+        elif tipo == NEG_TYPE_SELL and total_quantidade > 0:
+            custo_medio_antes_venda = valor_total_investido / total_quantidade
+            quantidade_real_vendida = min(quantidade, total_quantidade)
+            valor_total_investido -= quantidade_real_vendida * custo_medio_antes_venda
+            total_quantidade -= quantidade_real_vendida
+
+            if total_quantidade < epsilon:
+                total_quantidade = 0
+                valor_total_investido = 0
+
+        resumo_anual[date_object.year] = {
+            "ano": date_object.year,
+            "quantidadeFinal": total_quantidade,
+            "precoMedio": valor_total_investido / total_quantidade if total_quantidade > epsilon else 0,
+            "totalInvestido": valor_total_investido,
+        }
+
+    return _fill_open_position_years(resumo_anual, current_year)
+
+def calcular_vendas_dos_anos(transacoes: list, anos) -> dict:
+    """
+    Python counterpart of calcularVendasDoAno for several years in a single pass: year -> the
+    Venda total of each month, in order of each month's first sale. The generated tests call
+    it after calcularResumoAnual sorted the transactions in place, so they are taken in that date order.
+    """
+    parsed = [(*negotiation_fields(t), t) for t in transacoes]
+    parsed.sort(key=lambda item: (item[0] is None, item[0] or date.min))
+
+    monthly_totals = {ano: {} for ano in anos}
+    for date_object, _, valor, transacao in parsed:
+        if transacao.get(FIELD_NEG_TYPE) == NEG_TYPE_SELL and date_object and date_object.year in monthly_totals:
+            totals = monthly_totals[date_object.year]
+            totals[date_object.month] = totals.get(date_object.month, 0) + valor
+    return {ano: [{"month": month, "total": total} for month, total in totals.items()] for ano, totals in monthly_totals.items()}
+
+def somar_rendimentos_dos_anos(movimentos: list, anos) -> dict:
+    """
+    Python counterpart of the dividend, JCP and income totals of the Jest test template (and of
+    somarMovimentosDoAno) for several years in a single pass: year -> the summed Valor da
+    Operação of its "dividendos", "jcp" and "rendimentos" movements.
+    """
+    totals = {ano: {"dividendos": 0, "jcp": 0, "rendimentos": 0} for ano in anos}
+    for movimento in movimentos:
+        tipo = movimento.get(FIELD_MOV_TYPE)
+        if not isinstance(tipo, str):
+            continue
+        if tipo.startswith(MOV_TYPE_DIVIDEND):
+            field = "dividendos"
+        elif tipo == MOV_TYPE_JCP:
+            field = "jcp"
+        elif tipo.startswith(MOV_TYPE_FII_INCOME):
+            field = "rendimentos"
+        else:
+            continue
+
+        event_date = movement_fields(movimento)[0]
+        if event_date and event_date.year in totals:
+            totals[event_date.year][field] += parse_float_safe(movimento.get(FIELD_MOV_TOTAL_COST))
+    return totals
+
+def _fill_open_position_years(resumo_anual: dict, current_year: int = None) -> list:
+    # Unlike the events version, only positions still open are replicated to later years
+    if not resumo_anual:
+        return []
+
+    final_year = max(max(resumo_anual), current_year or date.today().year)
+    last_summary = None
+    for ano in range(min(resumo_anual), final_year + 1):
+        if ano in resumo_anual:
+            last_summary = resumo_anual[ano]
+        elif last_summary and last_summary["quantidadeFinal"] > CALCULATION_EPSILON:
+            resumo_anual[ano] = {**last_summary, "ano": ano}
+        else:
+            last_summary = None
+
+    return [resumo_anual[ano] for ano in sorted(resumo_anual)]
+
+def negotiation_unit_price(transacao) -> float:
+    """Preço of a negociação record; read from the parsed slots of a NegotiationRecord when its centavos are exact."""
+    if type(transacao) is NegotiationRecord and transacao.is_exact(FIELD_NEG_UNIT_PRICE):
+        return transacao.unit_price_cents / 100
+    return parse_float_safe(transacao.get(FIELD_NEG_UNIT_PRICE))
+
+def calcular_resultados_fifo(transacoes: list, anos=None, resumo_com_eventos: list = None) -> dict:
+    """
+    Python counterpart of AssetProcessor.calculateTradeResults for several years: year -> the
+    FIFO result of each Venda of that year (of every year with sales if anos is None), in date
+    order. As in AssetProcessor, only the sales of the year consume the buy lots, so the lots
+    left by earlier years' sales are not taken out, and a partly sold lot keeps its full Valor
+    while its quantity goes down, so its cost per unit rises with every partial sale. Only Compra
+    records with a positive quantity open a lot. The exports have no fees, so a trade's net value
+    is its Valor. A sale larger than the queue costs its remainder at the year-end precoMedio of
+    resumo_com_eventos, like AssetProcessor's fallback to the position's average price.
+
+    All years come from one pass over the sorted history: the buy lots are appended once, with
+    running totals of their quantities and values, and each year's FIFO queue is only the
+    quantity its sales consumed so far. A sale finds the lots it takes by bisecting the running
+    quantities, and lots it takes whole cost their full Valor, so each sale is O(log n) however
+    many years are matched and however many lots it spans.
+    """
+    average_prices = {resumo["ano"]: resumo["precoMedio"] for resumo in resumo_com_eventos or ()}
+
+    # Same order as AssetProcessor's stable sort by date; records without a valid date are left out
+    parsed = [(*negotiation_fields(t), t) for t in transacoes]
+    parsed = sorted((item for item in parsed if item[0]), key=lambda item: item[0])
+    if anos is None:
+        anos = sorted({item[0].year for item in parsed if item[3].get(FIELD_NEG_TYPE) == NEG_TYPE_SELL})
+
+    results = {ano: [] for ano in anos}
+    if not results:
+        return results
+    last_year = max(results)
+
+    lot_quantities, lot_values = [], [] # Quantity and net value of each buy, oldest first
+    # Totals of the lots before each lot; values as whole centavos plus the float remainder of
+    # each Valor, so subtracting two large totals leaves no cancellation error
+    cumulative_quantities, cumulative_cents, cumulative_remainders = [0], [0], [0.0]
+    consumed_year, consumed = None, 0 # Quantity the sales of consumed_year took from the front of the lots
+
+    for date_object, quantidade, valor, transacao in parsed:
+        if date_object.year > last_year:
+            break
+        tipo = transacao.get(FIELD_NEG_TYPE)
+        if tipo != NEG_TYPE_SELL:
+            if tipo == 'Compra' and quantidade > 0:
+                lot_quantities.append(quantidade)
+                lot_values.append(valor)
+                cumulative_quantities.append(cumulative_quantities[-1] + quantidade)
+                centavos = round(valor * 100)
+                cumulative_cents.append(cumulative_cents[-1] + centavos)
+                cumulative_remainders.append(cumulative_remainders[-1] + (valor - centavos / 100))
+            continue
+        sales = results.get(date_object.year)
+        if sales is None:
+            continue
+        if consumed_year != date_object.year:
+            consumed_year, consumed = date_object.year, 0 # Every year's sales start from the oldest lot
+
+        custo = 0.0
+        available = cumulative_quantities[-1]
+        if consumed < available and quantidade > 0:
+            head = bisect_right(cumulative_quantities, consumed) - 1 # Lot being consumed
+            head_remaining = cumulative_quantities[head + 1] - consumed
+            if quantidade < head_remaining:
+                custo = quantidade * (lot_values[head] / head_remaining)
+            else:
+                end = min(consumed + quantidade, available)
+                tail = bisect_right(cumulative_quantities, end) - 1 # Lot the sale stops in, if any is left of it
+                custo = lot_values[head] + (
+                    (cumulative_cents[tail] - cumulative_cents[head + 1]) / 100
+                    + (cumulative_remainders[tail] - cumulative_remainders[head + 1])
+                )
+                if tail < len(lot_quantities) and end > cumulative_quantities[tail]:
+                    custo += (end - cumulative_quantities[tail]) * (lot_values[tail] / lot_quantities[tail])
+        matched = min(quantidade, available - consumed) if quantidade > 0 and consumed < available else 0
+        consumed += matched
+
+        unmatched = quantidade - matched if quantidade > matched else 0
+        custo += unmatched * average_prices.get(date_object.year, 0)
+        sales.append({
+            "date": date_object.isoformat(),
+            "month": date_object.month,
+            "quantity": quantidade,
+            "purchasePrice": custo / quantidade if quantidade > 0 else 0,
+            "purchaseCost": custo,
+            "salePrice": negotiation_unit_price(transacao),
+            "saleValue": valor,
+            "profitOrLoss": valor - custo,
+            "unmatchedQuantity": unmatched,
+        })
+    return results
+
+def iter_fifo_trade_results(fragmented_data: dict, anos=None, current_year: int = None):
+    """Yields (ticker, transactions, calcular_resultados_fifo's output) for every ticker of fragment_data's output."""
+    for ticker in fragmented_data:
+        transactions = ticker_records(fragmented_data, ticker, "transactions")
+        summaries = calcular_resumo_anual_com_eventos(
+            transactions, ticker_records(fragmented_data, ticker, "movements"), ticker, current_year
+        )
+        yield ticker, transactions, calcular_resultados_fifo(transactions, anos, summaries)
+
+def compute_fifo_trade_results(fragmented_data: dict, declaration_years: tuple, current_year: int = None) -> dict:
+    """Runs calcular_resultados_fifo for every ticker of fragment_data's output: ticker -> year -> sale results."""
+    return {
+        ticker: {str(ano): sales for ano, sales in results.items()}
+        for ticker, _, results in iter_fifo_trade_results(fragmented_data, declaration_years, current_year)
+    }
+
+def asset_category(raw_ticker, market=None) -> str:
+    """Python counterpart of B3FileParser.determineAssetCategory ('HGLG11' -> FII, 'AAPL34' -> BDR...)."""
+    if not isinstance(raw_ticker, str) or not raw_ticker.strip():
+        return ASSET_CATEGORY_OTHER
+    asset_code = raw_ticker.split(' - ')[0].upper().strip()
+    asset_code = asset_code[:-1] if asset_code.endswith('F') else asset_code
+    normalized_market = market.strip().upper() if isinstance(market, str) else ''
+    if 'OPÇÃO' in normalized_market or 'OPTION' in normalized_market:
+        return ASSET_CATEGORY_OPTION
+    if asset_code.endswith('11') or 'FII' in asset_code:
+        return ASSET_CATEGORY_FII
+    if asset_code.endswith('11B') or 'ETF' in asset_code:
+        return ASSET_CATEGORY_ETF
+    if asset_code.endswith('34') or 'BDR' in asset_code:
+        return ASSET_CATEGORY_BDR
+    if 'DEB' in asset_code:
+        return ASSET_CATEGORY_DEBENTURE
+    return ASSET_CATEGORY_STOCK
+
+def ticker_asset_category(transactions: list) -> str:
+    """Category of a ticker's position: that of its first negociação, as AssetProcessor keeps it."""
+    dated = [(negotiation_fields(t)[0], t) for t in transactions]
+    dated = [item for item in dated if item[0]]
+    if not dated:
+        return ASSET_CATEGORY_OTHER
+    first = min(dated, key=lambda item: item[0])[1]
+    return asset_category(first.get(FIELD_NEG_TICKER), first.get(FIELD_NEG_MARKET_TYPE))
+
+def calcular_resultados_mensais(vendas: list) -> dict:
+    """
+    Monthly capital gains per asset category in a single pass: vendas are (asset category,
+    calcular_resultados_fifo sale) pairs in date order, of any number of years, and the result
+    is year -> that year's month entries. Sales are summed into (year, month, category)
+    accumulators in the order AssetProcessor.calculateMonthlyResults keys them, then each entry
+    is walked in (year, month) order:
+    - a month's stock sales up to STOCK_SALES_EXEMPTION_LIMIT make its stock gains exempt (no tax due);
+    - a net loss is carried forward to the later months, across years, only within the stock and
+      FII categories, and offsets their later net gains, exempt or not.
+    Given one year's sales this is calculateMonthlyResults for that year's declaration.
+    The exports have no IRRF column, so nothing is withheld and the tax to pay is the tax due.
+    """
+    months = {} # (year, month, category) -> [sales, profit, loss, number of sales]
+    stock_sales = {} # (year, month) -> total of the stock sales
+    for category, sale in vendas:
+        year_month = (int(sale["date"][:4]), sale["month"])
+        accumulator = months.setdefault((*year_month, category), [0.0, 0.0, 0.0, 0])
+        accumulator[0] += sale["saleValue"]
+        if sale["profitOrLoss"] > 0:
+            accumulator[1] += sale["profitOrLoss"]
+        else:
+            accumulator[2] -= sale["profitOrLoss"]
+        accumulator[3] += 1
+        if category == ASSET_CATEGORY_STOCK:
+            stock_sales[year_month] = stock_sales.get(year_month, 0) + sale["saleValue"]
+
+    remaining_losses = dict.fromkeys(LOSS_CARRYING_CATEGORIES, 0) # category -> loss still to offset
+    resultados = {}
+    for (ano, month, category), (sales, profit, loss, trades) in sorted(months.items(), key=lambda item: item[0][:2]):
+        net_result = profit - loss
+        remaining_loss = remaining_losses.get(category, 0)
+        compensated_loss = 0
+        if net_result > 0 and remaining_loss > 0:
+            compensated_loss = min(net_result, remaining_loss)
+            remaining_loss -= compensated_loss
+        elif net_result < 0:
+            remaining_loss -= net_result
+        if category in remaining_losses:
+            remaining_losses[category] = remaining_loss
+        else:
+            remaining_loss = 0
+
+        taxable_profit = max(0, net_result - compensated_loss)
+        is_exempt = category == ASSET_CATEGORY_STOCK and stock_sales.get((ano, month), 0) <= STOCK_SALES_EXEMPTION_LIMIT
+        tax_rate = CAPITAL_GAINS_TAX_RATES.get(category, DEFAULT_CAPITAL_GAINS_TAX_RATE)
+        tax_due = taxable_profit * tax_rate if taxable_profit > 0 and not is_exempt else 0
+        resultados.setdefault(ano, []).append({
+            "month": month,
+            "assetCategory": category,
+            "trades": trades,
+            "totalSalesValue": sales,
+            "totalProfit": profit,
+            "totalLoss": loss,
+            "netResult": net_result,
+            "isExempt": is_exempt,
+            "compensatedLoss": compensated_loss,
+            "taxableProfit": taxable_profit,
+            "taxRate": tax_rate,
+            "taxDue": tax_due,
+            "taxWithheld": 0,
+            "taxToPay": tax_due,
+            "remainingLoss": remaining_loss,
+        })
+    return resultados
+
+def compute_capital_gains_ledger(fragmented_data: dict, declaration_years: tuple = None, current_year: int = None) -> dict:
+    """
+    Monthly capital gains ledger per asset category over the whole history: year -> the months
+    of each declaration year (of every year with sales if declaration_years is None). The FIFO
+    results of every sale of every ticker are computed once and walked by calcular_resultados_mensais
+    in one pass, so the stock and FII losses of earlier years are still offset in later ones.
+    """
+    sales = []
+    for ticker, transactions, results in iter_fifo_trade_results(fragmented_data, None, current_year):
+        if not results:
+            continue
+        category = ticker_asset_category(transactions)
+        sales.extend((sale["date"], category, sale) for ano_sales in results.values() for sale in ano_sales)
+
+    # AssetProcessor sorts the trade results of all tickers by date, keeping the ticker order on ties
+    sales.sort(key=lambda item: item[0])
+    ledger = calcular_resultados_mensais([(category, sale) for _, category, sale in sales])
+    anos = sorted(ledger) if declaration_years is None else declaration_years
+    return {str(ano): ledger.get(ano, []) for ano in anos}
+
+def negotiation_fields_cents(transacao) -> tuple:
+    """negotiation_fields with the value as an integer amount of centavos."""
+    if type(transacao) is NegotiationRecord:
+        return date_from_ordinal(transacao.date_ordinal), transacao.quantity, transacao.value_cents
+    event_date, quantity, value = negotiation_fields(transacao)
+    return event_date, quantity, round(value * 100)
+
+def _div_round_half_even(numerator: int, denominator: int) -> int:
+    # numerator / denominator rounded to the nearest integer, ties to even (banker's rounding)
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+def calcular_resumo_anual_centavos(transacoes: list, current_year: int = None) -> list:
+    """
+    calcular_resumo_anual in exact integer arithmetic: quantities are ints and the invested
+    cost is a reduced fraction of centavos (numerator, denominator), so no epsilon clamps are
+    needed and a Venda keeps exactly cost * remaining / held of the cost. Nothing is rounded
+    while accumulating; "totalInvestidoCentavos" is the exact cost rounded half-even for
+    display and "totalInvestidoCentavosExato" the unrounded [numerator, denominator].
+    """
+    total_quantidade = 0
+    custo_numerador, custo_denominador = 0, 1
+    resumo_anual = {}
+
+    parsed = [(*negotiation_fields_cents(t), t) for t in transacoes]
+    parsed.sort(key=lambda item: (item[0] is None, item[0] or date.min))
+
+    for date_object, quantidade, centavos, transacao in parsed:
+        tipo = transacao.get(FIELD_NEG_TYPE)
+
+        if not date_object or quantidade <= 0 or centavos < 0:
+            continue
+
+        if tipo == 'Compra':
+            total_quantidade += quantidade
+            custo_numerador += centavos * custo_denominador
+        elif tipo == NEG_TYPE_SELL and total_quantidade > 0:
+            remaining = total_quantidade - min(quantidade, total_quantidade)
+            custo_numerador *= remaining
+            custo_denominador *= total_quantidade
+            divisor = gcd(custo_numerador, custo_denominador)
+            custo_numerador //= divisor
+            custo_denominador //= divisor
+            total_quantidade = remaining
+
+        resumo_anual[date_object.year] = {
+            "ano": date_object.year,
+            "quantidadeFinal": total_quantidade,
+            "precoMedio": custo_numerador / (custo_denominador * total_quantidade) / 100 if total_quantidade else 0,
+            "totalInvestido": custo_numerador / custo_denominador / 100,
+            "totalInvestidoCentavos": _div_round_half_even(custo_numerador, custo_denominador),
+            "totalInvestidoCentavosExato": [custo_numerador, custo_denominador],
+        }
+
+    return _fill_open_position_years(resumo_anual, current_year)
+
+def compute_exact_summaries(fragmented_data: dict, current_year: int = None) -> dict:
+    """calcular_resumo_anual_centavos for every ticker of fragment_data's output."""
+    return {
+        ticker: calcular_resumo_anual_centavos(ticker_records(fragmented_data, ticker, "transactions"), current_year)
+        for ticker in fragmented_data
+    }
+
+def centavo_drift_report(float_summaries: dict, exact_summaries: dict) -> list:
+    """
+    Ticker-years where the float engine's year-end cost is half a centavo or more away from
+    the exact, unrounded cost (or where the quantities differ, e.g. after an epsilon clamp).
+    driftCentavos is float - exact, computed without rounding either side.
+    """
+    report = []
+    for ticker, exact_list in exact_summaries.items():
+        float_by_year = {summary["ano"]: summary for summary in float_summaries.get(ticker, [])}
+        for exact in exact_list:
+            approximate = float_by_year.get(exact["ano"])
+            if approximate is None:
+                continue
+            numerador, denominador = exact["totalInvestidoCentavosExato"]
+            drift = float(Fraction(approximate["totalInvestido"]) * 100 - Fraction(numerador, denominador))
+            if abs(drift) >= 0.5 or approximate["quantidadeFinal"] != exact["quantidadeFinal"]:
+                report.append({
+                    "ticker": ticker,
+                    "ano": exact["ano"],
+                    "quantidadeFinal": exact["quantidadeFinal"],
+                    "totalInvestido": approximate["totalInvestido"],
+                    "totalInvestidoCentavos": exact["totalInvestidoCentavos"],
+                    "totalInvestidoCentavosExato": exact["totalInvestidoCentavosExato"],
+                    "driftCentavos": drift,
+                })
+    return report
+
+def build_negotiation_columns(fragmented_data: dict) -> dict:
+    """
+    Parses every valid negociação row of fragment_data's output once into columnar
+    NumPy arrays: ticker id, date ordinal, year, signed quantity, value and side
+    (1 = Compra, -1 = Venda, 0 = other types, which only mark the year as active).
+    """
+    tickers = list(fragmented_data)
+    ticker_ids, ordinals, years, quantities, values, sides = [], [], [], [], [], []
+    parsed_dates = {} # A few thousand distinct dates repeat across all rows
+
+    for ticker_id, ticker in enumerate(tickers):
+        for transacao in ticker_records(fragmented_data, ticker, "transactions"):
+            if type(transacao) is NegotiationRecord:
+                date_object, quantidade, valor = negotiation_fields(transacao)
+            else:
+                date_string = transacao.get(FIELD_NEG_DATE)
+                try:
+                    date_object = parsed_dates[date_string]
+                except (KeyError, TypeError):
+                    date_object = parse_br_date(date_string)
+                    if isinstance(date_string, str):
+                        parsed_dates[date_string] = date_object
+                quantidade = parse_int_safe(transacao.get(FIELD_NEG_QUANTITY))
+                valor = parse_float_safe(transacao.get(FIELD_NEG_TOTAL_COST))
+            if not date_object or quantidade <= 0 or valor < 0:
+                continue
+
+            tipo = transacao.get(FIELD_NEG_TYPE)
+            side = 1 if tipo == 'Compra' else -1 if tipo == NEG_TYPE_SELL else 0
+            ticker_ids.append(ticker_id)
+            ordinals.append(date_object.toordinal())
+            years.append(date_object.year)
+            quantities.append(side * quantidade)
+            values.append(valor)
+            sides.append(side)
+
+    return {
+        "tickers": tickers,
+        "ticker_id": np.array(ticker_ids, dtype=np.int64),
+        "date_ordinal": np.array(ordinals, dtype=np.int64),
+        "year": np.array(years, dtype=np.int64),
+        "signed_quantity": np.array(quantities, dtype=np.int64),
+        "value": np.array(values, dtype=np.float64),
+        "side": np.array(sides, dtype=np.int8),
+    }
+
+def _segmented_affine_scan(multipliers, offsets, segment_starts):
+    # Inclusive scan of x_i = a_i * x_(i-1) + b_i restarting at every segment start
+    # (Hillis-Steele doubling: log2(n) vectorized steps instead of a per-row loop)
+    a = multipliers.copy()
+    b = offsets.copy()
+    n = len(a)
+    segment = np.cumsum(segment_starts)
+    step = 1
+    while step < n:
+        same_segment = segment[step:] == segment[:-step]
+        prev_a, prev_b = a[:-step], b[:-step]
+        new_a = np.where(same_segment, a[step:] * prev_a, a[step:])
+        new_b = np.where(same_segment, a[step:] * prev_b + b[step:], b[step:])
+        a[step:], b[step:] = new_a, new_b
+        step *= 2
+    return b
+
+def negotiation_columns_from_table(table: dict) -> dict:
+    """
+    Same columns as build_negotiation_columns, taken from the typed columns of a cached
+    negociação export table (see load_cached_export_table) without parsing any string.
+    """
+    meta = table["meta"]
+    tickers = meta["tickers"]
+    quantity = table["quantity"]
+    value = table["value"]
+
+    valid = (table["date_ordinal"] > 0) & (quantity > 0) & (value >= 0)
+    if 'UNKNOWN' in tickers:
+        valid &= table["ticker_id"] != tickers.index('UNKNOWN')
+
+    side_by_type = np.array(
+        [1 if event_type == 'Compra' else -1 if event_type == NEG_TYPE_SELL else 0 for event_type in meta["event_types"]],
+        dtype=np.int8
+    )
+    side = side_by_type[table["event_type_id"][valid]] if len(side_by_type) else np.zeros(0, dtype=np.int8)
+    date_ordinal = table["date_ordinal"][valid].astype(np.int64)
+    epoch_ordinal = date(1970, 1, 1).toordinal()
+
+    return {
+        "tickers": tickers,
+        "ticker_id": table["ticker_id"][valid].astype(np.int64),
+        "date_ordinal": date_ordinal,
+        "year": (date_ordinal - epoch_ordinal).astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970,
+        "signed_quantity": side * quantity[valid].astype(np.int64),
+        "value": value[valid],
+        "side": side,
+    }
+
+def compute_simple_summaries_vectorized(fragmented_data: dict, current_year: int = None, columns: dict = None) -> dict:
+    """
+    Vectorized calcular_resumo_anual for every ticker at once.
+    The running quantity is a group-wise cumulative sum floored at zero (sells are capped at
+    the held quantity), and the invested cost, which sells reduce proportionally
+    (cost *= remaining / held), is a segmented scan of affine updates.
+    Matches the per-ticker loop within CALCULATION_EPSILON.
+    Pass columns (e.g. from negotiation_columns_from_table) to skip parsing the records.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for the vectorized engine (pip install numpy)")
+
+    if columns is None:
+        columns = build_negotiation_columns(fragmented_data)
+    tickers = columns["tickers"]
+    summaries = {ticker: [] for ticker in fragmented_data}
+    if len(columns["ticker_id"]) == 0:
+        return summaries
+
+    # Chronological order per ticker; lexsort is stable, so same-day rows keep input order
+    order = np.lexsort((columns["date_ordinal"], columns["ticker_id"]))
+    ticker_id = columns["ticker_id"][order]
+    year = columns["year"][order]
+    delta = columns["signed_quantity"][order]
+    value = columns["value"][order]
+    side = columns["side"][order]
+
+    n = len(order)
+    segment_starts = np.ones(n, dtype=np.int64)
+    segment_starts[1:] = ticker_id[1:] != ticker_id[:-1]
+    start_index = np.maximum.accumulate(np.where(segment_starts == 1, np.arange(n), 0))
+
+    # Quantity: q_t = max(q_(t-1) + delta_t, 0) == S_t - min(0, min_(k<=t) S_k), S being the per-ticker cumsum
+    cumulative = np.cumsum(delta)
+    before_segment = np.where(start_index > 0, cumulative[start_index - 1], 0)
+    running_sum = cumulative - before_segment
+    # Segmented running minimum: shift each segment below all previous ones, then undo the shift
+    segment_number = np.cumsum(segment_starts) - 1
+    shift = 2 * (int(np.abs(running_sum).max()) + 1)
+    running_min = np.minimum.accumulate(running_sum - segment_number * shift) + segment_number * shift
+    quantity = running_sum - np.minimum(running_min, 0)
+
+    previous_quantity = np.where(segment_starts == 1, 0, np.roll(quantity, 1))
+
+    # Cost: buys add their value, sells scale by remaining / held quantity (0 when fully sold)
+    multipliers = np.ones(n, dtype=np.float64)
+    offsets = np.where(side == 1, value, 0.0)
+    selling = (side == -1) & (previous_quantity > 0)
+    multipliers[selling] = quantity[selling] / previous_quantity[selling]
+    invested = _segmented_affine_scan(multipliers, offsets, segment_starts)
+    invested[quantity == 0] = 0.0
+
+    # Year-end snapshot: last row of each (ticker, year)
+    is_last = np.ones(n, dtype=bool)
+    is_last[:-1] = (ticker_id[1:] != ticker_id[:-1]) | (year[1:] != year[:-1])
+
+    # Dense ticker x year grid, forward-filling years without trades while the position is open
+    first_year = int(year.min())
+    final_year = max(int(year.max()), current_year or date.today().year)
+    width = final_year - first_year + 1
+    grid_shape = (len(tickers), width)
+    present = np.zeros(grid_shape, dtype=bool)
+    grid_quantity = np.zeros(grid_shape, dtype=np.int64)
+    grid_invested = np.zeros(grid_shape, dtype=np.float64)
+
+    rows, cols = ticker_id[is_last], year[is_last] - first_year
+    present[rows, cols] = True
+    grid_quantity[rows, cols] = quantity[is_last]
+    grid_invested[rows, cols] = invested[is_last]
+
+    column_index = np.broadcast_to(np.arange(width), grid_shape)
+    last_present = np.maximum.accumulate(np.where(present, column_index, -1), axis=1)
+    has_previous = last_present >= 0
+    source = np.where(has_previous, last_present, 0)
+    source_quantity = np.take_along_axis(grid_quantity, source, axis=1)
+    source_invested = np.take_along_axis(grid_invested, source, axis=1)
+
+    # Each ticker is replicated up to max(its last traded year, current year), like the template
+    ticker_last_column = np.full(len(tickers), -1, dtype=np.int64)
+    np.maximum.at(ticker_last_column, rows, cols)
+    end_column = np.maximum(ticker_last_column, (current_year or date.today().year) - first_year)
+    within_range = column_index <= end_column[:, None]
+
+    filled = present | (has_previous & (source_quantity > CALCULATION_EPSILON) & within_range)
+
+    for ticker_index, column in zip(*np.nonzero(filled)):
+        total_quantidade = int(source_quantity[ticker_index, column])
+        valor_total_investido = float(source_invested[ticker_index, column])
+        summaries.setdefault(tickers[ticker_index], []).append({
+            "ano": first_year + int(column),
+            "quantidadeFinal": total_quantidade,
+            "precoMedio": valor_total_investido / total_quantidade if total_quantidade > CALCULATION_EPSILON else 0,
+            "totalInvestido": valor_total_investido,
+        })
+
+    return summaries
+
+def compute_simple_summaries(fragmented_data: dict, current_year: int = None, negociacao_table: dict = None) -> dict:
+    """
+    calcular_resumo_anual for every ticker, vectorized with NumPy when it is installed.
+    With the cached negociação table, the typed columns are used instead of re-parsing the records.
+    """
+    if np is not None:
+        columns = negotiation_columns_from_table(negociacao_table) if negociacao_table is not None else None
+        return compute_simple_summaries_vectorized(fragmented_data, current_year, columns)
+    return {ticker: calcular_resumo_anual(ticker_records(fragmented_data, ticker, "transactions"), current_year) for ticker in fragmented_data}
+
+
+# --- Columnar Cache of Parsed Exports ---
+# A parsed, typed copy of each B3 export, keyed by the source file's SHA-256, so
+# repeated runs neither re-decode the JSON nor re-parse B3's string fields.
+
+def file_sha256(file_path: str) -> str:
+    """Hashes a file in fixed-size blocks (memoized per path, size and modification time)."""
+    stat = os.stat(file_path)
+    return _file_sha256_cached(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=32)
+def _file_sha256_cached(file_path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def build_export_table(records) -> dict:
+    """
+    Converts export records into a columnar table:
+    - every source field as categorical codes into a dictionary of JSON-encoded values
+      (-1 when the record lacks the field), plus each record's key layout, so the
+      original records can be rebuilt exactly;
+    - typed columns parsed once: date ordinal (0 if invalid), quantity, unit price, value;
+    - categorical ticker (normalized) and event type columns.
+    """
+    fields, field_index = [], {}
+    layouts, layout_index = [], {}
+    value_dictionaries, value_indexes, codes = [], [], []
+    layout_codes = []
+    kind = None
+    tickers, ticker_index, ticker_ids = [], {}, []
+    event_types, event_type_index, event_type_ids = [], {}, []
+    date_ordinals, quantities, unit_prices, values = [], [], [], []
+    rows = 0
+
+    for record in records:
+        if kind is None:
+            kind = 'negociacao' if FIELD_NEG_TICKER in record else 'movimentacao'
+            ticker_field, date_field, type_field, price_field, value_field = (
+                (FIELD_NEG_TICKER, FIELD_NEG_DATE, FIELD_NEG_TYPE, FIELD_NEG_UNIT_PRICE, FIELD_NEG_TOTAL_COST)
+                if kind == 'negociacao' else
+                (FIELD_MOV_TICKER, FIELD_MOV_DATE, FIELD_MOV_TYPE, FIELD_MOV_UNIT_PRICE, FIELD_MOV_TOTAL_COST)
+            )
+
+        layout = []
+        for field, value in record.items():
+            if field not in field_index:
+                field_index[field] = len(fields)
+                fields.append(field)
+                value_dictionaries.append([])
+                value_indexes.append({})
+                codes.append([-1] * rows)
+            position = field_index[field]
+            layout.append(position)
+
+            # Keyed by type too, so 1, 1.0 and True stay distinct; only new values are JSON-encoded
+            value_key = (type(value), value) if isinstance(value, (str, int, float, type(None))) else json.dumps(value, ensure_ascii=False)
+            code = value_indexes[position].get(value_key)
+            if code is None:
+                code = value_indexes[position][value_key] = len(value_dictionaries[position])
+                value_dictionaries[position].append(json.dumps(value, ensure_ascii=False))
+            codes[position].append(code)
+
+        for position in range(len(fields)):
+            if len(codes[position]) == rows:
+                codes[position].append(-1) # Field missing from this record
+
+        layout = tuple(layout)
+        if layout not in layout_index:
+            layout_index[layout] = len(layouts)
+            layouts.append(list(layout))
+        layout_codes.append(layout_index[layout])
+
+        raw_ticker = record.get(ticker_field)
+        ticker = normalize_ticker(raw_ticker) if raw_ticker else 'UNKNOWN'
+        if ticker not in ticker_index:
+            ticker_index[ticker] = len(tickers)
+            tickers.append(ticker)
+        ticker_ids.append(ticker_index[ticker])
+
+        event_type = record.get(type_field)
+        if event_type not in event_type_index:
+            event_type_index[event_type] = len(event_types)
+            event_types.append(event_type)
+        event_type_ids.append(event_type_index[event_type])
+
+        parsed_date = parse_br_date(record.get(date_field))
+        date_ordinals.append(parsed_date.toordinal() if parsed_date else 0)
+        quantities.append(
+            parse_int_safe(record.get(FIELD_NEG_QUANTITY)) if kind == 'negociacao' else parse_float_safe(record.get(FIELD_MOV_QUANTITY))
+        )
+        unit_prices.append(parse_float_safe(record.get(price_field)))
+        values.append(parse_float_safe(record.get(value_field)))
+        rows += 1
+
+    return {
+        "meta": {
+            "schema_version": EXPORT_CACHE_SCHEMA_VERSION,
+            "kind": kind,
+            "rows": rows,
+            "fields": fields,
+            "layouts": layouts,
+            "tickers": tickers,
+            "event_types": event_types,
+        },
+        "layout": np.array(layout_codes, dtype=np.int32),
+        "raw_codes": [np.array(column, dtype=np.int32) for column in codes],
+        "raw_values": value_dictionaries,
+        "ticker_id": np.array(ticker_ids, dtype=np.int32),
+        "event_type_id": np.array(event_type_ids, dtype=np.int32),
+        "date_ordinal": np.array(date_ordinals, dtype=np.int32),
+        "quantity": np.array(quantities, dtype=np.float64),
+        "unit_price": np.array(unit_prices, dtype=np.float64),
+        "value": np.array(values, dtype=np.float64),
+    }
+
+def iter_table_records(table: dict, compact: bool = False):
+    """
+    Rebuilds the original export records, in order, from a table built by build_export_table.
+    With compact=True they are built as NegotiationRecord/MovementRecord rows straight from
+    the columns: the parsed slots come from the typed columns and no text is parsed again.
+    """
+    meta = table["meta"]
+    fields = meta["fields"]
+    layouts = meta["layouts"]
+    record_class = NegotiationRecord if meta["kind"] == 'negociacao' else MovementRecord
+    parsed_fields = record_class.PARSED_FIELDS if compact else {}
+    slots = {}
+    if compact:
+        # np.rint rounds half to even like round(), so the centavos match parse_cents
+        quantity = table["quantity"].astype(np.int64) if record_class is NegotiationRecord else table["quantity"]
+        slots = {
+            "date_ordinal": table["date_ordinal"].tolist(),
+            "quantity": quantity.tolist(),
+            "unit_price_cents": np.rint(table["unit_price"] * 100).astype(np.int64).tolist(),
+            "value_cents": np.rint(table["value"] * 100).astype(np.int64).tolist(),
+        }
+
+    # Decode each distinct value once, then expand every column with C-level lookups
+    columns = []
+    for field, codes, dictionary in zip(fields, table["raw_codes"], table["raw_values"]):
+        decoded = json.loads(f"[{','.join(dictionary)}]") if dictionary else []
+        if field in parsed_fields:
+            # A compact row leaves out the texts its slot formats back exactly; the slot of a
+            # distinct text is the same on every row, so it is checked once on its first row
+            slot, formatter = parsed_fields[field]
+            values = slots[slot]
+            distinct_codes, first_rows = np.unique(codes, return_index=True)
+            for code, row in zip(distinct_codes.tolist(), first_rows.tolist()):
+                text = decoded[code] if code >= 0 else None
+                if isinstance(text, str) and formatter(values[row]) == text:
+                    decoded[code] = PARSED_TEXT
+        decoded.append(None) # Code -1 (missing) picks the extra slot
+        columns.append([decoded[code] for code in codes.tolist()])
+
+    layout_keys = [tuple(fields[position] for position in layout) for layout in layouts]
+    if len(layouts) == 1:
+        # Common case: every record has the same keys in the same order
+        layout_codes = repeat(0)
+        rows = zip(*(columns[position] for position in layouts[0]))
+    else:
+        layout_codes = table["layout"].tolist()
+        rows = (tuple(columns[position][row] for position in layouts[code]) for row, code in enumerate(layout_codes))
+
+    if not compact:
+        for code, values in zip(layout_codes, rows):
+            yield dict(zip(layout_keys[code], values))
+        return
+
+    layout_positions = [_record_layout(keys)[0] for keys in layout_keys]
+    for code, values, date_ordinal, quantity, unit_price_cents, value_cents in zip(
+        layout_codes, rows, slots["date_ordinal"], slots["quantity"], slots["unit_price_cents"], slots["value_cents"]
+    ):
+        row = record_class()
+        row._positions = layout_positions[code]
+        row._values = values
+        row.date_ordinal = date_ordinal
+        row.quantity = quantity
+        row.unit_price_cents = unit_price_cents
+        row.value_cents = value_cents
+        yield row
+
+def _export_cache_path(cache_dir: str, source_hash: str) -> Path:
+    extension = '.parquet' if pq is not None else '.npz'
+    return Path(cache_dir) / f"{source_hash}{extension}"
+
+def save_export_table(table: dict, cache_path: Path):
+    """Writes a table as Parquet when pyarrow is installed, otherwise as an uncompressed NumPy .npz."""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = cache_path.with_name(cache_path.name + '.tmp')
+
+    if cache_path.suffix == '.parquet':
+        columns = {"layout": pa.array(table["layout"])}
+        for position, (codes, dictionary) in enumerate(zip(table["raw_codes"], table["raw_values"])):
+            indices = pa.array(codes, mask=codes < 0)
+            columns[f"raw_{position}"] = pa.DictionaryArray.from_arrays(indices, pa.array(dictionary, type=pa.string()))
+        for name, dictionary in (("ticker_id", table["meta"]["tickers"]), ("event_type_id", table["meta"]["event_types"])):
+            # Parquet dictionaries cannot hold nulls; the exact values are kept in meta
+            labels = pa.array(['' if value is None else str(value) for value in dictionary], type=pa.string())
+            columns[name] = pa.DictionaryArray.from_arrays(pa.array(table[name]), labels)
+        for name in EXPORT_CACHE_NUMERIC_COLUMNS:
+            columns[name] = pa.array(table[name])
+        arrow_table = pa.table(columns).replace_schema_metadata({"meta": json.dumps(table["meta"], ensure_ascii=False)})
+        pq.write_table(arrow_table, temporary_path)
+    else:
+        arrays = {
+            "meta": np.array(json.dumps(table["meta"], ensure_ascii=False)),
+            "layout": table["layout"],
+            "ticker_id": table["ticker_id"],
+            "event_type_id": table["event_type_id"],
+        }
+        for position, (codes, dictionary) in enumerate(zip(table["raw_codes"], table["raw_values"])):
+            arrays[f"raw_codes_{position}"] = codes
+            arrays[f"raw_values_{position}"] = np.array(dictionary, dtype=str)
+        for name in EXPORT_CACHE_NUMERIC_COLUMNS:
+            arrays[name] = table[name]
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    os.replace(temporary_path, cache_path) # Never leave a half-written cache behind
+
+def load_export_table(cache_path: Path) -> dict:
+    """Reads a table written by save_export_table; returns None if it is unreadable or has another schema version."""
+    try:
+        if cache_path.suffix == '.parquet':
+            arrow_table = pq.read_table(cache_path)
+            meta = json.loads(arrow_table.schema.metadata[b"meta"])
+            if meta.get("schema_version") != EXPORT_CACHE_SCHEMA_VERSION:
+                return None
+            table = {"meta": meta, "layout": arrow_table.column("layout").to_numpy()}
+            table["raw_codes"], table["raw_values"] = [], []
+            for position in range(len(meta["fields"])):
+                column = arrow_table.column(f"raw_{position}").combine_chunks()
+                table["raw_codes"].append(column.indices.fill_null(-1).to_numpy().astype(np.int32))
+                table["raw_values"].append(column.dictionary.to_pylist())
+            for name in ("ticker_id", "event_type_id"):
+                table[name] = arrow_table.column(name).combine_chunks().indices.to_numpy().astype(np.int32)
+            for name in EXPORT_CACHE_NUMERIC_COLUMNS:
+                table[name] = arrow_table.column(name).to_numpy()
+            return table
+
+        with np.load(cache_path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            if meta.get("schema_version") != EXPORT_CACHE_SCHEMA_VERSION:
+                return None
+            table = {name: arrays[name] for name in ("layout", "ticker_id", "event_type_id", *EXPORT_CACHE_NUMERIC_COLUMNS)}
+            table["meta"] = meta
+            table["raw_codes"] = [arrays[f"raw_codes_{position}"] for position in range(len(meta["fields"]))]
+            table["raw_values"] = [arrays[f"raw_values_{position}"].tolist() for position in range(len(meta["fields"]))]
+            return table
+    except Exception as e:
+        print(f"Warning: Ignoring unreadable export cache {cache_path}: {e}")
+        return None
+
+def load_cached_export_table(file_path: str, cache_dir: str, stream: bool = False) -> dict:
+    """
+    Returns the parsed table of an export from cache_dir, building and caching it on a miss.
+    Tables from an older EXPORT_CACHE_SCHEMA_VERSION are rebuilt.
+    """
+    cache_path = _export_cache_path(cache_dir, file_sha256(file_path))
+    table = load_export_table(cache_path) if cache_path.is_file() else None
+    if table is None:
+        table = build_export_table(load_json_data(file_path, stream=stream))
+        save_export_table(table, cache_path)
+        print(f"Cached parsed export {file_path} at {cache_path}")
+    return table
+
+
+# --- Expected-Result Snapshots ---
+
+def build_expected_snapshot(ticker: str, transactions: list, movements: list, declaration_years: tuple, current_year: int = None) -> dict:
+    """
+    Every value the generated Jest test of a ticker expects, computed once by the reference
+    engine: both year-end summaries (every year up to current_year) and, for each declaration
+    year, the monthly sales, the FIFO result of each sale, the monthly capital gains of those
+    sales and the dividend, JCP and income totals, each in a single pass.
+    """
+    current_year = current_year or date.today().year
+    resumo_com_eventos = calcular_resumo_anual_com_eventos(transactions, movements, ticker, current_year)
+    sales = calcular_vendas_dos_anos(transactions, declaration_years)
+    fifo_results = calcular_resultados_fifo(transactions, declaration_years, resumo_com_eventos)
+    category = ticker_asset_category(transactions)
+    income = somar_rendimentos_dos_anos(movements, declaration_years)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "anosDeclaracao": list(declaration_years),
+        "anoAtual": current_year,
+        "resumoAnual": calcular_resumo_anual(transactions, current_year),
+        "resumoAnualComEventos": resumo_com_eventos,
+        "anos": {
+            str(ano): {
+                "vendasDoAno": sales[ano],
+                "resultadosFifo": fifo_results[ano],
+                "resultadosMensais": calcular_resultados_mensais([(category, sale) for sale in fifo_results[ano]]).get(ano, []),
+                **income[ano],
+            }
+            for ano in declaration_years
+        },
+    }
+
+def snapshot_file_name(ticker: str) -> str:
+    return f"{ticker}{SNAPSHOT_FILE_SUFFIX}"
+
+def save_expected_snapshot(ticker: str, data: dict, output_path: Path, declaration_years: tuple):
+    """Writes a ticker's expected-result snapshot as compact JSON next to its history files."""
+    snapshot = build_expected_snapshot(ticker, data["transactions"], data["movements"], declaration_years)
+    write_text_file(output_path / snapshot_file_name(ticker), json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')))
+
+
+# --- Per-Ticker Generation ---
+
+@lru_cache(maxsize=None)
+def template_version(layout: str = 'per-ticker', timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT,
+                     snapshots: bool = False, multi_year: bool = False) -> str:
+    """
+    Hash of the compiled templates a ticker's files come from: its test template (the suite
+    template in the consolidated layout) and the calculation helper. Any change to the
+    template texts or to the code deriving their variants regenerates every ticker.
+    """
+    if layout == 'consolidated':
+        compiled = jest_suite_compiled(history_format, snapshots, multi_year)
+    else:
+        compiled = jest_test_compiled(timeline, history_format, snapshots, multi_year)
+    digest = hashlib.sha256()
+    for template in (compiled, CALCULATION_HELPER_COMPILED):
+        digest.update(json.dumps([template.parts, template.slots], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+def ticker_content_digest(data: dict, history_dir_relative: str, declaration_years: tuple, layout: str = 'per-ticker',
+                          timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False) -> str:
+    """
+    Hashes everything a ticker's generated files depend on: its record slice, the
+    template version, the declaration years, the history import path, the test layout,
+    whether the timeline file is written, the history file format and, with snapshots,
+    the current year the snapshot's summaries run up to.
+    """
+    version = template_version(layout, timeline, history_format, snapshots, len(declaration_years) > 1)
+    digest = hashlib.sha256()
+    digest.update(f"{version}|{','.join(map(str, declaration_years))}|{history_dir_relative}|{layout}|".encode('utf-8'))
+    if timeline:
+        digest.update(b"timeline|")
+    if history_format != DEFAULT_HISTORY_FORMAT:
+        digest.update(f"{history_format}|".encode('utf-8'))
+    if snapshots:
+        digest.update(f"snapshots|{SNAPSHOT_VERSION}|{date.today().year}|".encode('utf-8'))
+    digest.update(json.dumps([data["transactions"], data["movements"]], ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return digest.hexdigest()
+
+def ticker_output_paths(ticker: str, history_dir: str, test_dir: str, layout: str = None, timeline: bool = None,
+                        history_format: str = None, snapshots: bool = None) -> list:
+    """
+    Returns every file generated for a ticker in the given layout, timeline mode, history
+    format and snapshot mode, or in any of them when left as None.
+    """
+    history_formats = [history_format] if history_format else HISTORY_FORMATS
+    kinds = [kind for kind in HISTORY_FILE_KINDS if kind != "timeline" or timeline is not False]
+    paths = list(dict.fromkeys(
+        Path(history_dir) / history_file_name(ticker, kind, history_format)
+        for history_format in history_formats
+        for kind in kinds
+    ))
+    if snapshots is not False:
+        paths.append(Path(history_dir) / snapshot_file_name(ticker))
+    if layout != 'consolidated':
+        paths.append(Path(test_dir) / f"{ticker}.test.ts")
+    return paths
+
+def manifest_path_for(history_dir: str) -> Path:
+    """The generation manifest is stored next to the history directory."""
+    history_path = Path(history_dir)
+    return history_path.with_name(f"{history_path.name}{MANIFEST_SUFFIX}")
+
+def load_generation_manifest(manifest_path: Path) -> dict:
+    """Loads the ticker -> content digest map of the previous run (empty if missing or outdated)."""
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"Warning: Could not read generation manifest {manifest_path}. Regenerating all asset groups.")
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("tickers", {})
+
+def save_generation_manifest(manifest_path: Path, digests: dict):
+    """Saves the ticker -> content digest map of the current run."""
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": MANIFEST_VERSION, "tickers": dict(sorted(digests.items()))}, f, indent=2)
+
+def delete_stale_ticker_files(tickers, history_dir: str, test_dir: str) -> int:
+    """Removes the generated files of tickers no longer present in the input. Returns how many tickers were removed."""
+    deleted = 0
+    for ticker in tickers:
+        for path in ticker_output_paths(ticker, history_dir, test_dir):
+            if path.is_file():
+                path.unlink()
+        deleted += 1
+    return deleted
+
+def generate_ticker_files(ticker: str, data: dict, history_dir: str, test_dir: str, history_dir_relative: str,
+                          declaration_years: tuple, previous_digest: str = None, layout: str = 'per-ticker', timeline: bool = False,
+                          history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False):
+    """
+    Writes every output of a single ticker (history files in history_format and optionally its
+    timeline and expected-result snapshot, plus the Jest test file in the per-ticker layout),
+    unless its content digest matches previous_digest and all files still exist. Files this
+    ticker had in another layout, timeline mode, history format or snapshot mode are removed.
+    Returns (ticker, status, digest, error message, stats) so one bad ticker does not abort the run;
+    stats holds the seconds spent and bytes written by the history and test file steps.
+    """
+    stats = dict.fromkeys(TICKER_STAT_FIELDS, 0)
+    try:
+        digest = ticker_content_digest(data, history_dir_relative, declaration_years, layout, timeline, history_format, snapshots)
+        output_paths = ticker_output_paths(ticker, history_dir, test_dir, layout, timeline, history_format, snapshots)
+        if digest == previous_digest and all(path.is_file() for path in output_paths):
+            return ticker, 'skipped', digest, None, stats
+
+        # E.g. a leftover test file would run a ticker covered by a consolidated suite twice
+        for path in set(ticker_output_paths(ticker, history_dir, test_dir)) - set(output_paths):
+            path.unlink(missing_ok=True)
+
+        start = time.perf_counter()
+        save_ticker_history_files(ticker, data, Path(history_dir), timeline, history_format)
+        stats["history_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+        if snapshots:
+            save_expected_snapshot(ticker, data, Path(history_dir), declaration_years)
+        if layout != 'consolidated':
+            generate_jest_test_file(ticker, test_dir, history_dir_relative, declaration_years, timeline, history_format, snapshots)
+        stats["test_seconds"] = time.perf_counter() - start
+
+        test_file = Path(test_dir) / f"{ticker}.test.ts"
+        for path in output_paths:
+            stats["test_bytes" if path == test_file else "history_bytes"] += path.stat().st_size
+        return ticker, 'written', digest, None, stats
+    except Exception as e:
+        return ticker, 'failed', None, f"{type(e).__name__}: {e}", stats
+
+def generate_all_ticker_files(fragmented_data: dict, history_dir: str, test_dir: str, history_dir_relative: str,
+                              declaration_years: tuple, jobs: int = 1, previous_digests: dict = None, layout: str = 'per-ticker',
+                              timeline: bool = False, history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False) -> dict:
+    """
+    Generates the outputs of every ticker, serially or over a process pool of `jobs` workers.
+    Each ticker writes only its own files, so the output is identical in both modes.
+    Tickers whose digest matches previous_digests are left untouched.
+    Returns the new digests, the failed (ticker, error) pairs, the written/skipped counts and
+    the summed per-ticker stats (see generate_ticker_files).
+    """
+    Path(history_dir).mkdir(parents=True, exist_ok=True)
+    Path(test_dir).mkdir(parents=True, exist_ok=True)
+
+    previous_digests = previous_digests or {}
+    total = len(fragmented_data)
+    result = {"digests": {}, "failures": [], "written": 0, "skipped": 0, "stats": dict.fromkeys(TICKER_STAT_FIELDS, 0)}
+
+    def report(done: int, ticker: str, status: str, digest: str, error, stats: dict):
+        for field, value in stats.items():
+            result["stats"][field] += value
+        if status == 'failed':
+            print(f"Error: [{done}/{total}] Failed to generate asset group {ticker}: {error}")
+            result["failures"].append((ticker, error))
+            return
+        result["digests"][ticker] = digest
+        result[status] += 1
+        if status == 'written':
+            print(f"Processing asset group: {ticker} [{done}/{total}]")
+
+    if jobs <= 1:
+        for done, (ticker, data) in enumerate(fragmented_data.items(), start=1):
+            report(done, *generate_ticker_files(
+                ticker, data, history_dir, test_dir, history_dir_relative, declaration_years, previous_digests.get(ticker), layout, timeline,
+                history_format, snapshots
+            ))
+    else:
+        # Tickers are copied and submitted lazily, at most JOBS_IN_FLIGHT_PER_WORKER per worker at a
+        # time, so only the tickers being generated are held in memory instead of the dataset twice
+        tickers = iter(fragmented_data)
+        pending = set()
+        done = 0
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                for ticker in tickers:
+                    pending.add(executor.submit(
+                        generate_ticker_files, ticker, fragmented_data[ticker], history_dir, test_dir, history_dir_relative,
+                        declaration_years, previous_digests.get(ticker), layout, timeline, history_format, snapshots
+                    ))
+                    if len(pending) >= jobs * JOBS_IN_FLIGHT_PER_WORKER:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done += 1
+                    report(done, *future.result())
+
+    result["failures"].sort()
+    return result
+
+
+# --- Consolidated Jest Suites ---
+
+def suite_file_path(test_dir: str, suite_index: int) -> Path:
+    return Path(test_dir) / ASSET_SUITE_FILE_GLOB.replace('*', str(suite_index))
+
+def balance_suites(weights: dict, suites: int) -> dict:
+    """
+    Bin-packs tickers into `suites` bins of similar total weight (longest processing time
+    first: heaviest ticker to the currently lightest bin). Returns ticker -> bin index.
+    """
+    bins = [(0, index) for index in range(suites)] # (load, index): ties go to the lowest index
+    assignment = {}
+    for ticker in sorted(weights, key=lambda ticker: (-weights[ticker], ticker)):
+        load, index = heapq.heappop(bins)
+        assignment[ticker] = index
+        heapq.heappush(bins, (load + weights[ticker], index))
+    return assignment
+
+def build_asset_manifest(fragmented_data: dict, history_dir_relative: str, declaration_years: tuple, suites: int = DEFAULT_SUITES,
+                         history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False) -> dict:
+    """
+    The manifest read by the consolidated suites: for every ticker, its suite, its history
+    files (relative to the test dir), its expected-result snapshot with snapshots=True and
+    the record counts the files must contain.
+    Tickers are balanced across the suites by record count (see balance_suites).
+    """
+    tickers = sorted(fragmented_data)
+    suites = max(1, min(suites, len(tickers)))
+    history_dir_relative_posix = history_dir_relative.replace('\\', '/')
+
+    counts = {}
+    for ticker in tickers:
+        if isinstance(fragmented_data, FragmentedData):
+            counts[ticker] = fragmented_data.record_counts(ticker)
+        else:
+            counts[ticker] = tuple(len(fragmented_data[ticker][kind]) for kind in ("transactions", "movements"))
+    weights = {ticker: SUITE_TICKER_BASE_WEIGHT + sum(counts[ticker]) for ticker in tickers}
+    assignment = balance_suites(weights, suites)
+
+    assets = []
+    for ticker in tickers:
+        transaction_count, movement_count = counts[ticker]
+        assets.append({
+            "ticker": ticker,
+            "suite": assignment[ticker],
+            "transactions": f"./{history_dir_relative_posix}/{history_file_name(ticker, 'transactions', history_format)}",
+            "movements": f"./{history_dir_relative_posix}/{history_file_name(ticker, 'movements', history_format)}",
+            "transactionCount": transaction_count,
+            "movementCount": movement_count,
+            "weight": weights[ticker],
+        })
+        if snapshots:
+            assets[-1]["expected"] = f"./{history_dir_relative_posix}/{snapshot_file_name(ticker)}"
+
+    years = {"declarationYear": declaration_years[0]} if len(declaration_years) == 1 else {"declarationYears": list(declaration_years)}
+    return {"version": MANIFEST_VERSION, **years, "suites": suites if assets else 0, "assets": assets}
+
+def jest_test_path(path, jest_root_dir: str) -> str:
+    """A test file's path relative to jest_root_dir, with forward slashes, as given to `react-scripts test <path>`."""
+    return os.path.relpath(Path(path).resolve(), Path(jest_root_dir).resolve()).replace('\\', '/')
+
+def build_shard_manifest(manifest: dict, test_dir: str, jest_root_dir: str) -> dict:
+    """
+    Per suite file: its path relative to jest_root_dir, the command that runs only that suite,
+    its total weight and its tickers. Each CI worker runs one suite's command; the repo's
+    react-scripts 5 runs Jest 27, which has no `--shard`, so the files are selected by path.
+    """
+    shards = []
+    for suite_index in range(manifest["suites"]):
+        suite_path = jest_test_path(suite_file_path(test_dir, suite_index), jest_root_dir)
+        tickers = [asset for asset in manifest["assets"] if asset["suite"] == suite_index]
+        shards.append({
+            "file": suite_path,
+            "command": f"{JEST_TEST_COMMAND} {suite_path}",
+            "weight": sum(asset["weight"] for asset in tickers),
+            "tickers": [asset["ticker"] for asset in tickers],
+        })
+
+    return {
+        "version": MANIFEST_VERSION,
+        "shards": manifest["suites"],
+        "command": f"{JEST_TEST_COMMAND} <file>",
+        "suites": shards,
+    }
+
+def generate_consolidated_suite_files(fragmented_data: dict, test_dir: str, history_dir_relative: str, declaration_years: tuple,
+                                      suites: int = DEFAULT_SUITES, jest_root_dir: str = None,
+                                      history_format: str = DEFAULT_HISTORY_FORMAT, snapshots: bool = False) -> int:
+    """
+    Writes the asset manifest and the describe.each suite files that replace the per-ticker
+    test files, so ts-jest boots a few modules instead of one per ticker, plus the shard
+    manifest listing each suite file's path (relative to jest_root_dir, the test dir's
+    parent by default) and the command that runs it alone.
+    Suite files of a previous run with more suites are removed. Returns the number of suites.
+    """
+    manifest = build_asset_manifest(fragmented_data, history_dir_relative, declaration_years, suites, history_format, snapshots)
+    write_text_file_if_changed(Path(test_dir) / ASSET_MANIFEST_FILE, json.dumps(manifest, indent=2, ensure_ascii=False))
+
+    shard_manifest = build_shard_manifest(manifest, test_dir, jest_root_dir or Path(test_dir).parent)
+    write_text_file_if_changed(Path(test_dir) / ASSET_SHARDS_FILE, json.dumps(shard_manifest, indent=2, ensure_ascii=False))
+
+    suite_paths = set()
+    for suite_index in range(manifest["suites"]):
+        suite_path = suite_file_path(test_dir, suite_index)
+        write_text_file_if_changed(suite_path, jest_suite_compiled(history_format, snapshots, len(declaration_years) > 1).render({
+            "suite_index": suite_index,
+            "manifest_file": ASSET_MANIFEST_FILE,
+            **declaration_year_values(declaration_years),
+        }))
+        suite_paths.add(suite_path)
+
+    for path in Path(test_dir).glob(ASSET_SUITE_FILE_GLOB):
+        if path not in suite_paths:
+            path.unlink()
+    return manifest["suites"]
+
+def delete_consolidated_suite_files(test_dir: str):
+    """Removes the manifests and suite files of a previous consolidated run."""
+    for path in [Path(test_dir) / ASSET_MANIFEST_FILE, Path(test_dir) / ASSET_SHARDS_FILE, *Path(test_dir).glob(ASSET_SUITE_FILE_GLOB)]:
+        path.unlink(missing_ok=True)
+
+
+# --- Pipeline Metrics ---
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory of this process or its largest finished worker process, or None where unsupported."""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+def cpu_seconds() -> float:
+    """CPU time of this process plus its finished worker processes (--jobs)."""
+    total = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total += children.ru_utime + children.ru_stime
+    return total
+
+def output_bytes(paths) -> int:
+    """Total size of the given files that exist."""
+    return sum(path.stat().st_size for path in map(Path, paths) if path.is_file())
+
+class PipelineMetrics:
+    """Wall time, CPU time, throughput, bytes written and peak RSS of each pipeline stage."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str, records: int = None):
+        """
+        Measures the enclosed block as one stage. The yielded entry can be updated inside the
+        block with the records processed, the bytes written or stage-specific details.
+        """
+        entry = {"stage": name, "records": records, "bytes_written": 0}
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            seconds = time.perf_counter() - start
+            entry["seconds"] = round(seconds, 6)
+            entry["cpu_seconds"] = round(cpu_seconds() - cpu_start, 6)
+            entry["records_per_second"] = round(entry["records"] / seconds, 1) if entry["records"] and seconds > 0 else None
+            entry["peak_rss_bytes"] = peak_rss_bytes()
+            self.stages.append(entry)
+
+    def to_dict(self) -> dict:
+        return {
+            "version": METRICS_VERSION,
+            "seconds": round(time.perf_counter() - self.started, 6),
+            "cpu_seconds": round(cpu_seconds(), 6),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": self.stages,
+        }
+
+    def print_summary(self):
+        print(f"{'stage':<24} {'seconds':>9} {'cpu':>9} {'records/s':>12} {'bytes':>12}")
+        for entry in self.stages:
+            rate = f"{entry['records_per_second']:.0f}" if entry["records_per_second"] else '-'
+            print(f"{entry['stage']:<24} {entry['seconds']:>9.3f} {entry['cpu_seconds']:>9.3f} {rate:>12} {entry['bytes_written']:>12}")
+        peak = peak_rss_bytes()
+        if peak is not None:
+            print(f"Peak RSS: {peak / (1 << 20):.1f} MiB")
+
+    def save(self, file_path: Path):
+        write_text_file(Path(file_path), json.dumps(self.to_dict(), indent=2))
+
+def save_profile(profiler: cProfile.Profile, file_path: Path, top: int = PROFILE_TOP_FUNCTIONS):
+    """Dumps the profiler stats (readable with pstats or snakeviz) and prints the top functions by cumulative time."""
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(str(file_path))
+    pstats.Stats(profiler).strip_dirs().sort_stats('cumulative').print_stats(top)
+
 
 # --- Main Execution ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fragment B3 JSON data and generate Jest tests per asset.")
     parser.add_argument(
         "--negociacao",
-        default=DEFAULT_NEGOCIACAO_PATH,
-        help=f"Path to the B3 negociacao JSON file (default: {DEFAULT_NEGOCIACAO_PATH})"
+        nargs='+',
+        default=[DEFAULT_NEGOCIACAO_PATH],
+        help="Path(s) or glob(s) of the B3 negociacao JSON files, or B3 Portal .xlsx exports (needs openpyxl); several "
+             f"overlapping exports are merged by date without duplicates (default: {DEFAULT_NEGOCIACAO_PATH})"
     )
     parser.add_argument(
         "--movimentacao",
-        default=DEFAULT_MOVIMENTACAO_PATH,
-        help=f"Path to the B3 movimentacao JSON file (default: {DEFAULT_MOVIMENTACAO_PATH})"
+        nargs='+',
+        default=[DEFAULT_MOVIMENTACAO_PATH],
+        help="Path(s) or glob(s) of the B3 movimentacao JSON files, or B3 Portal .xlsx exports (needs openpyxl); several "
+             f"overlapping exports are merged by date without duplicates (default: {DEFAULT_MOVIMENTACAO_PATH})"
     )
     parser.add_argument(
         "--history-dir",
@@ -1447,48 +4717,335 @@ if __name__ == "__main__":
         default=DECLARATION_YEAR,
         help=f"Declaration year for calculations (default: {DECLARATION_YEAR})"
     )
+    parser.add_argument(
+        "--years",
+        help="Several declaration years, as a range and/or a comma-separated list (e.g. 2019-2025); the expectations "
+             "of every year are computed in the same pass and each generated test runs once per year (overrides --year)"
+    )
+    parser.add_argument(
+        "--skip-inactive",
+        action="store_true",
+        help="Only write the asset groups with a trade, event or income in the declaration year(s) or an open position "
+             "at the end of them or of the year before, using an activity index built while fragmenting"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to generate the per-ticker files (default: 1, serial)"
+    )
+    parser.add_argument(
+        "--layout",
+        choices=TEST_LAYOUTS,
+        default='per-ticker',
+        help="per-ticker: one .test.ts per ticker; consolidated: an asset manifest plus a few describe.each suites (default: per-ticker)"
+    )
+    parser.add_argument(
+        "--suites",
+        type=int,
+        default=DEFAULT_SUITES,
+        help=f"Number of suite files written by --layout consolidated (default: {DEFAULT_SUITES})"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Bin-pack the tickers into this many consolidated suites balanced by record count, one per CI worker; "
+             f"{ASSET_SHARDS_FILE} lists each suite's path and the `react-scripts test <path>` command that runs it alone "
+             "(implies --layout consolidated --suites K)"
+    )
+    parser.add_argument(
+        "--timeline",
+        action="store_true",
+        help="Also write each ticker's transactions and movements merged into one pre-sorted, pre-parsed timeline "
+             "(<ticker>_timeline.json), read by the per-ticker tests instead of re-parsing and sorting dates"
+    )
+    parser.add_argument(
+        "--snapshots",
+        action="store_true",
+        help=f"Also write each ticker's expected results, computed once by the Python reference engine (<ticker>{SNAPSHOT_FILE_SUFFIX}); "
+             "the generated tests then only compare AssetProcessor against them instead of running the calculation helpers"
+    )
+    parser.add_argument(
+        "--history-format",
+        choices=HISTORY_FORMATS,
+        default=DEFAULT_HISTORY_FORMAT,
+        help="Format of the history files: pretty (indented JSON), compact (JSON without whitespace), ndjson (one record "
+             "per line, .ndjson) or columnar (value arrays per field with dictionaries, .columns.json); the generated "
+             f"tests load whichever is chosen (default: {DEFAULT_HISTORY_FORMAT})"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rewrite every asset group even if its inputs did not change since the last run"
+    )
+    parser.add_argument(
+        "--reference-summaries",
+        help="Also compute every ticker's year-end position with the Python reference engine and save it to this JSON file"
+    )
+    parser.add_argument(
+        "--trade-results",
+        help="Also match every sale of the declaration year(s) against the ticker's buy lots in FIFO order (like "
+             "AssetProcessor.calculateTradeResults) and save the realized result of each sale to this JSON file"
+    )
+    parser.add_argument(
+        "--capital-gains",
+        help="Also compute the monthly capital gains ledger per asset category over the whole history in one pass "
+             f"(FIFO results, R$ {STOCK_SALES_EXEMPTION_LIMIT} stock sales exemption, stock and FII loss carry-forward "
+             "across months and years) and save the declaration year(s) to this JSON file"
+    )
+    parser.add_argument(
+        "--simple-summaries",
+        help="Also compute every ticker's Compra/Venda year-end position (calcularResumoAnual, vectorized with NumPy when available) and save it to this JSON file"
+    )
+    parser.add_argument(
+        "--exact-summaries",
+        help="Also compute every ticker's Compra/Venda year-end position with its cost as an exact fraction of centavos and save it to this JSON file"
+    )
+    parser.add_argument(
+        "--drift-report",
+        help="Save to this JSON file the ticker-years where the float Compra/Venda totals differ from the exact centavo ones"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for the parsed columnar cache of the input files (Parquet with pyarrow, else NumPy .npz), reused while the files are unchanged; "
+             "the cached rows are loaded as compact records whose parsed fields come from the typed columns (implies --compact)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse the input files incrementally, one record at a time, instead of loading them whole (always on for .xlsx exports); "
+             "the records are spilled to per-ticker files while fragmenting, so memory stays flat"
+    )
+    parser.add_argument(
+        "--spill-dir",
+        help="Directory for the per-ticker spill files of --stream, removed at exit (default: the system temporary directory)"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Hold the input rows as compact __slots__ records parsed once at load time instead of dicts (less memory per row)"
+    )
+    parser.add_argument(
+        "--duplicate-report",
+        help=f"Save to this JSON file the movimentação events the calculation helper skips as duplicates (same asset, type and quantity within {DUPLICATE_TIME_WINDOW_DAYS} days)"
+    )
+    parser.add_argument(
+        "--drop-duplicates",
+        action="store_true",
+        help="Also leave those duplicate events out of the history files (by default the history keeps every exported row, so the helper's own check is exercised)"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Save the wall time, CPU time, records/s, bytes written and peak RSS of every pipeline stage to this JSON file"
+    )
+    parser.add_argument(
+        "--profile",
+        help="Run the pipeline under cProfile, save the stats to this file and print the top functions "
+             "(with --jobs > 1 only the parent process is profiled)"
+    )
 
 
     args = parser.parse_args()
-    declaration_year = int(args.year.strip())
+    declaration_years = parse_declaration_years(args.years) if args.years else (int(str(args.year).strip()),)
+    if args.shards:
+        args.layout, args.suites = 'consolidated', args.shards
 
     # Adjust relative paths to be relative to the script's location
     script_dir = Path(__file__).parent
-    negociacao_path = script_dir / args.negociacao
-    movimentacao_path = script_dir / args.movimentacao
+    negociacao_paths = resolve_input_paths(args.negociacao, script_dir)
+    movimentacao_paths = resolve_input_paths(args.movimentacao, script_dir)
     history_output_dir = script_dir / args.history_dir
     test_output_dir = script_dir / args.test_dir
+    if any(is_xlsx_export(path) for path in negociacao_paths + movimentacao_paths):
+        # Spreadsheet rows go straight into fragment_data instead of being loaded into a list first
+        args.stream = True
 
     print("Starting test generation process...")
-    print(f"Negociação file: {negociacao_path}")
-    print(f"Movimentação file: {movimentacao_path}")
+    print(f"Negociação file{'s' if len(negociacao_paths) > 1 else ''}: {', '.join(map(str, negociacao_paths))}")
+    print(f"Movimentação file{'s' if len(movimentacao_paths) > 1 else ''}: {', '.join(map(str, movimentacao_paths))}")
     print(f"History output directory: {history_output_dir}")
     print(f"Test output directory: {test_output_dir}")
 
 
-    # 1. Load Data
-    negociacao_data = load_json_data(negociacao_path)
-    movimentacao_data = load_json_data(movimentacao_path)
-    print(f"Loaded {len(negociacao_data)} negotiation records and {len(movimentacao_data)} movement records.")
+    metrics = PipelineMetrics()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+
+    # 1. Load Data (with --stream the files are only opened here and parsed by the stages that read them)
+    cache_dir = script_dir / args.cache_dir if args.cache_dir else None
+    with metrics.stage("load") as stage:
+        merge_stats = {"negociação": {}, "movimentação": {}}
+        negociacao_data = load_export_files(
+            negociacao_paths, FIELD_NEG_DATE, args.stream, cache_dir, args.compact, merge_stats["negociação"]
+        )
+        movimentacao_data = load_export_files(
+            movimentacao_paths, FIELD_MOV_DATE, args.stream, cache_dir, args.compact, merge_stats["movimentação"]
+        )
+        stage["bytes_read"] = output_bytes(negociacao_paths + movimentacao_paths)
+        if not args.stream:
+            stage["records"] = len(negociacao_data) + len(movimentacao_data)
+            print(f"Loaded {len(negociacao_data)} negotiation records and {len(movimentacao_data)} movement records.")
 
     # 2. Fragment Data
-    fragmented_data = fragment_data(negociacao_data, movimentacao_data)
-    print(f"Fragmented data into {len(fragmented_data)} asset groups.")
-
-    # 3. Save Fragmented Files
-    save_fragmented_files(fragmented_data, history_output_dir)
-
-    # 4. Generate Test Files
+    with metrics.stage("fragment") as stage:
+        fragmented_data = fragment_data(negociacao_data, movimentacao_data, activity=args.skip_inactive, spill_dir=args.spill_dir)
+        transactions_count, movements_count = fragmented_data.record_counts()
+        stage["records"] = transactions_count + movements_count
+        stage["tickers"] = len(fragmented_data)
+        if args.stream:
+            print(f"Streamed {transactions_count} negotiation records and {movements_count} movement records.")
+        for label, paths in (("negociação", negociacao_paths), ("movimentação", movimentacao_paths)):
+            if len(paths) > 1:
+                stats = merge_stats[label]
+                stage[f"{label}_duplicates"] = stats["duplicates"]
+                print(f"Merged {len(paths)} {label} files: {stats['records']} records, {stats['duplicates']} duplicate(s) removed.")
+        print(f"Fragmented data into {len(fragmented_data)} asset groups.")
+    records_count = metrics.stages[-1]["records"]
+
+    # 3. Find Duplicate Events (only reported, unless --drop-duplicates leaves them out of the history too)
+    if args.duplicate_report or args.drop_duplicates:
+        with metrics.stage("duplicate_events", movements_count) as stage:
+            duplicate_events = find_fragmented_duplicate_events(fragmented_data)
+            stage["duplicates"] = len(duplicate_events)
+            if args.duplicate_report:
+                duplicate_report_path = script_dir / args.duplicate_report
+                save_reference_summaries(duplicate_events, duplicate_report_path)
+                stage["bytes_written"] = output_bytes([duplicate_report_path])
+            if args.drop_duplicates:
+                fragmented_data = fragmented_data.without_records("movements", (duplicate["index"] for duplicate in duplicate_events))
+        action = "Dropped" if args.drop_duplicates else "Found"
+        print(f"{action} {len(duplicate_events)} duplicate movimentação event(s) within {DUPLICATE_TIME_WINDOW_DAYS} days.")
+        if args.duplicate_report:
+            print(f"Saved the duplicate event report to {duplicate_report_path}")
+
+    records_count = metrics.stages[-1]["records"]
+
+    if args.reference_summaries:
+        reference_summaries_path = script_dir / args.reference_summaries
+        with metrics.stage("reference_summaries", records_count) as stage:
+            save_reference_summaries(compute_reference_summaries(fragmented_data), reference_summaries_path)
+            stage["bytes_written"] = output_bytes([reference_summaries_path])
+        print(f"Saved reference year-end summaries of {len(fragmented_data)} asset groups to {reference_summaries_path}")
+
+    if args.trade_results:
+        trade_results_path = script_dir / args.trade_results
+        with metrics.stage("trade_results", records_count) as stage:
+            save_reference_summaries(compute_fifo_trade_results(fragmented_data, declaration_years), trade_results_path)
+            stage["bytes_written"] = output_bytes([trade_results_path])
+        print(f"Saved FIFO sale results of {len(fragmented_data)} asset groups to {trade_results_path}")
+
+    if args.capital_gains:
+        capital_gains_path = script_dir / args.capital_gains
+        with metrics.stage("capital_gains", records_count) as stage:
+            save_reference_summaries(compute_capital_gains_ledger(fragmented_data, declaration_years), capital_gains_path)
+            stage["bytes_written"] = output_bytes([capital_gains_path])
+        print(f"Saved the monthly capital gains ledger of {len(fragmented_data)} asset groups to {capital_gains_path}")
+
+    if args.simple_summaries:
+        simple_summaries_path = script_dir / args.simple_summaries
+        with metrics.stage("simple_summaries", records_count) as stage:
+            negociacao_table = (
+                load_cached_export_table(negociacao_paths[0], cache_dir, args.stream)
+                if cache_dir and np is not None and len(negociacao_paths) == 1 else None
+            )
+            save_reference_summaries(compute_simple_summaries(fragmented_data, negociacao_table=negociacao_table), simple_summaries_path)
+            stage["bytes_written"] = output_bytes([simple_summaries_path])
+        print(f"Saved simple year-end summaries of {len(fragmented_data)} asset groups to {simple_summaries_path}")
+
+    if args.exact_summaries or args.drift_report:
+        with metrics.stage("exact_summaries", records_count) as stage:
+            exact_summaries = compute_exact_summaries(fragmented_data)
+            if args.exact_summaries:
+                exact_summaries_path = script_dir / args.exact_summaries
+                save_reference_summaries(exact_summaries, exact_summaries_path)
+                stage["bytes_written"] = output_bytes([exact_summaries_path])
+                print(f"Saved exact centavo year-end summaries of {len(fragmented_data)} asset groups to {exact_summaries_path}")
+            if args.drift_report:
+                drift_report_path = script_dir / args.drift_report
+                float_summaries = {
+                    ticker: calcular_resumo_anual(ticker_records(fragmented_data, ticker, "transactions"))
+                    for ticker in fragmented_data
+                }
+                drift = centavo_drift_report(float_summaries, exact_summaries)
+                save_reference_summaries(drift, drift_report_path)
+                stage["bytes_written"] += output_bytes([drift_report_path])
+                print(f"Found {len(drift)} ticker-year(s) where float totals drift from exact centavos, saved to {drift_report_path}")
+
+    # Only the asset groups relevant to the declaration year(s) get history and test files
+    test_data = fragmented_data
+    if args.skip_inactive:
+        with metrics.stage("activity") as stage:
+            test_data = fragmented_data.restricted_to(select_active_tickers(fragmented_data, declaration_years))
+            stage["tickers"] = len(test_data)
+            stage["skipped"] = len(fragmented_data) - len(test_data)
+        years_label = ', '.join(map(str, declaration_years))
+        print(f"Skipping {len(fragmented_data) - len(test_data)} of {len(fragmented_data)} asset groups without activity or position in {years_label}.")
+
+    # 4. Generate Calculation Helper
     # Calculate relative path from test_dir to history_dir for imports
     history_dir_relative = os.path.relpath(history_output_dir, test_output_dir)
 
-    generate_calculation_helper_file(test_output_dir)
-
-    for ticker, data in fragmented_data.items():
-        print(f"Processing asset group: {ticker}")
-        # Calculate expected counts for this group
-        
-        # Generate the test file with counts
-        generate_jest_test_file(ticker, test_output_dir, history_dir_relative)
+    with metrics.stage("calculation_helper") as stage:
+        helper_path = generate_calculation_helper_file(test_output_dir)
+        stage["bytes_written"] = output_bytes([helper_path] if helper_path else [])
+
+    # 5. Save Fragmented Files and Generate Test Files (per ticker), skipping unchanged ones
+    manifest_path = manifest_path_for(history_output_dir)
+    # The previous manifest is always read, so stale tickers are found even with --force
+    previous_digests = load_generation_manifest(manifest_path)
+
+    with metrics.stage("ticker_files", records_count) as stage:
+        generation = generate_all_ticker_files(
+            test_data, history_output_dir, test_output_dir, history_dir_relative, declaration_years,
+            jobs=args.jobs, previous_digests={} if args.force else previous_digests, layout=args.layout, timeline=args.timeline,
+            history_format=args.history_format, snapshots=args.snapshots
+        )
+        ticker_stats = generation["stats"]
+        stage["bytes_written"] = ticker_stats["history_bytes"] + ticker_stats["test_bytes"]
+        stage.update(written=generation["written"], skipped=generation["skipped"], jobs=args.jobs)
+        # Summed over the tickers, so with --jobs > 1 they add up to more than the stage's wall time
+        stage["save_history"] = {"seconds": round(ticker_stats["history_seconds"], 6), "bytes_written": ticker_stats["history_bytes"]}
+        stage["jest_tests"] = {"seconds": round(ticker_stats["test_seconds"], 6), "bytes_written": ticker_stats["test_bytes"]}
+
+    if args.layout == 'consolidated':
+        with metrics.stage("consolidated_suites") as stage:
+            suites = generate_consolidated_suite_files(
+                test_data, test_output_dir, history_dir_relative, declaration_years, args.suites, script_dir / JEST_ROOT_DIR,
+                args.history_format, args.snapshots
+            )
+            stage["bytes_written"] = output_bytes([
+                test_output_dir / ASSET_MANIFEST_FILE, test_output_dir / ASSET_SHARDS_FILE, *test_output_dir.glob(ASSET_SUITE_FILE_GLOB)
+            ])
+        print(f"Wrote the asset manifest and {suites} consolidated test suite(s) to {test_output_dir}")
+    else:
+        delete_consolidated_suite_files(test_output_dir)
+
+    # 6. Remove files of tickers that disappeared from the input (or were skipped) and record the new manifest
+    with metrics.stage("cleanup") as stage:
+        stale_tickers = sorted(set(previous_digests) - set(test_data))
+        deleted = delete_stale_ticker_files(stale_tickers, history_output_dir, test_output_dir)
+        save_generation_manifest(manifest_path, generation["digests"])
+        stage["deleted"] = deleted
+
+    print(f"Asset groups: {generation['written']} written, {generation['skipped']} skipped (unchanged), {deleted} deleted (stale).")
+
+    if profiler:
+        profiler.disable()
+        profile_path = script_dir / args.profile
+        save_profile(profiler, profile_path)
+        print(f"Saved profile stats to {profile_path}")
+
+    if args.metrics_json or args.profile:
+        metrics.print_summary()
+    if args.metrics_json:
+        metrics_path = script_dir / args.metrics_json
+        metrics.save(metrics_path)
+        print(f"Saved pipeline metrics to {metrics_path}")
+
+    failures = generation["failures"]
+    if failures:
+        print(f"Test generation process completed with {len(failures)} failed asset group(s): {', '.join(ticker for ticker, _ in failures)}")
+        exit(1)
 
     print("Test generation process completed.")
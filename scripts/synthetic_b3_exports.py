@@ -0,0 +1,247 @@
+# python scripts/synthetic_b3_exports.py --rows 1000000 --output-dir /tmp/b3-sintetico
+
+import argparse
+import json
+import math
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+import generate_asset_tests as gat
+
+# --- Configuration ---
+DEFAULT_ROWS = 100_000 # Negociação rows; movimentação rows follow from the trades and events
+DEFAULT_TICKERS = 50
+DEFAULT_START_YEAR = 2019
+DEFAULT_END_YEAR = 2025
+DEFAULT_SEED = 42
+
+# Per ticker and year: probability of each corporate event, and expected income payments
+DEFAULT_RATES = {
+    "split": 0.03,            # Desdobro
+    "reverse_split": 0.01,    # Grupamento
+    "bonus": 0.04,            # Bonificação em Ativos
+    "fraction": 0.5,          # Chance a split/reverse split/bonus leaves a Fração em Ativos + Leilão de Fração
+    "dividend": 4.0,          # Dividendo / Rendimento (FIIs) payments per year
+    "jcp": 1.0,               # Juros sobre Capital Próprio payments per year (stocks only)
+    "settlement": 0.3,        # Share of trades mirrored by a 'Transferência - Liquidação' movement
+}
+
+SYNTHETIC_BROKERS = ['CORRETORA EXEMPLO S/A', 'OUTRA CORRETORA EXEMPLO', 'BANCO EXEMPLO S/A']
+SPLIT_FACTORS = (2, 3, 4, 5, 10)
+REVERSE_SPLIT_FACTORS = (2, 5, 10, 20)
+BONUS_RATES = (0.05, 0.1, 0.2)
+POPULARITY_EXPONENT = 1.1 # Zipf-like skew: a few tickers get most of the trades
+FII_SHARE = 0.3 # Share of the tickers that are FIIs (XXXX11)
+
+PRICE_NONE = ' - ' # How B3 fills price/value of movements without cash
+
+# --- Helper Functions ---
+
+def synthetic_tickers(count: int, rng: random.Random) -> list:
+    """Distinct trading codes ('ABCD3', 'ABCD4', 'ABCD11') with a company name for 'Produto'."""
+    tickers = []
+    bases = set()
+    while len(tickers) < count:
+        base = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+        if base in bases:
+            continue
+        bases.add(base)
+        is_fii = rng.random() < FII_SHARE
+        code = f"{base}11" if is_fii else f"{base}{rng.choice([3, 4])}"
+        name = f"FII {base} EXEMPLO" if is_fii else f"EMPRESA {base} S/A"
+        tickers.append({"code": code, "product": f"{code} - {name}", "fii": is_fii})
+    return tickers
+
+def business_days(start_year: int, end_year: int) -> list:
+    """Every Monday-Friday from January 1st of start_year to December 31st of end_year."""
+    days = []
+    current = date(start_year, 1, 1)
+    end = date(end_year, 12, 31)
+    while current <= end:
+        if current.weekday() < 5:
+            days.append(current)
+        current += timedelta(days=1)
+    return days
+
+def schedule_events(tickers: list, days: list, rates: dict, rng: random.Random) -> dict:
+    """Day index -> [(ticker index, event kind)] for corporate events and income payments."""
+    by_year = {}
+    for index, day in enumerate(days):
+        by_year.setdefault(day.year, []).append(index)
+
+    schedule = {}
+    for ticker_index, ticker in enumerate(tickers):
+        for year_days in by_year.values():
+            events = []
+            for kind in ("split", "reverse_split", "bonus"):
+                if rng.random() < rates[kind]:
+                    events.append(kind)
+            payments = [("dividend", rates["dividend"])]
+            if not ticker["fii"]:
+                payments.append(("jcp", rates["jcp"]))
+            for kind, expected in payments:
+                count = int(expected) + (1 if rng.random() < expected - int(expected) else 0)
+                events.extend([kind] * count)
+            for kind in events:
+                schedule.setdefault(rng.choice(year_days), []).append((ticker_index, kind))
+    return schedule
+
+class JsonArrayWriter:
+    """Writes records one at a time as a JSON array indented like the B3 exports (indent=4)."""
+
+    def __init__(self, file_path: str):
+        self.file = open(file_path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record: dict):
+        self.file.write('[\n' if self.count == 0 else ',\n')
+        self.file.write('    ' + json.dumps(record, indent=4, ensure_ascii=False).replace('\n', '\n    '))
+        self.count += 1
+
+    def close(self):
+        self.file.write('\n]\n' if self.count else '[]\n')
+        self.file.close()
+
+def write_synthetic_exports(negociacao_path: str, movimentacao_path: str, rows: int = DEFAULT_ROWS,
+                            tickers: int = DEFAULT_TICKERS, start_year: int = DEFAULT_START_YEAR,
+                            end_year: int = DEFAULT_END_YEAR, seed: int = DEFAULT_SEED, rates: dict = None) -> dict:
+    """
+    Writes a negociação export of exactly `rows` trades and the matching movimentação export,
+    deterministically for a given seed. Each ticker follows a price random walk and a running
+    position: sells never exceed the quantity held, splits, reverse splits and bonuses change
+    it (with 'Fator' on splits and reverse splits), and income is paid on the quantity held.
+    Records are in chronological order (B3 lists the newest first; the script accepts both).
+    Returns the record counts.
+    """
+    rates = {**DEFAULT_RATES, **(rates or {})}
+    rng = random.Random(seed)
+    assets = synthetic_tickers(tickers, rng)
+    days = business_days(start_year, end_year)
+    schedule = schedule_events(assets, days, rates, rng)
+
+    popularity = [1 / (rank + 1) ** POPULARITY_EXPONENT for rank in range(len(assets))]
+    prices = [rng.uniform(5, 120) for _ in assets]
+    positions = [0.0] * len(assets)
+
+    negociacao = JsonArrayWriter(negociacao_path)
+    movimentacao = JsonArrayWriter(movimentacao_path)
+
+    def movement(day_text: str, asset: dict, kind: str, direction: str, quantity: float, unit_price=None, extra: dict = None):
+        record = {
+            gat.FIELD_MOV_DIRECTION: direction,
+            gat.FIELD_MOV_DATE: day_text,
+            gat.FIELD_MOV_TYPE: kind,
+            gat.FIELD_MOV_TICKER: asset["product"],
+            gat.FIELD_NEG_BROKER_NAME: SYNTHETIC_BROKERS[0],
+            gat.FIELD_MOV_QUANTITY: gat.format_quantity(round(quantity, 2)),
+            gat.FIELD_MOV_UNIT_PRICE: PRICE_NONE if unit_price is None else f"{unit_price:.2f}",
+            gat.FIELD_MOV_TOTAL_COST: PRICE_NONE if unit_price is None else f"{quantity * unit_price:.2f}",
+        }
+        if extra:
+            record.update(extra)
+        movimentacao.write(record)
+
+    try:
+        for day_index, day in enumerate(days):
+            day_text = day.strftime('%d/%m/%Y')
+
+            for asset_index in range(len(assets)):
+                prices[asset_index] = max(0.5, prices[asset_index] * math.exp(rng.gauss(0, 0.015)))
+
+            for asset_index, kind in schedule.get(day_index, ()):
+                asset = assets[asset_index]
+                held = positions[asset_index]
+                if held <= 0:
+                    continue
+
+                if kind in ("split", "reverse_split", "bonus"):
+                    if kind == "split":
+                        factor = rng.choice(SPLIT_FACTORS)
+                        new_quantity = held * factor
+                        movement(day_text, asset, 'Desdobro', 'Credito', held * (factor - 1), extra={gat.FIELD_NEG_FACTOR: str(factor)})
+                        prices[asset_index] /= factor
+                    elif kind == "reverse_split":
+                        factor = rng.choice(REVERSE_SPLIT_FACTORS)
+                        new_quantity = held / factor
+                        movement(day_text, asset, gat.EVENT_REVERSE_SPLIT, 'Credito', new_quantity, extra={gat.FIELD_NEG_FACTOR: str(factor)})
+                        prices[asset_index] *= factor
+                    else:
+                        new_quantity = held * (1 + rng.choice(BONUS_RATES))
+                        movement(day_text, asset, 'Bonificação em Ativos', 'Credito', math.floor(new_quantity) - held)
+
+                    fraction = new_quantity - math.floor(new_quantity)
+                    if fraction > 0 and rng.random() < rates["fraction"]:
+                        movement(day_text, asset, gat.EVENT_FRACTION, 'Debito', round(fraction, 2))
+                        movement(day_text, asset, 'Leilão de Fração', 'Credito', round(fraction, 2), prices[asset_index])
+                    positions[asset_index] = math.floor(new_quantity)
+
+                else:
+                    per_share = round(prices[asset_index] * rng.uniform(0.002, 0.012), 2) or 0.01
+                    if kind == "jcp":
+                        kind_name = gat.MOV_TYPE_JCP
+                    else:
+                        kind_name = gat.MOV_TYPE_FII_INCOME if asset["fii"] else gat.MOV_TYPE_DIVIDEND
+                    movement(day_text, asset, kind_name, 'Credito', held, per_share)
+
+            # Spread the trades evenly over the days so exactly `rows` are written
+            trades_today = (day_index + 1) * rows // len(days) - day_index * rows // len(days)
+            for asset_index in rng.choices(range(len(assets)), weights=popularity, k=trades_today):
+                asset = assets[asset_index]
+                price = round(prices[asset_index], 2) or 0.01
+                held = positions[asset_index]
+
+                if held >= 1 and rng.random() < 0.35:
+                    trade_type = gat.NEG_TYPE_SELL
+                    quantity = rng.randint(1, int(held))
+                    positions[asset_index] -= quantity
+                else:
+                    trade_type = 'Compra'
+                    quantity = rng.choice([rng.randint(1, 99), 100 * rng.randint(1, 10)]) if not asset["fii"] else rng.randint(1, 200)
+                    positions[asset_index] += quantity
+
+                fractional = not asset["fii"] and quantity % 100 != 0
+                negociacao.write({
+                    gat.FIELD_NEG_DATE: day_text,
+                    gat.FIELD_NEG_TYPE: trade_type,
+                    gat.FIELD_NEG_MARKET_TYPE: 'Mercado Fracionário' if fractional else 'Mercado à Vista',
+                    'Prazo/Vencimento': '-',
+                    gat.FIELD_NEG_BROKER_NAME: rng.choice(SYNTHETIC_BROKERS),
+                    gat.FIELD_NEG_TICKER: f"{asset['code']}F" if fractional else asset["code"],
+                    gat.FIELD_NEG_QUANTITY: str(quantity),
+                    gat.FIELD_NEG_UNIT_PRICE: f"{price:.2f}",
+                    gat.FIELD_NEG_TOTAL_COST: f"{quantity * price:.2f}",
+                })
+
+                if rng.random() < rates["settlement"]:
+                    direction = 'Credito' if trade_type == 'Compra' else 'Debito'
+                    movement(day_text, asset, 'Transferência - Liquidação', direction, quantity, price)
+    finally:
+        negociacao.close()
+        movimentacao.close()
+
+    return {"negociacao": negociacao.count, "movimentacao": movimentacao.count, "tickers": len(assets)}
+
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write deterministic synthetic B3 negociação and movimentação exports.")
+    parser.add_argument("--output-dir", required=True, help="Directory for negociacao-sintetica.json and movimentacao-sintetica.json")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help=f"Negociação rows (default: {DEFAULT_ROWS})")
+    parser.add_argument("--tickers", type=int, default=DEFAULT_TICKERS, help=f"Distinct tickers (default: {DEFAULT_TICKERS})")
+    parser.add_argument("--start-year", type=int, default=DEFAULT_START_YEAR, help=f"First year of history (default: {DEFAULT_START_YEAR})")
+    parser.add_argument("--end-year", type=int, default=DEFAULT_END_YEAR, help=f"Last year of history (default: {DEFAULT_END_YEAR})")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"Random seed (default: {DEFAULT_SEED})")
+    for name, value in DEFAULT_RATES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}-rate", type=float, default=value, help=f"Rate of {name} events, see DEFAULT_RATES (default: {value})")
+
+    args = parser.parse_args()
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    counts = write_synthetic_exports(
+        output_dir / 'negociacao-sintetica.json', output_dir / 'movimentacao-sintetica.json',
+        rows=args.rows, tickers=args.tickers, start_year=args.start_year, end_year=args.end_year, seed=args.seed,
+        rates={name: getattr(args, f"{name}_rate") for name in DEFAULT_RATES}
+    )
+    print(json.dumps(counts))